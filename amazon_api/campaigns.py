@@ -1,14 +1,16 @@
 # amazon_api/campaigns.py
 
 import json
-import requests
 from settings import API_BASE_URL, CLIENT_ID
+from .credentials import bearer
 
 
 def get_sp_campaigns(access_token, profile_id):
+    import requests
+
     url = f"{API_BASE_URL}/sp/campaigns/list"
     headers = {
-        "Authorization": f"Bearer {access_token}",
+        "Authorization": bearer(access_token),
         "Amazon-Advertising-API-Scope": str(profile_id),
         "Amazon-Advertising-API-ClientId": CLIENT_ID,
         "Accept": "application/vnd.spcampaign.v3+json",
@@ -35,4 +37,42 @@ def get_sp_campaigns(access_token, profile_id):
     for c in camps:
         print(f"- ID: {c['campaignId']} | Nome: {c['name']} | Stato: {c['state']}")
     print()
-    return camps
\ No newline at end of file
+    return camps
+
+
+def iter_campaign_pages(access_token, profile_id, max_results=1000):
+    """
+    Campagne SP paginate (nextToken), senza log: restituisce pagina per
+    pagina (lista campagne, byte grezzi della risposta).
+    """
+    import requests
+
+    url = f"{API_BASE_URL}/sp/campaigns/list"
+    headers = {
+        "Authorization": bearer(access_token),
+        "Amazon-Advertising-API-Scope": str(profile_id),
+        "Amazon-Advertising-API-ClientId": CLIENT_ID,
+        "Accept": "application/vnd.spcampaign.v3+json",
+        "Content-Type": "application/vnd.spcampaign.v3+json",
+    }
+    payload = {
+        "campaignFilter": {
+            "campaignTypes": ["SPONSORED_PRODUCTS"],
+            "stateFilter": ["ENABLED", "PAUSED"],
+        },
+        "maxResults": max_results,
+    }
+
+    while True:
+        # header ricostruiti a ogni pagina: il token può essere un provider
+        headers["Authorization"] = bearer(access_token)
+        resp = requests.post(url, headers=headers, json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+
+        yield data.get("campaigns", []), resp.content
+
+        next_token = data.get("nextToken")
+        if not next_token:
+            return
+        payload["nextToken"] = next_token
@@ -0,0 +1,24 @@
+# amazon_api/credentials.py
+
+"""
+Credenziali per le chiamate HTTP Amazon Ads.
+
+Le funzioni di amazon_api accettano come access_token una stringa oppure un
+provider: un callable senza argomenti (es. auth.ensure_access_token) che
+viene interrogato a ogni richiesta. Con il provider, i job lunghi (attesa
+report, update massivi) usano sempre il token corrente invece di quello
+letto all'inizio, e non arrivano a scadenza a metà lavoro.
+"""
+
+from typing import Callable, Union
+
+AccessToken = Union[str, Callable[[], str]]
+
+
+def resolve_access_token(access_token: AccessToken) -> str:
+    return access_token() if callable(access_token) else access_token
+
+
+def bearer(access_token: AccessToken) -> str:
+    """Valore dell'header Authorization per la richiesta corrente."""
+    return f"Bearer {resolve_access_token(access_token)}"
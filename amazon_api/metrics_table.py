@@ -0,0 +1,194 @@
+# amazon_api/metrics_table.py
+
+"""
+Tabella colonnare compatta delle metriche per target (report SP Targeting).
+
+Al posto di un dict {str(targetId): {6 valori boxed}} per riga, le metriche
+stanno in array tipizzati (int64 / float64) ordinati per targetId:
+    8 byte x 7 colonne = 56 byte per target, contro le centinaia del dict.
+
+La ricerca per targetId è una bisezione sull'array degli ID, senza indice
+aggiuntivo in memoria. ACOS mancante (nessuna vendita) è NaN.
+"""
+
+import math
+from array import array
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+INT_COLUMNS = ("impressions", "clicks", "orders")
+FLOAT_COLUMNS = ("cost", "sales", "acos")
+COLUMNS = ("impressions", "clicks", "cost", "orders", "sales", "acos")
+
+# Colonne alternative per ordini/vendite: v3 (purchases14d/sales14d) o v2
+ORDERS_KEYS = ("purchases14d", "attributedConversions14d")
+SALES_KEYS = ("sales14d", "attributedSales14d")
+
+NAN = float("nan")
+
+
+class MetricsTable:
+    """
+    Metriche per target in colonne tipizzate, ordinate per target_id.
+
+    Le colonne sono array.array: si possono passare così come sono a
+    pandas/numpy (buffer protocol) o leggere per indice dal motore regole.
+    """
+
+    __slots__ = ("target_ids", "impressions", "clicks", "cost", "orders", "sales", "acos")
+
+    def __init__(self) -> None:
+        self.target_ids = array("q")
+        self.impressions = array("q")
+        self.clicks = array("q")
+        self.orders = array("q")
+        self.cost = array("d")
+        self.sales = array("d")
+        self.acos = array("d")
+
+    def __len__(self) -> int:
+        return len(self.target_ids)
+
+    def __contains__(self, target_id: Any) -> bool:
+        return self.index_of(target_id) is not None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in self.columns().values())
+
+    def columns(self) -> Dict[str, array]:
+        out = {"target_id": self.target_ids}
+        for name in COLUMNS:
+            out[name] = getattr(self, name)
+        return out
+
+    def index_of(self, target_id: Any) -> Optional[int]:
+        try:
+            tid = int(target_id)
+        except (TypeError, ValueError):
+            return None
+        i = bisect_left(self.target_ids, tid)
+        if i < len(self.target_ids) and self.target_ids[i] == tid:
+            return i
+        return None
+
+    def row(self, i: int) -> Dict[str, Any]:
+        """Metriche della riga i, nello stesso formato di get_sp_targeting_metrics."""
+        acos = self.acos[i]
+        return {
+            "impressions": self.impressions[i],
+            "clicks": self.clicks[i],
+            "cost": self.cost[i],
+            "orders": self.orders[i],
+            "sales": self.sales[i],
+            "acos": None if math.isnan(acos) else acos,
+        }
+
+    def get(self, target_id: Any, default: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        i = self.index_of(target_id)
+        return default if i is None else self.row(i)
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for i, tid in enumerate(self.target_ids):
+            yield str(tid), self.row(i)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """Formato storico {str(targetId): metriche}, per i chiamanti esistenti."""
+        return dict(self.items())
+
+    def _sort(self) -> None:
+        """Ordina per target_id; per ID duplicati vince l'ultima riga (come nel dict)."""
+        ids = self.target_ids
+        if all(ids[i] < ids[i + 1] for i in range(len(ids) - 1)):
+            return
+
+        # sort stabile: a parità di ID l'ultima occorrenza resta in fondo al gruppo
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        keep = [
+            pos
+            for n, pos in enumerate(order)
+            if n + 1 == len(order) or ids[order[n + 1]] != ids[pos]
+        ]
+        for name, col in self.columns().items():
+            reordered = array(col.typecode, (col[pos] for pos in keep))
+            setattr(self, "target_ids" if name == "target_id" else name, reordered)
+
+
+def _first_value(row: Dict[str, Any], keys: Tuple[str, ...]) -> Any:
+    """Primo valore non nullo e diverso da zero tra le colonne alternative (v3, poi v2)."""
+    value = None
+    for key in keys:
+        value = row.get(key)
+        if value:
+            return value
+    return value
+
+
+def parse_sp_targeting_table(rows: Iterable[Dict[str, Any]]) -> MetricsTable:
+    """
+    Costruisce una MetricsTable dalle righe del report.
+
+    Ordini e vendite si leggono riga per riga da v3 o, in mancanza, da v2
+    (ORDERS_KEYS / SALES_KEYS): un report con righe miste non perde valori.
+    """
+    table = MetricsTable()
+
+    ids_append = table.target_ids.append
+    imp_append = table.impressions.append
+    clk_append = table.clicks.append
+    cost_append = table.cost.append
+    ord_append = table.orders.append
+    sales_append = table.sales.append
+    acos_append = table.acos.append
+
+    for row in rows:
+        tid = row.get("targetId")
+        if tid is None:
+            continue
+
+        cost = float(row.get("cost") or 0.0)
+        sales = float(_first_value(row, SALES_KEYS) or 0.0)
+
+        ids_append(int(tid))
+        imp_append(int(row.get("impressions") or 0))
+        clk_append(int(row.get("clicks") or 0))
+        cost_append(cost)
+        ord_append(int(_first_value(row, ORDERS_KEYS) or 0))
+        sales_append(sales)
+        acos_append((cost / sales) * 100.0 if sales > 0 and cost > 0 else NAN)
+
+    table._sort()
+    return table
+
+
+def parse_sp_targeting_daily(rows: Iterable[Dict[str, Any]]) -> Dict[str, MetricsTable]:
+    """
+    Righe di un report con timeUnit DAILY -> una MetricsTable per giorno
+    (chiave "AAAA-MM-GG"), in una sola passata e senza tenere le righe.
+    """
+    tables: Dict[str, MetricsTable] = {}
+
+    for row in rows:
+        tid = row.get("targetId")
+        day = row.get("date")
+        if tid is None or not day:
+            continue
+
+        table = tables.get(day)
+        if table is None:
+            table = tables[day] = MetricsTable()
+
+        cost = float(row.get("cost") or 0.0)
+        sales = float(_first_value(row, SALES_KEYS) or 0.0)
+
+        table.target_ids.append(int(tid))
+        table.impressions.append(int(row.get("impressions") or 0))
+        table.clicks.append(int(row.get("clicks") or 0))
+        table.cost.append(cost)
+        table.orders.append(int(_first_value(row, ORDERS_KEYS) or 0))
+        table.sales.append(sales)
+        table.acos.append((cost / sales) * 100.0 if sales > 0 and cost > 0 else NAN)
+
+    for table in tables.values():
+        table._sort()
+    return tables
@@ -0,0 +1,175 @@
+# amazon_api/profiles.py
+
+"""
+Registro dei profili Amazon Ads con cache persistente.
+
+La lista di /v2/profiles cambia di rado: la salviamo nella tabella settings
+(chiave PROFILE_CACHE_KEY) con un TTL e la indicizziamo in memoria per
+profileId e per marketplace (countryCode o marketplaceStringId), così
+scheduler e UI risolvono profilo/marketplace/valuta senza chiamate API.
+"""
+
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from .credentials import AccessToken
+
+PROFILE_CACHE_KEY = "profiles_cache"
+PROFILE_CACHE_TTL = 24 * 3600   # secondi
+
+# alcuni account usano GB, le regole tipicamente UK (e viceversa)
+MARKETPLACE_ALIASES = {"GB": "UK", "UK": "GB"}
+
+
+class ProfileRegistry:
+    """Profili indicizzati: lookup O(1) per profileId e per marketplace."""
+
+    def __init__(self, profiles: List[Dict[str, Any]], fetched_at: float):
+        self.profiles = profiles
+        self.fetched_at = fetched_at
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._by_marketplace: Dict[str, List[Dict[str, Any]]] = {}
+
+        for p in profiles:
+            self._by_id[str(p["profileId"])] = p
+            keys = {
+                (p.get("countryCode") or "").upper(),
+                (p.get("marketplaceString") or "").upper(),
+                ((p.get("accountInfo") or {}).get("marketplaceStringId") or "").upper(),
+            }
+            for key in keys - {""}:
+                self._by_marketplace.setdefault(key, []).append(p)
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    def __iter__(self):
+        return iter(self.profiles)
+
+    def age_seconds(self) -> float:
+        return time.time() - self.fetched_at
+
+    def get(self, profile_id: Any) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(str(profile_id))
+
+    def by_marketplace(self, marketplace: Optional[str]) -> List[Dict[str, Any]]:
+        """Profili del marketplace (countryCode o marketplaceStringId); None = tutti."""
+        if not marketplace:
+            return list(self.profiles)
+        key = marketplace.upper()
+        found = self._by_marketplace.get(key)
+        if found is None and key in MARKETPLACE_ALIASES:
+            found = self._by_marketplace.get(MARKETPLACE_ALIASES[key])
+        return list(found or [])
+
+    def canonical_marketplace(self, marketplace: Optional[str]) -> Optional[str]:
+        """
+        Codice con cui i target del marketplace sono etichettati (quello di
+        marketplace_of): risolve minuscole, alias UK/GB e marketplaceStringId
+        come by_marketplace. Senza profili corrispondenti: maiuscolo.
+        """
+        if not marketplace:
+            return marketplace
+        found = self.by_marketplace(marketplace.strip())
+        if found:
+            return self.marketplace_of(found[0]["profileId"])
+        return marketplace.strip().upper()
+
+    def marketplace_of(self, profile_id: Any) -> Optional[str]:
+        p = self.get(profile_id)
+        if not p:
+            return None
+        return p.get("countryCode") or p.get("marketplaceString")
+
+    def currency_of(self, profile_id: Any) -> Optional[str]:
+        p = self.get(profile_id)
+        return p.get("currencyCode") if p else None
+
+
+_registry: Optional[ProfileRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def _load_persisted() -> Optional[ProfileRegistry]:
+    from db.database import get_setting
+
+    raw = get_setting(PROFILE_CACHE_KEY)
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+        return ProfileRegistry(data["profiles"], float(data["fetched_at"]))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _persist(registry: ProfileRegistry) -> None:
+    from db.database import set_setting
+
+    set_setting(
+        PROFILE_CACHE_KEY,
+        json.dumps({"fetched_at": registry.fetched_at, "profiles": registry.profiles}),
+    )
+
+
+def load_profile_registry(
+    access_token: Optional[AccessToken] = None,
+    ttl: float = PROFILE_CACHE_TTL,
+    force_refresh: bool = False,
+) -> ProfileRegistry:
+    """
+    Registro profili: memoria -> tabella settings -> /v2/profiles.
+
+    Se la cache è scaduta serve access_token (stringa o provider) per
+    riscaricarla; senza token si restituisce la cache scaduta, se esiste.
+    """
+    global _registry
+
+    with _registry_lock:
+        registry = _registry
+        if registry is None:
+            registry = _load_persisted()
+
+        if registry is not None and not force_refresh and registry.age_seconds() <= ttl:
+            _registry = registry
+            return registry
+
+        if access_token is None:
+            if registry is None:
+                raise RuntimeError("Nessun profilo in cache: serve un access token per scaricarli.")
+            _registry = registry
+            return registry
+
+        from auth import get_profiles
+
+        registry = ProfileRegistry(get_profiles(access_token), time.time())
+        _persist(registry)
+        _registry = registry
+        return registry
+
+
+def canonical_marketplace(marketplace: Optional[str]) -> Optional[str]:
+    """
+    ProfileRegistry.canonical_marketplace sul registro in cache, senza
+    chiamate API; senza cache solo maiuscolo (al salvataggio delle regole).
+    """
+    if not marketplace:
+        return marketplace
+    try:
+        registry = load_profile_registry()
+    except RuntimeError:
+        return marketplace.strip().upper()
+    return registry.canonical_marketplace(marketplace)
+
+
+def invalidate_profile_registry() -> None:
+    """Forza il prossimo load_profile_registry a rileggere (o riscaricare)."""
+    global _registry
+
+    from db.database import set_setting
+
+    with _registry_lock:
+        _registry = None
+        set_setting(PROFILE_CACHE_KEY, "")
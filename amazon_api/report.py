@@ -2,13 +2,15 @@
 
 import time
 import json
-import gzip
-from io import BytesIO
 from datetime import date, timedelta
-
-import requests
+from typing import Iterator
 
 from settings import API_BASE_URL, CLIENT_ID
+from .credentials import AccessToken, bearer
+from .metrics_table import MetricsTable, parse_sp_targeting_table
+
+# requests e gzip sono importati nelle funzioni che fanno HTTP: chi usa solo
+# il parsing (scheduler con snapshot recente, benchmark) non li carica.
 
 
 # Intervalli di polling per la generazione del report
@@ -16,12 +18,13 @@ REPORT_POLL_INTERVAL = 5       # secondi
 REPORT_POLL_TIMEOUT = 300      # secondi
 
 
-def _common_headers(access_token: str, profile_id: str) -> dict:
+def _common_headers(access_token: AccessToken, profile_id: str) -> dict:
     """
     Header standard per le chiamate Amazon Ads (reporting v3).
+    access_token può essere un provider: vedi amazon_api.credentials.
     """
     return {
-        "Authorization": f"Bearer {access_token}",
+        "Authorization": bearer(access_token),
         "Amazon-Ads-CustomerId": str(profile_id),
         "Amazon-Ads-ClientId": CLIENT_ID,
         "Content-Type": "application/json",
@@ -30,11 +33,12 @@ def _common_headers(access_token: str, profile_id: str) -> dict:
 
 
 def create_sp_targeting_report(
-    access_token: str,
+    access_token: AccessToken,
     profile_id: str,
     start_date: date,
     end_date: date,
     campaign_ids=None,
+    time_unit: str = "SUMMARY",
 ) -> str:
     """
     Richiede la creazione di un report Targeting Sponsored Products (versione 3).
@@ -53,11 +57,15 @@ def create_sp_targeting_report(
         start_date: data di inizio (date)
         end_date: data di fine (date)
         campaign_ids: lista di campaignId da filtrare (opzionale)
+        time_unit: "SUMMARY" (una riga per target) o "DAILY" (una riga per
+            target e giorno, con colonna "date")
 
     Returns:
         report_id (string)
     """
 
+    import requests
+
     url = f"{API_BASE_URL}/reporting/reports"
 
     headers = _common_headers(access_token, profile_id)
@@ -71,7 +79,7 @@ def create_sp_targeting_report(
     configuration = {
         "adProduct": "SPONSORED_PRODUCTS",
         "reportTypeId": "spTargeting",  # eventualmente "sp_targeting" o simile
-        "timeUnit": "SUMMARY",          # oppure "DAILY" se vuoi righe per giorno
+        "timeUnit": time_unit,          # "SUMMARY" oppure "DAILY" (righe per giorno)
         "format": "GZIP_JSON",
         "columns": [
             "campaignId",
@@ -99,6 +107,9 @@ def create_sp_targeting_report(
             }
         )
 
+    if time_unit == "DAILY":
+        configuration["columns"].insert(0, "date")
+
     if filters:
         configuration["filters"] = filters
 
@@ -124,7 +135,7 @@ def create_sp_targeting_report(
 
 
 def wait_for_report(
-    access_token: str,
+    access_token: AccessToken,
     profile_id: str,
     report_id: str,
     timeout: int = REPORT_POLL_TIMEOUT,
@@ -136,12 +147,15 @@ def wait_for_report(
     Ritorna il JSON di meta-dati del report (contiene 'status' e 'location').
     """
 
+    import requests
+
     url = f"{API_BASE_URL}/reporting/reports/{report_id}"
-    headers = _common_headers(access_token, profile_id)
 
     start_ts = time.time()
 
     while True:
+        # header ricostruiti a ogni polling: l'attesa può superare la vita del token
+        headers = _common_headers(access_token, profile_id)
         resp = requests.get(url, headers=headers)
         print("=== GET REPORT STATUS ===")
         print(resp.status_code, resp.text[:400])
@@ -169,6 +183,19 @@ def download_report_gzip_json(location_url: str) -> list:
 
     Restituisce una lista di dict, uno per riga.
     """
+    return list(iter_report_gzip_json(location_url))
+
+
+def iter_report_gzip_json(location_url: str) -> Iterator[dict]:
+    """
+    Come download_report_gzip_json, ma restituisce le righe una alla volta:
+    non tiene in memoria la lista di tutti i dict del report.
+    """
+
+    import gzip
+    from io import BytesIO
+
+    import requests
 
     resp = requests.get(location_url)
     resp.raise_for_status()
@@ -179,17 +206,15 @@ def download_report_gzip_json(location_url: str) -> list:
     with gzip.GzipFile(fileobj=BytesIO(content)) as gz:
         raw = gz.read().decode("utf-8")
 
-    rows = []
     for line in raw.splitlines():
         line = line.strip()
         if not line:
             continue
-        rows.append(json.loads(line))
-    return rows
+        yield json.loads(line)
 
 
 def get_sp_targeting_metrics(
-    access_token: str,
+    access_token: AccessToken,
     profile_id: str,
     campaign_ids,
     timeframe_days: int,
@@ -202,9 +227,12 @@ def get_sp_targeting_metrics(
     - scarica e parsifica il GZIP JSON
     - restituisce un dict {targetId: metriche}
 
+    Per account grandi preferire get_sp_targeting_metrics_table, che evita
+    il dict per target.
+
     Returns:
         {
-          targetId (int o string): {
+          targetId (string): {
               "impressions": int,
               "clicks": int,
               "cost": float,
@@ -215,6 +243,22 @@ def get_sp_targeting_metrics(
           ...
         }
     """
+    return get_sp_targeting_metrics_table(
+        access_token, profile_id, campaign_ids, timeframe_days
+    ).to_dict()
+
+
+def get_sp_targeting_metrics_table(
+    access_token: AccessToken,
+    profile_id: str,
+    campaign_ids,
+    timeframe_days: int,
+) -> MetricsTable:
+    """
+    Come get_sp_targeting_metrics, ma restituisce una MetricsTable colonnare
+    (array int64/float64 ordinati per targetId), condivisibile con motore
+    regole e UI.
+    """
 
     # Per sicurezza usiamo dati fino a ieri, non includiamo oggi (ritardi attribution)
     end = date.today() - timedelta(days=1)
@@ -233,46 +277,42 @@ def get_sp_targeting_metrics(
     if not location:
         raise RuntimeError(f"Nessuna 'location' nel meta report: {meta}")
 
-    rows = download_report_gzip_json(location)
+    return parse_sp_targeting_table(iter_report_gzip_json(location))
 
-    metrics_by_target = {}
 
-    for row in rows:
-        tid = row.get("targetId")
-        if tid is None:
-            continue
+def iter_sp_targeting_daily_rows(
+    access_token: AccessToken,
+    profile_id: str,
+    campaign_ids,
+    start_date: date,
+    end_date: date,
+) -> Iterator[dict]:
+    """
+    Righe del report SP Targeting con timeUnit DAILY (una per target e
+    giorno, campo "date" in formato AAAA-MM-GG), lette in streaming.
+    """
+    report_id = create_sp_targeting_report(
+        access_token=access_token,
+        profile_id=profile_id,
+        start_date=start_date,
+        end_date=end_date,
+        campaign_ids=campaign_ids,
+        time_unit="DAILY",
+    )
 
-        impressions = int(row.get("impressions", 0) or 0)
-        clicks = int(row.get("clicks", 0) or 0)
-        cost = float(row.get("cost", 0.0) or 0.0)
+    meta = wait_for_report(access_token, profile_id, report_id)
+    location = meta.get("location")
+    if not location:
+        raise RuntimeError(f"Nessuna 'location' nel meta report: {meta}")
 
-        # Nomina ordini tipica: purchases14d (v3) oppure attributedConversions14d (v2)
-        orders = (
-            row.get("purchases14d")
-            or row.get("attributedConversions14d")
-            or 0
-        )
-        orders = int(orders or 0)
+    return iter_report_gzip_json(location)
 
-        # Nomina vendite tipica: sales14d (v3) oppure attributedSales14d (v2)
-        sales = (
-            row.get("sales14d")
-            or row.get("attributedSales14d")
-            or 0.0
-        )
-        sales = float(sales or 0.0)
-
-        acos = None
-        if sales > 0 and cost > 0:
-            acos = (cost / sales) * 100.0
-
-        metrics_by_target[str(tid)] = {
-            "impressions": impressions,
-            "clicks": clicks,
-            "cost": cost,
-            "orders": orders,
-            "sales": sales,
-            "acos": acos,
-        }
 
-    return metrics_by_target
+def parse_sp_targeting_rows(rows: list) -> dict:
+    """
+    Converte le righe del report SP Targeting in {targetId: metriche}.
+
+    Separata da get_sp_targeting_metrics per poterla misurare/testare
+    senza chiamate HTTP (vedi benchmarks/).
+    """
+    return parse_sp_targeting_table(rows).to_dict()
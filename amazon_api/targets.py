@@ -1,8 +1,8 @@
 # amazon_api/targets.py
 
 import json
-import requests
 from settings import API_BASE_URL, CLIENT_ID
+from .credentials import bearer
 
 
 def get_targets_for_campaign(access_token, profile_id, campaign_id):
@@ -15,10 +15,12 @@ def get_targets_for_campaign(access_token, profile_id, campaign_id):
       NON sono garantite qui e vanno prese tramite i REPORT ufficiali di Amazon Ads.
     """
 
+    import requests
+
     url = f"{API_BASE_URL}/adsApi/v1/query/targets"
 
     headers = {
-        "Authorization": f"Bearer {access_token}",
+        "Authorization": bearer(access_token),
         "Amazon-Ads-CustomerId": str(profile_id),
         "Amazon-Ads-ClientId": CLIENT_ID,
         "Amazon-Advertising-API-Scope": str(profile_id),
@@ -80,3 +82,59 @@ def get_targets_for_campaign(access_token, profile_id, campaign_id):
         print(f"- {tid} | type={target_type} | info={info} | kw={kw} | mt={mt} | bid={bid}")
 
     return targets
+
+
+def _targets_headers(access_token, profile_id):
+    return {
+        "Authorization": bearer(access_token),
+        "Amazon-Ads-CustomerId": str(profile_id),
+        "Amazon-Ads-ClientId": CLIENT_ID,
+        "Amazon-Advertising-API-Scope": str(profile_id),
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+    }
+
+
+def iter_target_pages(access_token, profile_id, campaign_ids, max_results=1000):
+    """
+    Come get_targets_for_campaign ma paginato (nextToken) e senza log per
+    target. Restituisce, pagina per pagina, (lista target, byte grezzi della
+    risposta): i byte servono al sync incrementale per confrontare gli hash.
+    """
+    import requests
+
+    url = f"{API_BASE_URL}/adsApi/v1/query/targets"
+    payload = {
+        "adProductFilter": {"include": ["SPONSORED_PRODUCTS"]},
+        "campaignIdFilter": {"include": [str(c) for c in campaign_ids]},
+        "stateFilter": {"include": ["ENABLED", "PAUSED"]},
+        "maxResults": max_results,
+    }
+
+    while True:
+        resp = requests.post(url, headers=_targets_headers(access_token, profile_id), json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+
+        yield data.get("targets", []), resp.content
+
+        next_token = data.get("nextToken")
+        if not next_token:
+            return
+        payload["nextToken"] = next_token
+
+
+def flatten_target(t):
+    """Campi di configurazione del target in forma piatta (formato rules.engine)."""
+    td = t.get("targetDetails") or {}
+    kw = td.get("keywordTarget") or {}
+    return {
+        "target_id": str(t["targetId"]),
+        "campaign_id": str(t["campaignId"]) if t.get("campaignId") else None,
+        "ad_group_id": str(t["adGroupId"]) if t.get("adGroupId") else None,
+        "keyword_text": kw.get("keyword"),
+        "match_type": (kw.get("matchType") or "").lower() or None,
+        "state": t.get("state"),
+        "target_type": t.get("targetType"),
+        "bid": (t.get("bid") or {}).get("bid"),
+    }
@@ -1,21 +1,21 @@
 # amazon_api/update_bids.py
 
-import requests
 import json
 from settings import API_BASE_URL, CLIENT_ID
+from rules.guardrails import DEFAULT_MIN_BID, clamp_bid
+from .credentials import bearer
 
-def update_target_bids(access_token, profile_id, targets, delta):
+# target per singola POST di update: i batch più grandi vanno spezzati
+MAX_TARGETS_PER_REQUEST = 100
 
-    url = f"{API_BASE_URL}/adsApi/v1/update/targets"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Amazon-Ads-CustomerId": str(profile_id),
-        "Amazon-Ads-ClientId": CLIENT_ID,
-        "Amazon-Advertising-API-Scope": str(profile_id),
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
 
+def build_bid_updates(targets, delta, guardrails=None, profile_id=None):
+    """
+    Lista di update {targetId, bid} con il delta applicato.
+
+    Con guardrails (rules.guardrails.GuardrailIndex) il nuovo bid resta nei
+    limiti del target; senza, vale il minimo DEFAULT_MIN_BID (0.02).
+    """
     updates = []
     for t in targets:
         tid = t.get("targetId")
@@ -24,14 +24,49 @@ def update_target_bids(access_token, profile_id, targets, delta):
         if old_bid is None:
             continue
 
-        new_bid = round(old_bid + delta, 2)
-        if new_bid < 0.02:
-            new_bid = 0.02
+        if guardrails is not None:
+            lo, hi = guardrails.bounds(profile_id, t.get("campaignId"), tid, old_bid)
+        else:
+            lo, hi = DEFAULT_MIN_BID, None
+        new_bid = round(clamp_bid(old_bid + delta, lo, hi), 2)
 
         updates.append({
             "targetId": tid,
             "bid": {"bid": new_bid}
         })
+    return updates
+
+
+def update_target_bids(access_token, profile_id, targets, delta, guardrails=None):
+    updates = build_bid_updates(targets, delta, guardrails, profile_id)
+    return post_bid_updates(access_token, profile_id, updates)
+
+
+def set_target_bids(access_token, profile_id, bids):
+    """
+    Imposta bid esatti: bids = {targetId: nuovo_bid}, una sola POST (usato
+    dallo scheduler, al più MAX_TARGETS_PER_REQUEST target per chiamata).
+    """
+    updates = [
+        {"targetId": str(tid), "bid": {"bid": round(float(bid), 2)}}
+        for tid, bid in bids.items()
+    ]
+    return post_bid_updates(access_token, profile_id, updates)
+
+
+def post_bid_updates(access_token, profile_id, updates):
+
+    import requests
+
+    url = f"{API_BASE_URL}/adsApi/v1/update/targets"
+    headers = {
+        "Authorization": bearer(access_token),
+        "Amazon-Ads-CustomerId": str(profile_id),
+        "Amazon-Ads-ClientId": CLIENT_ID,
+        "Amazon-Advertising-API-Scope": str(profile_id),
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
 
     payload = {"targets": updates}
 
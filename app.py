@@ -1,23 +1,36 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
 import streamlit as st
-import pandas as pd
 
 from auth import (
     build_login_url,
     exchange_code_for_tokens,
     ensure_access_token,
-    get_profiles,
     select_profile
 )
 
-from amazon_api.campaigns import get_sp_campaigns
-from amazon_api.targets import get_targets_for_campaign
-from amazon_api.update_bids import update_target_bids
+from amazon_api.update_bids import build_bid_updates, post_bid_updates
+from amazon_api.profiles import invalidate_profile_registry, load_profile_registry
+from db.database import init_db, load_guardrail_index, log_manual_bid_changes
+from db.keyword_table import KeywordTable
+from db.mirror import invalidate_mirror
+from scheduler.sync import load_campaign_targets, load_profile_campaigns
+
+# pandas (~350 ms) si importa nelle funzioni che costruiscono le tabelle:
+# login e profili si aprono senza caricarlo
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 # ==========================================================
 # CONFIGURAZIONE DASHBOARD
 # ==========================================================
 
+# Inizializza DB (idempotente): serve la tabella settings per la cache profili
+init_db()
+
 st.set_page_config(page_title="AgentSP MVP", layout="wide")
 st.sidebar.title("AgentSP ADS Manager MVP")
 
@@ -47,6 +60,68 @@ CURRENCY_MAP = {
     "GBP": "£",
 }
 
+# TTL cache dati (secondi)
+PROFILES_TTL = 3600
+CAMPAIGNS_TTL = 900
+TARGETS_TTL = 300
+
+
+# ==========================================================
+# CACHE DATI AMAZON
+# ==========================================================
+# st.cache_data evita di riscaricare profili/campagne/target a ogni rerun.
+# Il token ha il prefisso "_" perché non faccia parte della chiave: cambia
+# a ogni refresh ma i dati restano gli stessi.
+
+@st.cache_data(ttl=PROFILES_TTL, show_spinner=False)
+def cached_profiles(_access_token: str) -> list[dict]:
+    # registro persistito in settings: sopravvive ai riavvii ed è condiviso con lo scheduler
+    return load_profile_registry(_access_token).profiles
+
+
+@st.cache_data(ttl=CAMPAIGNS_TTL, show_spinner=False)
+def cached_campaigns(_access_token: str, profile_id) -> list[dict]:
+    # mirror SQLite condiviso con lo scheduler: le API solo se è più vecchio del TTL
+    return load_profile_campaigns(_access_token, profile_id, CAMPAIGNS_TTL)
+
+
+@st.cache_data(ttl=TARGETS_TTL, show_spinner=False)
+def cached_campaign_targets(_access_token: str, profile_id, campaign_id) -> list[dict]:
+    return load_campaign_targets(_access_token, profile_id, campaign_id, TARGETS_TTL)
+
+
+@st.cache_data(ttl=TARGETS_TTL, show_spinner=False)
+def cached_targets_dataframe(profile_id, campaign_ids: tuple, _all_targets: list[dict]) -> pd.DataFrame:
+    # chiave: profilo + insieme di campagne; i target arrivano già dalla cache sopra
+    return build_targets_dataframe(_all_targets)
+
+
+@st.cache_resource(ttl=TARGETS_TTL, max_entries=8, show_spinner=False)
+def cached_keyword_table(profile_id, campaign_ids: tuple, _df: pd.DataFrame) -> KeywordTable:
+    # cache_resource: la stessa istanza SQLite è condivisa, senza copie per rerun
+    return KeywordTable(_df.columns, _df.itertuples(index=False, name=None))
+
+
+def invalidate_targets_cache() -> None:
+    """Da chiamare dopo ogni scrittura dei bid: i target in cache non sono più validi."""
+    cached_campaign_targets.clear()
+    cached_targets_dataframe.clear()
+    cached_keyword_table.clear()
+
+
+def invalidate_cache() -> None:
+    invalidate_profile_registry()
+    if "profile" in st.session_state:
+        invalidate_mirror(st.session_state["profile"]["profileId"])
+    cached_profiles.clear()
+    cached_campaigns.clear()
+    invalidate_targets_cache()
+
+
+if st.sidebar.button("Aggiorna dati Amazon", use_container_width=True):
+    invalidate_cache()
+    st.sidebar.success("Cache svuotata.")
+
 
 # ==========================================================
 # 1) LOGIN AMAZON (OAuth diretto in Streamlit)
@@ -99,7 +174,7 @@ def render_profile_page():
         return
 
     try:
-        profiles = get_profiles(access_token)
+        profiles = cached_profiles(access_token)
     except Exception as e:
         st.error(f"Errore nel recupero dei profili: {e}")
         return
@@ -181,22 +256,38 @@ def render_profile_page():
 # 3) CAMPAGNE
 # ==========================================================
 
+CAMPAIGN_COLUMNS = ["Campaign ID", "Nome campagna", "ASIN"]
+
+
 def build_campaign_dataframe(campaigns: list[dict]) -> pd.DataFrame:
-    rows = []
-    for c in campaigns:
-        asin = (
+    import pandas as pd
+
+    # una sola passata: tuple grezze, poi DataFrame colonnare
+    records = [
+        (
+            c.get("campaignId"),
+            c.get("name"),
             c.get("asin")
-            or (c.get("tags", {}) or {}).get("ASIN")
-            or (c.get("attributes", {}) or {}).get("asin")
-        )
-        rows.append(
-            {
-                "Campaign ID": c.get("campaignId"),
-                "Nome campagna": c.get("name"),
-                "ASIN": asin,
-            }
+            or (c.get("tags") or {}).get("ASIN")
+            or (c.get("attributes") or {}).get("asin"),
         )
-    return pd.DataFrame(rows)
+        for c in campaigns
+    ]
+    return pd.DataFrame.from_records(records, columns=CAMPAIGN_COLUMNS)
+
+
+def build_campaign_labels(df: pd.DataFrame) -> dict:
+    """{etichetta multiselect: Campaign ID}, costruito con operazioni di colonna."""
+    asin = df["ASIN"].fillna("").astype(str).replace("", "no ASIN")
+    labels = (
+        df["Campaign ID"].astype(str)
+        + " – "
+        + df["Nome campagna"].astype(str)
+        + " ("
+        + asin
+        + ")"
+    )
+    return dict(zip(labels.tolist(), df["Campaign ID"].tolist()))
 
 
 def render_campaign_page():
@@ -215,7 +306,7 @@ def render_campaign_page():
     profile_id = st.session_state["profile"]["profileId"]
 
     try:
-        campaigns = get_sp_campaigns(access_token, profile_id)
+        campaigns = cached_campaigns(access_token, profile_id)
     except Exception as e:
         st.error(f"Errore recupero campagne: {e}")
         return
@@ -233,12 +324,8 @@ def render_campaign_page():
 
     st.subheader("Seleziona campagne")
 
-    labels = [
-        f"{row['Campaign ID']} – {row['Nome campagna']} ({row['ASIN'] or 'no ASIN'})"
-        for _, row in df.iterrows()
-    ]
-
-    ids = df["Campaign ID"].tolist()
+    label_to_id = build_campaign_labels(df)
+    labels = list(label_to_id)
 
     selected = st.multiselect(
         "Campagne da includere",
@@ -246,7 +333,7 @@ def render_campaign_page():
         default=labels,
     )
 
-    selected_ids = [ids[labels.index(lbl)] for lbl in selected]
+    selected_ids = [label_to_id[lbl] for lbl in selected]
     st.session_state["selected_campaigns"] = selected_ids
 
     if selected_ids:
@@ -259,53 +346,87 @@ def render_campaign_page():
 # 4) KEYWORD / TARGETS
 # ==========================================================
 
-def build_targets_dataframe(all_targets: list[dict]) -> pd.DataFrame:
-    rows = []
-    for t in all_targets:
-
-        td = t.get("targetDetails", {}) or {}
+TARGET_COLUMNS = [
+    "CAMPAIGN_ID",
+    "TARGET_ID",
+    "TARGET",
+    "MATCH_TYPE",
+    "BID",
+    "IMPRESSIONS",
+    "CLICKS",
+    "CPC",
+    "ORDINI",
+    "ACOS",
+]
+
+# campi grezzi estratti per ogni target, nell'ordine delle tuple sotto
+_RAW_TARGET_FIELDS = [
+    "CAMPAIGN_ID",
+    "TARGET_ID",
+    "TARGET",
+    "MATCH_TYPE",
+    "BID",
+    "IMPRESSIONS",
+    "CLICKS",
+    "cost",
+    "orders",
+    "purchases",
+    "attributedConversions14d",
+    "ACOS",
+]
+
+
+def _target_record(t: dict) -> tuple:
+    kw_data = (t.get("targetDetails") or {}).get("keywordTarget") or {}
+    return (
+        t.get("campaignId"),
+        t.get("targetId"),
+        kw_data.get("keyword"),
+        kw_data.get("matchType"),
+        (t.get("bid") or {}).get("bid"),
+        t.get("impressions"),
+        t.get("clicks"),
+        t.get("cost"),
+        t.get("orders"),
+        t.get("purchases"),
+        t.get("attributedConversions14d"),
+        t.get("acos"),
+    )
 
-        # Keyword target
-        kw_data = td.get("keywordTarget") or {}
-        kws = kw_data.get("keyword")
-        match_type = kw_data.get("matchType")
 
-        # Bid
-        bid_obj = t.get("bid") or {}
-        bid = bid_obj.get("bid")
+def build_targets_dataframe(all_targets: list[dict]) -> pd.DataFrame:
+    """
+    Una sola passata sui target (tuple di valori grezzi), poi CPC e ordini
+    calcolati come operazioni di colonna, con la stessa semantica della
+    versione riga per riga: ORDINI = orders or purchases or
+    attributedConversions14d (0 e mancante passano al successivo), ACOS
+    quello del target così com'è.
+    """
+    import pandas as pd
+
+    raw = pd.DataFrame.from_records(
+        [_target_record(t) for t in all_targets],
+        columns=_RAW_TARGET_FIELDS,
+    )
 
-        impressions = t.get("impressions")
-        clicks = t.get("clicks")
-        cost = t.get("cost")
+    numeric = ["BID", "IMPRESSIONS", "CLICKS", "cost", "orders", "purchases",
+               "attributedConversions14d", "ACOS"]
+    raw[numeric] = raw[numeric].apply(pd.to_numeric, errors="coerce")
 
-        cpc = None
-        if clicks and cost and clicks > 0:
-            cpc = cost / clicks
+    clicks = raw["CLICKS"]
+    cost = raw["cost"]
 
-        orders = (
-            t.get("orders")
-            or t.get("purchases")
-            or t.get("attributedConversions14d")
-        )
+    raw["CPC"] = (cost / clicks).where((clicks > 0) & (cost != 0))
 
-        acos = t.get("acos")
-
-        rows.append(
-            {
-                "CAMPAIGN_ID": t.get("campaignId"),
-                "TARGET_ID": t.get("targetId"),
-                "TARGET": kws,
-                "MATCH_TYPE": match_type,
-                "BID": bid,
-                "IMPRESSIONS": impressions,
-                "CLICKS": clicks,
-                "CPC": cpc,
-                "ORDINI": orders,
-                "ACOS": acos,
-            }
-        )
+    # catena di "or": un valore falsy (0 o mancante) passa al successivo,
+    # l'ultimo resta com'è
+    orders = raw["attributedConversions14d"]
+    for column in ("purchases", "orders"):
+        value = raw[column]
+        orders = value.where(value.notna() & (value != 0), orders)
+    raw["ORDINI"] = orders
 
-    return pd.DataFrame(rows)
+    return raw[TARGET_COLUMNS]
 
 
 def render_keyword_page():
@@ -331,7 +452,7 @@ def render_keyword_page():
     all_targets = []
     for cid in selected_campaigns:
         try:
-            t = get_targets_for_campaign(access_token, profile_id, cid)
+            t = cached_campaign_targets(access_token, profile_id, cid)
             all_targets.extend(t)
         except Exception as e:
             st.error(f"Errore campagna {cid}: {e}")
@@ -343,15 +464,94 @@ def render_keyword_page():
     st.session_state["targets"] = all_targets
     st.success(f"Trovati {len(all_targets)} targets totali.")
 
-    df = build_targets_dataframe(all_targets)
+    campaign_key = tuple(sorted(str(c) for c in selected_campaigns))
+    df = cached_targets_dataframe(profile_id, campaign_key, all_targets)
+    table = cached_keyword_table(profile_id, campaign_key, df)
 
-    st.dataframe(df, use_container_width=True)
+    render_keyword_table(table, campaign_key)
+
+
+def render_keyword_table(table: KeywordTable, campaign_ids: tuple) -> None:
+    """Filtri/ordinamento/paginazione eseguiti in SQL: al browser va solo la pagina."""
+    import pandas as pd
+
+    with st.expander("Filtri e ordinamento", expanded=True):
+        c1, c2, c3, c4 = st.columns(4)
+        with c1:
+            f_campaigns = st.multiselect("Campagne", options=list(campaign_ids), key="kw_campaigns")
+            f_match = st.multiselect(
+                "Match type", options=table.distinct("MATCH_TYPE"), key="kw_match"
+            )
+        with c2:
+            acos_min = st.number_input("ACOS min (%)", value=None, min_value=0.0, step=1.0, key="kw_acos_min")
+            acos_max = st.number_input("ACOS max (%)", value=None, min_value=0.0, step=1.0, key="kw_acos_max")
+        with c3:
+            clicks_min = st.number_input("Click min", value=None, min_value=0, step=1, key="kw_clicks_min")
+            clicks_max = st.number_input("Click max", value=None, min_value=0, step=1, key="kw_clicks_max")
+        with c4:
+            sort_by = st.selectbox("Ordina per", options=["-"] + table.columns, key="kw_sort")
+            descending = st.checkbox("Decrescente", key="kw_desc")
+            page_size = st.selectbox("Righe per pagina", options=[100, 200, 500], index=1, key="kw_page_size")
+
+    filters = dict(
+        campaign_ids=f_campaigns,
+        match_types=f_match,
+        acos_min=acos_min,
+        acos_max=acos_max,
+        clicks_min=clicks_min,
+        clicks_max=clicks_max,
+        sort_by=None if sort_by == "-" else sort_by,
+        descending=descending,
+        page_size=page_size,
+    )
+
+    page = int(st.session_state.get("kw_page", 1))
+    rows, total = table.query(page=page - 1, **filters)
+
+    n_pages = max(1, -(-total // page_size))
+    if page > n_pages:
+        # i filtri hanno ridotto le righe: torna all'ultima pagina valida
+        page = n_pages
+        st.session_state["kw_page"] = page
+        rows, total = table.query(page=page - 1, **filters)
+
+    first = (page - 1) * page_size + 1 if total else 0
+    last = min(page * page_size, total)
+    st.caption(f"Righe {first}–{last} di {total} filtrate ({len(table)} target totali)")
+
+    st.dataframe(
+        pd.DataFrame.from_records(rows, columns=table.columns),
+        use_container_width=True,
+        hide_index=True,
+    )
+    st.number_input("Pagina", min_value=1, max_value=n_pages, step=1, key="kw_page")
 
 
 # ==========================================================
 # 5) MODIFICA BID
 # ==========================================================
 
+def _manual_changes(profile_id, targets: list[dict], updates: list[dict]) -> list[dict]:
+    """Modifiche inviate da render_bid_page nel formato di log_manual_bid_changes."""
+    by_id = {str(t.get("targetId")): t for t in targets}
+    changes = []
+    for u in updates:
+        t = by_id.get(str(u["targetId"]))
+        if t is None:
+            continue
+        kw_data = (t.get("targetDetails") or {}).get("keywordTarget") or {}
+        changes.append({
+            "target_id": u["targetId"],
+            "profile_id": profile_id,
+            "campaign_id": t.get("campaignId"),
+            "keyword_text": kw_data.get("keyword"),
+            "match_type": kw_data.get("matchType"),
+            "old_bid": (t.get("bid") or {}).get("bid"),
+            "new_bid": u["bid"]["bid"],
+        })
+    return changes
+
+
 def render_bid_page():
     st.title("Modifica manuale Bid")
 
@@ -374,8 +574,17 @@ def render_bid_page():
 
     if st.button("Applica"):
         try:
-            result = update_target_bids(access_token, profile_id, targets, delta)
-            st.success("Bid aggiornati.")
+            # stessi limiti dello scheduler (bid min/max, variazione giornaliera)
+            updates = build_bid_updates(targets, delta, load_guardrail_index(), profile_id)
+            result = post_bid_updates(access_token, profile_id, updates)
+            # nel log come le modifiche delle regole: conta per bid di inizio
+            # giornata, cooldown e isteresi
+            log_manual_bid_changes(_manual_changes(profile_id, targets, updates))
+            invalidate_mirror(profile_id, {t.get("campaignId") for t in targets if t.get("campaignId")})
+            invalidate_targets_cache()
+            # i bid in sessione sono ormai vecchi: vanno ricaricati dalla pagina Keyword
+            st.session_state.pop("targets", None)
+            st.success("Bid aggiornati. Ricarica la pagina Keyword per vedere i nuovi valori.")
             st.json(result)
         except Exception as e:
             st.error(f"Errore update bid: {e}")
@@ -1,8 +1,9 @@
 # auth.py
 
 import json
+import os
+import threading
 import time
-import requests
 from urllib.parse import urlencode
 
 from settings import (
@@ -12,18 +13,36 @@ from settings import (
     TOKEN_URL,
     LWA_AUTHORIZE_URL,
     SCOPE,
+    require_credentials,
 )
 
 TOKEN_FILE = "tokens.json"
 
+# Margine prima della scadenza entro cui il token va rinnovato (secondi)
+TOKEN_REFRESH_MARGIN = 60
+
+# Cache in memoria dell'ultimo tokens.json valido: ensure_access_token non
+# rilegge il file a ogni chiamata. Il lock serializza i refresh (un solo
+# refresh alla volta, gli altri thread aspettano e usano il suo risultato).
+_token_cache: dict | None = None
+_token_lock = threading.Lock()
+
 
 # ==========================================================
 # SALVATAGGIO / CARICAMENTO TOKEN
 # ==========================================================
 
 def save_tokens(data: dict) -> None:
-    with open(TOKEN_FILE, "w", encoding="utf-8") as f:
+    """Scrittura atomica (file temporaneo + os.replace) e aggiornamento cache."""
+    global _token_cache
+
+    tmp = f"{TOKEN_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, TOKEN_FILE)
+    _token_cache = data
 
 
 def load_tokens() -> dict | None:
@@ -34,11 +53,22 @@ def load_tokens() -> dict | None:
         return None
 
 
+def clear_token_cache() -> None:
+    """Dimentica i token in memoria: la prossima richiesta rilegge il file."""
+    global _token_cache
+    _token_cache = None
+
+
+def _is_fresh(tokens: dict | None) -> bool:
+    return bool(tokens) and time.time() < tokens["expires_at"] - TOKEN_REFRESH_MARGIN
+
+
 # ==========================================================
 # URL DI LOGIN (per app.py)
 # ==========================================================
 
 def build_login_url() -> str:
+    require_credentials()
     params = {
         "client_id": CLIENT_ID,
         "scope": SCOPE,
@@ -53,6 +83,9 @@ def build_login_url() -> str:
 # ==========================================================
 
 def exchange_code_for_tokens(code: str) -> dict:
+    import requests  # import pigro: ~75 ms, serve solo quando si parla con LWA
+
+    require_credentials()
     payload = {
         "grant_type": "authorization_code",
         "code": code,
@@ -79,6 +112,9 @@ def exchange_code_for_tokens(code: str) -> dict:
 # ==========================================================
 
 def refresh_access_token(refresh_token: str) -> dict:
+    import requests
+
+    require_credentials()
     payload = {
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
@@ -105,30 +141,130 @@ def refresh_access_token(refresh_token: str) -> dict:
 # ==========================================================
 
 def ensure_access_token() -> str:
-    tokens = load_tokens()
-
-    if not tokens:
-        raise RuntimeError("Nessun token presente. Effettua il login Amazon Ads dalla UI.")
+    global _token_cache
 
-    # ancora valido
-    if time.time() < tokens["expires_at"] - 60:
+    # percorso veloce: token in memoria ancora valido, nessun I/O né lock
+    tokens = _token_cache
+    if _is_fresh(tokens):
         return tokens["access_token"]
 
-    # scaduto → refresh
-    refreshed = refresh_access_token(tokens["refresh_token"])
-    return refreshed["access_token"]
+    with _token_lock:
+        # un altro thread può aver già fatto il refresh mentre aspettavamo
+        tokens = _token_cache
+        if _is_fresh(tokens):
+            return tokens["access_token"]
+
+        # ... oppure un altro processo (scheduler / app) ha aggiornato il file
+        tokens = load_tokens()
+        if not tokens:
+            raise RuntimeError("Nessun token presente. Effettua il login Amazon Ads dalla UI.")
+
+        if _is_fresh(tokens):
+            _token_cache = tokens
+            return tokens["access_token"]
+
+        # scaduto → refresh (uno solo, gli altri thread sono in attesa sul lock)
+        refreshed = refresh_access_token(tokens["refresh_token"])
+        return refreshed["access_token"]
+
+
+# ==========================================================
+# REFRESH PROATTIVO IN BACKGROUND
+# ==========================================================
+
+# Per i job lunghi il token si rinnova con questo anticipo sulla scadenza
+TOKEN_PROACTIVE_LEAD = 600
+TOKEN_CHECK_INTERVAL = 30
+
+
+def refresh_if_expiring(lead_seconds: float = TOKEN_PROACTIVE_LEAD) -> bool:
+    """
+    Rinnova il token se scade entro lead_seconds. True se ha fatto il refresh.
+    Usa lo stesso lock di ensure_access_token: mai due refresh insieme.
+    """
+    global _token_cache
+
+    with _token_lock:
+        tokens = _token_cache
+        if tokens and time.time() < tokens["expires_at"] - lead_seconds:
+            return False
+
+        tokens = load_tokens()
+        if not tokens:
+            return False
+        if time.time() < tokens["expires_at"] - lead_seconds:
+            _token_cache = tokens
+            return False
+
+        refresh_access_token(tokens["refresh_token"])
+        return True
+
+
+class TokenRefresher:
+    """
+    Thread daemon che tiene il token valido mentre scheduler o job massivi
+    sono in esecuzione. Uso:
+
+        with TokenRefresher():
+            ...job lungo che passa ensure_access_token come provider...
+    """
+
+    def __init__(
+        self,
+        lead_seconds: float = TOKEN_PROACTIVE_LEAD,
+        check_interval: float = TOKEN_CHECK_INTERVAL,
+    ):
+        self.lead_seconds = lead_seconds
+        self.check_interval = check_interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> "TokenRefresher":
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="token-refresher", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "TokenRefresher":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                refresh_if_expiring(self.lead_seconds)
+            except Exception as exc:
+                # si riprova al prossimo giro; ensure_access_token resta il fallback
+                print("[AUTH] Refresh token in background fallito:", exc)
+            if self._stop.wait(self.check_interval):
+                return
 
 
 # ==========================================================
 # PROFILI AMAZON
 # ==========================================================
 
-def get_profiles(access_token: str) -> list[dict]:
+def get_profiles(access_token) -> list[dict]:
+    import requests
     from settings import API_BASE_URL  # import locale per evitare cicli
+    from amazon_api.credentials import bearer
+
+    require_credentials()
 
     url = f"{API_BASE_URL}/v2/profiles"
     headers = {
-        "Authorization": f"Bearer {access_token}",
+        "Authorization": bearer(access_token),
         "Amazon-Advertising-API-ClientId": CLIENT_ID,
     }
 
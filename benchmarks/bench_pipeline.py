@@ -0,0 +1,491 @@
+# benchmarks/bench_pipeline.py
+
+"""
+Benchmark della pipeline fetch → evaluate → log → update.
+
+Misura, per ogni scenario (numero di target) e numero di regole:
+    - apply_rule_to_target / apply_rules_to_target
+    - simulate_rules (valutazione in blocco del dry-run), anche con limiti bid
+    - parse_sp_targeting_rows / parse_sp_targeting_table (parsing report)
+    - log_rule_execution / log_rule_run (scritture su un DB SQLite temporaneo)
+    - get_due_rules
+    - build_bid_updates (payload di update_target_bids)
+    - fetch HTTP contro il mock locale (solo con --with-mock)
+    - tempo di avvio (scenario "startup"): import dei moduli d'ingresso e run
+      cron dello scheduler senza regole dovute, in un processo Python nuovo
+
+Le fasi più lente vengono misurate su un campione (--sample, --max-evals,
+--max-log-writes) e proiettate linearmente sulla dimensione dello scenario:
+nel JSON restano sia i numeri misurati sia quelli proiettati.
+
+Uso:
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --scenarios 1k,100k --rules 10,500
+    python -m benchmarks.bench_pipeline --output new.json --compare old.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from mock_api.accounts import AccountConfig, SyntheticAccount
+
+SCENARIOS = {
+    "1k": 1_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+}
+RULE_COUNTS = [10, 100, 500]
+
+DEFAULT_OUTPUT = "bench_results.json"
+TARGETS_PER_CAMPAIGN = 1000
+
+ROOT = Path(__file__).resolve().parent.parent
+# moduli d'ingresso di cron e CLI (app.py no: all'import esegue la pagina)
+STARTUP_MODULES = [
+    "scheduler.runner",
+    "scheduler.export",
+    "scheduler.simulation",
+    "auth",
+    "amazon_api.report",
+    "amazon_api.update_bids",
+]
+# obiettivo per "python -m scheduler.runner" lanciato da cron
+STARTUP_BUDGET_MS = 100
+
+
+def _prepare_env() -> None:
+    """auth controlla le credenziali (settings.require_credentials): valori fittizi, il benchmark non va in rete."""
+    os.environ.setdefault("AMAZON_ADS_CLIENT_ID", "bench-client")
+    os.environ.setdefault("AMAZON_ADS_CLIENT_SECRET", "bench-secret")
+    os.environ.setdefault("AMAZON_ADS_REDIRECT_URI", "http://localhost/bench")
+
+
+# ------------------------
+# Dati sintetici
+# ------------------------
+
+def make_account(n_targets: int) -> SyntheticAccount:
+    per_campaign = min(n_targets, TARGETS_PER_CAMPAIGN)
+    return SyntheticAccount(
+        AccountConfig(
+            marketplaces=["US"],
+            campaigns_per_profile=math.ceil(n_targets / per_campaign),
+            targets_per_campaign=per_campaign,
+        )
+    )
+
+
+def positions(account: SyntheticAccount, limit: int) -> List[Tuple[int, int]]:
+    out = []
+    for pos in account.iter_target_positions(0):
+        if len(out) >= limit:
+            break
+        out.append(pos)
+    return out
+
+
+def engine_target(account: SyntheticAccount, camp_idx: int, idx: int) -> Dict[str, Any]:
+    """Target nel formato atteso da rules.engine (vedi fetch_targets_for_rule)."""
+    t = account.target(0, camp_idx, idx)
+    row = account.report_row(0, camp_idx, idx, 14)
+    kw = (t["targetDetails"].get("keywordTarget") or {})
+    acos = None
+    if row["sales14d"] > 0 and row["cost"] > 0:
+        acos = row["cost"] / row["sales14d"] * 100.0
+    return {
+        "target_id": t["targetId"],
+        "campaign_id": t["campaignId"],
+        "keyword_text": kw.get("keyword"),
+        "match_type": (kw.get("matchType") or "").lower() or None,
+        "marketplace": "US",
+        "bid": t["bid"]["bid"],
+        "acos": acos,
+        "clicks": row["clicks"],
+        "impressions": row["impressions"],
+    }
+
+
+def make_rules(n: int) -> List[Dict[str, Any]]:
+    rules = []
+    for i in range(n):
+        rule: Dict[str, Any] = {
+            "id": i + 1,
+            "name": f"bench {i + 1}",
+            "campaign_id": None,
+            "marketplace": "US",
+            "match_type": "exact" if i % 3 == 0 else None,
+            "acos_min": None,
+            "acos_max": None,
+            "clicks_min": None,
+            "clicks_max": None,
+            "timeframe_days": 14,
+            "frequency_days": 3 + i % 5,
+            "enabled": 1,
+        }
+        if i % 2 == 0:
+            low = float((i * 7) % 60)
+            rule.update(
+                rule_type="ACOS_BAND",
+                acos_min=low,
+                acos_max=low + 15,
+                adjustment_type="ABS",
+                adjustment_value=0.05 if low < 30 else -0.05,
+            )
+        else:
+            rule.update(
+                rule_type="LOW_TRAFFIC",
+                clicks_min=0,
+                clicks_max=5 + i % 20,
+                adjustment_type="PCT",
+                adjustment_value=5,
+            )
+        rules.append(rule)
+    return rules
+
+
+# ------------------------
+# Misure
+# ------------------------
+
+def timed(fn: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def record(
+    results: List[Dict[str, Any]],
+    scenario: str,
+    n_targets: int,
+    n_rules: Optional[int],
+    stage: str,
+    items: int,
+    measured_items: int,
+    seconds: float,
+) -> None:
+    per_item = seconds / measured_items if measured_items else 0.0
+    entry = {
+        "scenario": scenario,
+        "targets": n_targets,
+        "rules": n_rules,
+        "stage": stage,
+        "items": items,
+        "measured_items": measured_items,
+        "seconds": round(seconds, 6),
+        "per_item_us": round(per_item * 1e6, 3),
+        "projected_seconds": round(per_item * items, 6),
+    }
+    results.append(entry)
+    rules_str = f"{n_rules:>4} regole" if n_rules is not None else " " * 11
+    print(
+        f"  {stage:<30} {rules_str}  {measured_items:>9}/{items:<10} "
+        f"{entry['per_item_us']:>10.3f} us/item  ~{entry['projected_seconds']:.3f}s"
+    )
+
+
+@contextlib.contextmanager
+def temp_database():
+    """Punta db.database a un file SQLite temporaneo (non tocca ads_rules.db)."""
+    from db import database
+
+    old_path = database.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = Path(tmp) / "bench.db"
+        database.init_db()
+        try:
+            yield database
+        finally:
+            database.DB_PATH = old_path
+
+
+def bench_engine(results, scenario, n, rule_counts, args, account, sample_pos) -> None:
+    from rules.batch import TargetColumns, simulate_rules
+    from rules.engine import apply_rule_to_target, apply_rules_to_target
+    from rules.guardrails import GuardrailIndex
+
+    targets = [engine_target(account, c, i) for c, i in sample_pos]
+    single = make_rules(1)[0]
+
+    secs = timed(lambda: [apply_rule_to_target(t, single) for t in targets], args.repeat)
+    record(results, scenario, n, 1, "apply_rule_to_target", n, len(targets), secs)
+
+    for r in rule_counts:
+        rules = make_rules(r)
+        k = max(1, min(len(targets), args.max_evals // r))
+        subset = targets[:k]
+        secs = timed(lambda: [apply_rules_to_target(t, rules) for t in subset], args.repeat)
+        record(results, scenario, n, r, "apply_rules_to_target", n * r, k * r, secs)
+
+        cols = TargetColumns.from_rows(subset)
+        secs = timed(lambda: simulate_rules(cols, rules), args.repeat)
+        record(results, scenario, n, r, "simulate_rules", n * r, k * r, secs)
+
+        # limiti per campagna + variazione giornaliera, indice costruito a ogni run
+        guard_rows = [
+            {"scope": "CAMPAIGN", "scope_id": c, "min_bid": 0.1, "max_bid": 3.0, "max_change_pct": 20}
+            for c in set(cols.campaign_id)
+        ]
+        secs = timed(
+            lambda: simulate_rules(cols, rules, guardrails=GuardrailIndex(guard_rows)),
+            args.repeat,
+        )
+        record(results, scenario, n, r, "simulate_rules_guardrails", n * r, k * r, secs)
+
+
+def bench_parse(results, scenario, n, args, account, sample_pos) -> None:
+    from amazon_api.report import parse_sp_targeting_rows
+    from amazon_api.metrics_table import parse_sp_targeting_table
+
+    rows = [account.report_row(0, c, i, 14) for c, i in sample_pos]
+    secs = timed(lambda: parse_sp_targeting_rows(rows), args.repeat)
+    record(results, scenario, n, None, "parse_sp_targeting_rows", n, len(rows), secs)
+
+    secs = timed(lambda: parse_sp_targeting_table(rows), args.repeat)
+    record(results, scenario, n, None, "parse_sp_targeting_table", n, len(rows), secs)
+
+
+def bench_payload(results, scenario, n, args, account, sample_pos) -> None:
+    from amazon_api.update_bids import build_bid_updates
+
+    api_targets = [account.target(0, c, i) for c, i in sample_pos]
+    secs = timed(lambda: build_bid_updates(api_targets, 0.05), args.repeat)
+    record(results, scenario, n, None, "build_bid_updates", n, len(api_targets), secs)
+
+
+def bench_db(results, scenario, n, rule_counts, args, account, sample_pos) -> None:
+    with temp_database() as database:
+        k = min(len(sample_pos), args.max_log_writes)
+        targets = [engine_target(account, c, i) for c, i in sample_pos[:k]]
+        run_at = datetime.utcnow()
+
+        def write_logs() -> None:
+            for t in targets:
+                database.log_rule_execution(
+                    rule_id=1,
+                    run_at=run_at,
+                    target=t,
+                    old_bid=t["bid"],
+                    new_bid=t["bid"],
+                    action="NO_ACTION",
+                )
+
+        secs = timed(write_logs, 1)
+        record(results, scenario, n, 1, "log_rule_execution", n, len(targets), secs)
+
+        # log dello scheduler: un run di regola, 5% dei target modificati
+        entries = [
+            (t, t["bid"], t["bid"] + 0.05, "INCREASE", "") if i % 20 == 0
+            else (t, t["bid"], t["bid"], "SKIP_CONDITION", "")
+            for i, t in enumerate(targets)
+        ]
+        secs = timed(lambda: database.log_rule_run(1, run_at, entries), args.repeat)
+        record(results, scenario, n, 1, "log_rule_run_compact", n, len(targets), secs)
+        secs = timed(lambda: database.log_rule_run(1, run_at, entries, full=True), args.repeat)
+        record(results, scenario, n, 1, "log_rule_run_full", n, len(targets), secs)
+
+    for r in rule_counts:
+        with temp_database() as database:
+            now = datetime.utcnow()
+            for rule in make_rules(r):
+                rule_id = database.create_rule(rule)
+                # metà delle regole già eseguite di recente (non "due")
+                if rule_id % 2 == 0:
+                    database.update_rule_last_run(rule_id, now - timedelta(days=1))
+
+            calls = 20
+            secs = timed(lambda: [database.get_due_rules(now) for _ in range(calls)], args.repeat)
+            record(results, scenario, n, r, "get_due_rules", r, r, secs / calls)
+
+
+def bench_fetch(results, scenario, n, args) -> None:
+    """Fetch HTTP reale (targets + report) contro il mock in-process."""
+    from mock_api.server import MockAdsServer, ServerBehaviour
+
+    per_campaign = min(n, TARGETS_PER_CAMPAIGN)
+    config = AccountConfig(
+        campaigns_per_profile=math.ceil(n / per_campaign),
+        targets_per_campaign=per_campaign,
+    )
+    server = MockAdsServer(
+        config,
+        ServerBehaviour(latency_ms=args.mock_latency_ms, report_delay=0.0),
+        port=0,
+    ).start()
+
+    try:
+        import settings
+        from amazon_api import report, targets as targets_api
+
+        # i moduli amazon_api leggono API_BASE_URL all'import: lo sovrascriviamo qui
+        for mod in (settings, report, targets_api):
+            mod.API_BASE_URL = server.url
+        report.REPORT_POLL_INTERVAL = 0.05
+
+        profile_id = server.state.account.profiles()[0]["profileId"]
+        n_camps = min(config.campaigns_per_profile, args.mock_campaigns)
+        camp_ids = [server.state.account.campaign_id(0, c) for c in range(n_camps)]
+        fetched = n_camps * per_campaign
+
+        def fetch_targets() -> None:
+            for cid in camp_ids:
+                targets_api.get_targets_for_campaign("bench-token", profile_id, cid)
+
+        def fetch_metrics() -> None:
+            report.get_sp_targeting_metrics("bench-token", profile_id, camp_ids, 14)
+
+        # i client stampano ogni risposta: la silenziamo per non falsare i tempi
+        with contextlib.redirect_stdout(io.StringIO()):
+            secs_t = timed(fetch_targets, 1)
+            secs_m = timed(fetch_metrics, 1)
+
+        record(results, scenario, n, None, "fetch_targets_http", n, fetched, secs_t)
+        record(results, scenario, n, None, "fetch_metrics_http", n, fetched, secs_m)
+    finally:
+        server.stop()
+
+
+def _startup_seconds(code: str, repeat: int) -> float:
+    """Tempo (migliore di repeat) di un processo python -c code, senza credenziali nell'ambiente."""
+    import subprocess
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith("AMAZON_ADS_")}
+    cmd = [sys.executable, "-c", code]
+    return timed(
+        lambda: subprocess.run(cmd, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL),
+        repeat,
+    )
+
+
+def bench_startup(results, args) -> None:
+    """Import dei moduli d'ingresso e run cron senza regole dovute, in processi nuovi."""
+    print("\n=== AVVIO (processo nuovo) ===")
+    repeat = max(args.repeat, 5)
+    base = _startup_seconds("pass", repeat)
+    record(results, "startup", 0, None, "python_bare", 1, 1, base)
+    for module in STARTUP_MODULES:
+        secs = _startup_seconds(f"import {module}", repeat)
+        record(results, "startup", 0, None, f"import:{module}", 1, 1, secs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        code = (
+            "from pathlib import Path\n"
+            "from db import database\n"
+            f"database.DB_PATH = Path({str(Path(tmp) / 'startup.db')!r})\n"
+            "from scheduler.runner import run_once_for_due_rules\n"
+            "run_once_for_due_rules()\n"
+        )
+        secs = _startup_seconds(code, repeat)
+    record(results, "startup", 0, None, "cron_run_no_due_rules", 1, 1, secs)
+    if secs * 1000 > STARTUP_BUDGET_MS:
+        print(f"  ATTENZIONE: run cron {secs * 1000:.0f} ms, obiettivo {STARTUP_BUDGET_MS} ms")
+
+
+# ------------------------
+# Confronto
+# ------------------------
+
+def result_key(entry: Dict[str, Any]) -> Tuple[str, Optional[int], str]:
+    return entry["scenario"], entry["rules"], entry["stage"]
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, threshold: float) -> bool:
+    """Stampa il confronto con un JSON precedente. False se c'è una regressione oltre soglia."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result_key(e): e for e in json.load(f)["results"]}
+
+    ok = True
+    print(f"\n=== CONFRONTO CON {baseline_path} ===")
+    for entry in results:
+        old = baseline.get(result_key(entry))
+        if not old or not old["per_item_us"]:
+            continue
+        ratio = entry["per_item_us"] / old["per_item_us"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- PEGGIORATO"
+            ok = False
+        elif ratio < 1 / threshold:
+            flag = "  (migliorato)"
+        rules_str = entry["rules"] if entry["rules"] is not None else "-"
+        print(
+            f"  {entry['scenario']:>5} {str(rules_str):>4} {entry['stage']:<30} "
+            f"{old['per_item_us']:>10.3f} -> {entry['per_item_us']:>10.3f} us  x{ratio:.2f}{flag}"
+        )
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark pipeline AgentSP")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="es. 1k,100k,1m")
+    parser.add_argument("--rules", default=",".join(str(r) for r in RULE_COUNTS))
+    parser.add_argument("--sample", type=int, default=100_000, help="target max misurati per scenario (0 = tutti)")
+    parser.add_argument("--max-evals", type=int, default=2_000_000, help="valutazioni target x regola max")
+    parser.add_argument("--max-log-writes", type=int, default=2_000)
+    parser.add_argument("--repeat", type=int, default=3, help="ripetizioni, si tiene la migliore")
+    parser.add_argument("--with-mock", action="store_true", help="include il fetch HTTP via mock_api")
+    parser.add_argument("--skip-startup", action="store_true", help="salta i tempi di avvio/import")
+    parser.add_argument("--mock-campaigns", type=int, default=5)
+    parser.add_argument("--mock-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--compare", help="JSON di un run precedente da confrontare")
+    parser.add_argument("--threshold", type=float, default=1.2, help="rapporto oltre cui è regressione")
+    args = parser.parse_args()
+
+    _prepare_env()
+
+    rule_counts = [int(r) for r in args.rules.split(",") if r.strip()]
+    results: List[Dict[str, Any]] = []
+
+    for scenario in [s.strip().lower() for s in args.scenarios.split(",") if s.strip()]:
+        if scenario not in SCENARIOS:
+            parser.error(f"scenario sconosciuto: {scenario} (validi: {', '.join(SCENARIOS)})")
+        n = SCENARIOS[scenario]
+        print(f"\n=== SCENARIO {scenario}: {n} target ===")
+
+        account = make_account(n)
+        sample_pos = positions(account, n if args.sample <= 0 else min(n, args.sample))
+
+        bench_engine(results, scenario, n, rule_counts, args, account, sample_pos)
+        bench_parse(results, scenario, n, args, account, sample_pos)
+        bench_payload(results, scenario, n, args, account, sample_pos)
+        bench_db(results, scenario, n, rule_counts, args, account, sample_pos)
+        if args.with_mock:
+            bench_fetch(results, scenario, n, args)
+
+    if not args.skip_startup:
+        bench_startup(results, args)
+
+    out = {
+        "meta": {
+            "created_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(out, f, indent=2)
+    print(f"\nRisultati salvati in {args.output}")
+
+    if args.compare and not compare(results, args.compare, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
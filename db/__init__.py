@@ -10,4 +10,27 @@ from .database import (
     set_rule_enabled,
     get_due_rules,
     log_rule_execution,
+    log_rule_run,
+    log_manual_bid_changes,
+    get_execution_log_detail,
+    set_execution_log_detail,
+    record_rule_runs,
+    get_recent_runs,
+    get_rule_runs,
+    get_setting,
+    set_setting,
+    get_execution_run_times,
+    get_targets_as_of,
+    refresh_rule_analysis,
+    get_rule_analysis,
+    get_conflict_policy,
+    set_conflict_policy,
+    get_guardrails,
+    set_guardrail,
+    delete_guardrail,
+    load_guardrail_index,
+    record_bid_changes,
+    get_bid_states,
+    get_bids_changed_since,
+    load_bid_state_index,
 )
@@ -1,9 +1,11 @@
 # db/database.py
 
+import json
 import sqlite3
+from collections import Counter
 from pathlib import Path
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DB_PATH = BASE_DIR / "ads_rules.db"
@@ -23,6 +25,10 @@ def init_db() -> None:
     """Crea le tabelle se non esistono."""
     with get_connection() as conn:
         cur = conn.cursor()
+        cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'target_bid_state';"
+        )
+        new_bid_state = cur.fetchone() is None
         cur.executescript(
             """
             CREATE TABLE IF NOT EXISTS settings (
@@ -33,7 +39,7 @@ def init_db() -> None:
             CREATE TABLE IF NOT EXISTS rules (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
-                rule_type TEXT NOT NULL,                -- 'ACOS_BAND' o 'LOW_TRAFFIC'
+                rule_type TEXT NOT NULL,                -- 'ACOS_BAND', 'LOW_TRAFFIC', 'METRIC', 'EXPRESSION'
                 campaign_id TEXT,                       -- null = tutte
                 marketplace TEXT,                       -- 'US', 'IT', ecc.
                 match_type TEXT,                        -- 'exact', 'phrase', 'broad'
@@ -44,6 +50,9 @@ def init_db() -> None:
                 clicks_min INTEGER,                     -- per LOW_TRAFFIC (se serve)
                 clicks_max INTEGER,
 
+                conditions TEXT,                        -- per METRIC: JSON (rules/conditions.py)
+                expression TEXT,                        -- per EXPRESSION: es. 'clicks >= 20 and orders == 0'
+
                 adjustment_type TEXT NOT NULL,          -- 'ABS' o 'PCT'
                 adjustment_value REAL NOT NULL,         -- es: 0.05 o 10
 
@@ -51,6 +60,10 @@ def init_db() -> None:
                 frequency_days INTEGER NOT NULL,        -- 3, 5, 7, 10, 15
 
                 enabled INTEGER NOT NULL DEFAULT 1,
+                priority INTEGER NOT NULL DEFAULT 100,  -- ordine di risoluzione (minore = prima)
+
+                cooldown_hours REAL,                    -- null = nessun cooldown (rules/cooldown.py)
+                hysteresis_pct REAL,                    -- margine sulle soglie per le inversioni
 
                 last_run_at TEXT,                       -- ISO datetime
                 created_at TEXT NOT NULL,
@@ -74,19 +87,181 @@ def init_db() -> None:
                 clicks INTEGER,
                 impressions INTEGER,
 
-                action TEXT NOT NULL,                   -- 'INCREASE', 'DECREASE', 'NO_ACTION', 'SKIP'
-                message TEXT,
+                action TEXT NOT NULL,                   -- 'INCREASE', 'DECREASE', 'NO_ACTION', 'SKIP_*', 'RUN_SUMMARY'
+                message TEXT,                           -- per RUN_SUMMARY: conteggi per azione (JSON)
 
                 FOREIGN KEY (rule_id) REFERENCES rules (id)
             );
 
+            -- Mirror locale di campagne e target (vedi db/mirror.py)
+            CREATE TABLE IF NOT EXISTS campaigns_mirror (
+                profile_id TEXT NOT NULL,
+                campaign_id TEXT NOT NULL,
+                name TEXT,
+                state TEXT,
+                data TEXT NOT NULL,                     -- JSON come restituito dalle API
+                content_hash TEXT NOT NULL,
+                updated_at TEXT NOT NULL,               -- ultima modifica vista dal sync
+                PRIMARY KEY (profile_id, campaign_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS targets_mirror (
+                target_id TEXT PRIMARY KEY,
+                profile_id TEXT NOT NULL,
+                campaign_id TEXT,
+                ad_group_id TEXT,
+                keyword_text TEXT,
+                match_type TEXT,
+                state TEXT,
+                target_type TEXT,
+                bid REAL,
+                data TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS sync_state (
+                profile_id TEXT NOT NULL,
+                scope TEXT NOT NULL,                    -- 'campaigns' o 'targets:<campaign_id>'
+                synced_at TEXT,                         -- NULL = da risincronizzare
+                page_hashes TEXT,                       -- JSON: hash delle pagine grezze
+                PRIMARY KEY (profile_id, scope)
+            );
+
+            CREATE TABLE IF NOT EXISTS target_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sync_id TEXT NOT NULL,
+                profile_id TEXT NOT NULL,
+                campaign_id TEXT,
+                target_id TEXT NOT NULL,
+                change TEXT NOT NULL,                   -- 'NEW', 'UPDATED', 'REMOVED'
+                changed_at TEXT NOT NULL
+            );
+
+            -- Limiti di sicurezza sui bid (vedi rules/guardrails.py)
+            CREATE TABLE IF NOT EXISTS bid_guardrails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,                    -- 'GLOBAL', 'PROFILE', 'CAMPAIGN', 'TARGET'
+                scope_id TEXT NOT NULL,                 -- '*' per GLOBAL
+                min_bid REAL,                           -- null = non definito a questo livello
+                max_bid REAL,
+                max_change_pct REAL,                    -- variazione massima al giorno, in %
+                updated_at TEXT NOT NULL,
+                UNIQUE (scope, scope_id)
+            );
+
+            -- Ultima modifica di bid per target (vedi record_bid_changes)
+            CREATE TABLE IF NOT EXISTS target_bid_state (
+                target_id TEXT PRIMARY KEY,
+                profile_id TEXT,
+                campaign_id TEXT,
+                bid REAL,                               -- bid dopo l'ultima modifica
+                previous_bid REAL,                      -- bid prima dell'ultima modifica
+                last_change_at TEXT,
+                last_change_delta REAL,                 -- bid - previous_bid
+                last_rule_id INTEGER,
+                change_count INTEGER NOT NULL DEFAULT 0, -- modifiche da window_start
+                window_start TEXT,                      -- inizio della finestra di conteggio
+                updated_at TEXT NOT NULL
+            );
+
+            -- Riepilogo per (run dello scheduler, regola), scritto a fine run
+            CREATE TABLE IF NOT EXISTS rule_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT NOT NULL,                   -- = rule_executions.run_at del run
+                rule_id INTEGER NOT NULL,
+                started_at TEXT NOT NULL,
+                finished_at TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                targets INTEGER NOT NULL DEFAULT 0,     -- target valutati
+                increases INTEGER NOT NULL DEFAULT 0,
+                decreases INTEGER NOT NULL DEFAULT 0,
+                actions TEXT,                           -- conteggi per azione (JSON)
+                bid_delta REAL NOT NULL DEFAULT 0,      -- somma delle variazioni scritte
+                api_calls INTEGER NOT NULL DEFAULT 0,   -- aggiornamenti bid inviati ad Amazon
+                errors INTEGER NOT NULL DEFAULT 0,
+                error TEXT                              -- ultimo errore, se presente
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_rule_runs_started
+                ON rule_runs (started_at);
+
+            CREATE INDEX IF NOT EXISTS idx_rule_runs_run
+                ON rule_runs (run_id);
+
+            CREATE INDEX IF NOT EXISTS idx_rule_runs_rule
+                ON rule_runs (rule_id, started_at);
+
+            CREATE INDEX IF NOT EXISTS idx_targets_mirror_campaign
+                ON targets_mirror (profile_id, campaign_id);
+
+            CREATE INDEX IF NOT EXISTS idx_target_changes_profile
+                ON target_changes (profile_id, changed_at);
+
             CREATE INDEX IF NOT EXISTS idx_rules_enabled
                 ON rules (enabled);
 
             CREATE INDEX IF NOT EXISTS idx_rule_exec_rule_id
                 ON rule_executions (rule_id);
+
+            CREATE INDEX IF NOT EXISTS idx_rule_exec_target
+                ON rule_executions (target_id, run_at);
+
+            CREATE INDEX IF NOT EXISTS idx_rule_exec_rule_run
+                ON rule_executions (rule_id, run_at);
+
+            -- bid di inizio giornata (get_day_start_bids) e ultimi run
+            CREATE INDEX IF NOT EXISTS idx_rule_exec_run_at
+                ON rule_executions (run_at);
             """
         )
+        # colonne aggiunte dopo la prima versione: i DB esistenti vanno migrati
+        _ensure_columns(cur, "rules", RULES_MIGRATIONS)
+        if new_bid_state:
+            # DB esistente: stato iniziale ricostruito una volta dallo storico
+            _backfill_bid_state(cur)
+        conn.commit()
+
+
+# colonna -> definizione, per ALTER TABLE sui DB creati prima della colonna
+RULES_MIGRATIONS = {
+    "priority": "INTEGER NOT NULL DEFAULT 100",
+    "conditions": "TEXT",
+    "expression": "TEXT",
+    "cooldown_hours": "REAL",
+    "hysteresis_pct": "REAL",
+}
+
+
+def _ensure_columns(cur: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> None:
+    existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table});")}
+    for name, ddl in columns.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl};")
+
+
+# ------------------------
+# Settings (chiave/valore)
+# ------------------------
+
+def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM settings WHERE key = ?;", (key,))
+        row = cur.fetchone()
+    return row["value"] if row else default
+
+
+def set_setting(key: str, value: str) -> None:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO settings (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+            """,
+            (key, value),
+        )
         conn.commit()
 
 
@@ -114,8 +289,40 @@ def get_rule(rule_id: int) -> Optional[Dict[str, Any]]:
     return row_to_dict(row) if row else None
 
 
+def _validate_rule_logic(data: Dict[str, Any], require: bool = True) -> Dict[str, Any]:
+    """
+    Condizioni JSON in forma canonica ed espressione validata/compilata
+    (rules.conditions, rules.expressions), marketplace nel codice dei
+    profili (amazon_api.profiles.canonical_marketplace), cooldown e isteresi
+    non negativi; ValueError se non validi.
+    require: la regola METRIC / EXPRESSION deve avere la sua condizione.
+    """
+    from rules.conditions import METRIC_RULE_TYPE, normalize_conditions
+    from rules.expressions import EXPRESSION_RULE_TYPE, normalize_expression
+
+    if "conditions" in data:
+        data = {**data, "conditions": normalize_conditions(data["conditions"])}
+    if data.get("marketplace"):
+        from amazon_api.profiles import canonical_marketplace
+
+        # stesso codice dei target (matches_filters e rules.conflicts confrontano con ==)
+        data = {**data, "marketplace": canonical_marketplace(data["marketplace"])}
+    if "expression" in data:
+        data = {**data, "expression": normalize_expression(data["expression"])}
+    if require and data.get("rule_type") == METRIC_RULE_TYPE and not data.get("conditions"):
+        raise ValueError("Una regola METRIC richiede almeno una condizione")
+    if require and data.get("rule_type") == EXPRESSION_RULE_TYPE and not data.get("expression"):
+        raise ValueError("Una regola EXPRESSION richiede un'espressione")
+    if (data.get("cooldown_hours") or 0) < 0:
+        raise ValueError("Il cooldown non può essere negativo")
+    if not 0 <= (data.get("hysteresis_pct") or 0) < 100:
+        raise ValueError("Il margine di isteresi deve essere tra 0 e 100%")
+    return data
+
+
 def create_rule(data: Dict[str, Any]) -> int:
     now = utc_now_str()
+    data = _validate_rule_logic(data)
     fields = [
         "name",
         "rule_type",
@@ -126,13 +333,20 @@ def create_rule(data: Dict[str, Any]) -> int:
         "acos_max",
         "clicks_min",
         "clicks_max",
+        "conditions",
+        "expression",
+        "cooldown_hours",
+        "hysteresis_pct",
         "adjustment_type",
         "adjustment_value",
         "timeframe_days",
         "frequency_days",
         "enabled",
+        "priority",
     ]
     values = [data.get(f) for f in fields]
+    if values[-1] is None:
+        values[-1] = 100
 
     with get_connection() as conn:
         cur = conn.cursor()
@@ -154,11 +368,16 @@ def create_rule(data: Dict[str, Any]) -> int:
             values + [now, now],
         )
         conn.commit()
-        return cur.lastrowid
+        rule_id = cur.lastrowid
+
+    refresh_rule_analysis()
+    return rule_id
 
 
 def update_rule(rule_id: int, data: Dict[str, Any]) -> None:
     now = utc_now_str()
+    # solo normalizzazione: il tipo della regola può non essere nel dict
+    data = _validate_rule_logic(data, require=False)
     allowed_fields = {
         "name",
         "rule_type",
@@ -169,11 +388,16 @@ def update_rule(rule_id: int, data: Dict[str, Any]) -> None:
         "acos_max",
         "clicks_min",
         "clicks_max",
+        "conditions",
+        "expression",
+        "cooldown_hours",
+        "hysteresis_pct",
         "adjustment_type",
         "adjustment_value",
         "timeframe_days",
         "frequency_days",
         "enabled",
+        "priority",
     }
 
     set_parts = []
@@ -198,6 +422,8 @@ def update_rule(rule_id: int, data: Dict[str, Any]) -> None:
         )
         conn.commit()
 
+    refresh_rule_analysis()
+
 
 def delete_rule(rule_id: int) -> None:
     with get_connection() as conn:
@@ -205,11 +431,328 @@ def delete_rule(rule_id: int) -> None:
         cur.execute("DELETE FROM rules WHERE id = ?;", (rule_id,))
         conn.commit()
 
+    refresh_rule_analysis()
+
 
 def set_rule_enabled(rule_id: int, enabled: bool) -> None:
     update_rule(rule_id, {"enabled": 1 if enabled else 0})
 
 
+# ------------------------
+# Analisi sovrapposizioni (rules.conflicts)
+# ------------------------
+
+RULE_ANALYSIS_KEY = "rule_analysis"
+RULE_POLICY_KEY = "rule_conflict_policy"
+
+
+def refresh_rule_analysis():
+    """
+    Ricalcola ordine di risoluzione e sovrapposizioni delle regole attive e
+    li salva in settings. Chiamata da create_rule / update_rule / delete_rule.
+    """
+    from rules.conflicts import analyze_rules
+
+    rules = [r for r in get_all_rules() if r["enabled"]]
+    analysis = analyze_rules(rules)
+    set_setting(RULE_ANALYSIS_KEY, json.dumps(analysis.to_dict()))
+    return analysis
+
+
+def get_rule_analysis():
+    """Analisi salvata (rules.conflicts.RuleAnalysis); la ricalcola se manca."""
+    from rules.conflicts import RuleAnalysis
+
+    raw = get_setting(RULE_ANALYSIS_KEY)
+    if not raw:
+        return refresh_rule_analysis()
+    return RuleAnalysis.from_dict(json.loads(raw))
+
+
+def get_conflict_policy() -> str:
+    """'SEQUENTIAL' (default, variazioni sommate) o 'FIRST_MATCH'."""
+    from rules.conflicts import POLICIES, SEQUENTIAL
+
+    policy = get_setting(RULE_POLICY_KEY, SEQUENTIAL)
+    return policy if policy in POLICIES else SEQUENTIAL
+
+
+def set_conflict_policy(policy: str) -> None:
+    from rules.conflicts import POLICIES
+
+    if policy not in POLICIES:
+        raise ValueError(f"Politica non valida: {policy}")
+    set_setting(RULE_POLICY_KEY, policy)
+
+
+# ------------------------
+# Limiti bid (rules.guardrails)
+# ------------------------
+
+def get_guardrails() -> List[Dict[str, Any]]:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM bid_guardrails ORDER BY scope, scope_id;")
+        rows = cur.fetchall()
+    return [row_to_dict(r) for r in rows]
+
+
+def set_guardrail(
+    scope: str,
+    scope_id: Any,
+    min_bid: Optional[float] = None,
+    max_bid: Optional[float] = None,
+    max_change_pct: Optional[float] = None,
+) -> None:
+    """Crea o sostituisce il limite per (scope, scope_id)."""
+    from rules.guardrails import GLOBAL_SCOPE_ID, SCOPES
+
+    if scope not in SCOPES:
+        raise ValueError(f"Ambito non valido: {scope}")
+    if min_bid is not None and max_bid is not None and min_bid > max_bid:
+        raise ValueError("min_bid maggiore di max_bid")
+    if max_change_pct is not None and max_change_pct < 0:
+        raise ValueError("max_change_pct negativo")
+    if scope == "GLOBAL":
+        scope_id = GLOBAL_SCOPE_ID
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO bid_guardrails (scope, scope_id, min_bid, max_bid, max_change_pct, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (scope, scope_id) DO UPDATE SET
+                min_bid = excluded.min_bid,
+                max_bid = excluded.max_bid,
+                max_change_pct = excluded.max_change_pct,
+                updated_at = excluded.updated_at;
+            """,
+            (scope, str(scope_id), min_bid, max_bid, max_change_pct, utc_now_str()),
+        )
+        conn.commit()
+
+
+def delete_guardrail(guardrail_id: int) -> None:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM bid_guardrails WHERE id = ?;", (guardrail_id,))
+        conn.commit()
+
+
+def get_day_start_bids(since: datetime) -> Dict[str, float]:
+    """
+    {target_id: old_bid} della prima modifica (INCREASE/DECREASE/MANUAL)
+    registrata da since in poi, cioè il bid che il target aveva a inizio
+    giornata.
+    """
+    since_str = since.isoformat(timespec="seconds") + "Z"
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT e.target_id, e.old_bid
+            FROM rule_executions e
+            JOIN (
+                SELECT target_id, MIN(id) AS id
+                -- solo le righe di oggi: senza INDEXED BY il planner sceglie
+                -- idx_rule_exec_target per il GROUP BY e scorre tutto il log
+                FROM rule_executions INDEXED BY idx_rule_exec_run_at
+                WHERE run_at >= ? AND action IN {_CHANGE_ACTIONS}
+                GROUP BY target_id
+            ) first ON first.id = e.id
+            WHERE e.target_id IS NOT NULL AND e.old_bid IS NOT NULL;
+            """,
+            (since_str,),
+        )
+        return {r["target_id"]: r["old_bid"] for r in cur.fetchall()}
+
+
+def load_guardrail_index(now: Optional[datetime] = None):
+    """
+    Limiti e bid di inizio giornata (UTC) in un rules.guardrails.GuardrailIndex:
+    due query per run, poi solo lookup in memoria.
+    """
+    from rules.guardrails import GuardrailIndex
+
+    if now is None:
+        now = datetime.utcnow()
+    index = GuardrailIndex(get_guardrails())
+    if index.has_rate_limits:
+        day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        index.day_start_bids.update(get_day_start_bids(day_start))
+    return index
+
+
+# ------------------------
+# Stato bid per target (ultima modifica)
+# ------------------------
+
+# finestra del conteggio change_count: scaduta, il conteggio riparte da zero
+BID_CHANGE_WINDOW_DAYS = 7
+
+# modifiche di bid: delle regole e manuali (pagina "Modifica Bid", MANUAL_ACTION)
+_CHANGE_ACTIONS = "('INCREASE', 'DECREASE', 'MANUAL')"
+
+
+def _backfill_bid_state(cur: sqlite3.Cursor) -> None:
+    """Popola target_bid_state dall'ultima modifica di ogni target in rule_executions."""
+    now = datetime.utcnow()
+    cutoff = (now - timedelta(days=BID_CHANGE_WINDOW_DAYS)).isoformat(timespec="seconds") + "Z"
+    cur.execute(
+        f"""
+        INSERT OR REPLACE INTO target_bid_state (
+            target_id, campaign_id, bid, previous_bid, last_change_at,
+            last_change_delta, last_rule_id, change_count, window_start, updated_at
+        )
+        SELECT
+            e.target_id, e.campaign_id, e.new_bid, e.old_bid, e.run_at,
+            ROUND(e.new_bid - e.old_bid, 4), e.rule_id,
+            COALESCE(w.n, 0), COALESCE(w.start, e.run_at), ?
+        FROM rule_executions e
+        JOIN (
+            SELECT target_id, MAX(id) AS id
+            FROM rule_executions
+            WHERE target_id IS NOT NULL AND action IN {_CHANGE_ACTIONS}
+            GROUP BY target_id
+        ) last ON last.id = e.id
+        LEFT JOIN (
+            SELECT target_id, COUNT(*) AS n, MIN(run_at) AS start
+            FROM rule_executions
+            WHERE run_at >= ? AND action IN {_CHANGE_ACTIONS}
+            GROUP BY target_id
+        ) w ON w.target_id = e.target_id;
+        """,
+        (now.isoformat(timespec="seconds") + "Z", cutoff),
+    )
+
+
+def record_bid_changes(changes: Iterable[Dict[str, Any]], run_at: Optional[datetime] = None) -> int:
+    """
+    Aggiorna target_bid_state con le modifiche di un run, in una sola
+    transazione (executemany). Da chiamare una volta a fine run.
+
+    changes: dict con target_id, old_bid, new_bid e opzionali profile_id,
+    campaign_id, rule_id, nell'ordine in cui sono state applicate. Più
+    modifiche dello stesso target nel run diventano una riga: previous_bid
+    è il bid prima della prima, bid quello dopo l'ultima.
+
+    change_count somma le modifiche da window_start; se la finestra
+    (BID_CHANGE_WINDOW_DAYS) è scaduta riparte da questo run.
+    Ritorna il numero di target aggiornati.
+    """
+    if run_at is None:
+        run_at = datetime.utcnow()
+    run_str = run_at.isoformat(timespec="seconds") + "Z"
+    cutoff = (run_at - timedelta(days=BID_CHANGE_WINDOW_DAYS)).isoformat(timespec="seconds") + "Z"
+
+    merged: Dict[str, Dict[str, Any]] = {}
+    for c in changes:
+        tid = str(c["target_id"])
+        row = merged.get(tid)
+        if row is None:
+            merged[tid] = {**c, "count": 1}
+        else:
+            row.update({k: v for k, v in c.items() if k != "old_bid" and v is not None})
+            row["count"] += 1
+    if not merged:
+        return 0
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT INTO target_bid_state (
+                target_id, profile_id, campaign_id, bid, previous_bid, last_change_at,
+                last_change_delta, last_rule_id, change_count, window_start, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (target_id) DO UPDATE SET
+                profile_id = COALESCE(excluded.profile_id, profile_id),
+                campaign_id = COALESCE(excluded.campaign_id, campaign_id),
+                bid = excluded.bid,
+                previous_bid = excluded.previous_bid,
+                last_change_at = excluded.last_change_at,
+                last_change_delta = excluded.last_change_delta,
+                last_rule_id = excluded.last_rule_id,
+                change_count = CASE WHEN window_start >= ?
+                    THEN change_count + excluded.change_count
+                    ELSE excluded.change_count END,
+                window_start = CASE WHEN window_start >= ?
+                    THEN window_start ELSE excluded.window_start END,
+                updated_at = excluded.updated_at;
+            """,
+            [
+                (
+                    tid,
+                    None if row.get("profile_id") is None else str(row["profile_id"]),
+                    None if row.get("campaign_id") is None else str(row["campaign_id"]),
+                    row["new_bid"],
+                    row["old_bid"],
+                    run_str,
+                    round(row["new_bid"] - row["old_bid"], 4),
+                    row.get("rule_id"),
+                    row["count"],
+                    run_str,
+                    run_str,
+                    cutoff,
+                    cutoff,
+                )
+                for tid, row in merged.items()
+            ],
+        )
+        conn.commit()
+    return len(merged)
+
+
+def get_bid_states(target_ids: Optional[Iterable[Any]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    {target_id: riga di target_bid_state}: caricata una volta per run, la
+    verifica "quando è cambiato l'ultima volta" diventa un lookup.
+    target_ids: solo quei target (None = tutti).
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        if target_ids is None:
+            cur.execute("SELECT * FROM target_bid_state;")
+            rows = cur.fetchall()
+        else:
+            ids = list(dict.fromkeys(str(t) for t in target_ids))
+            rows = []
+            # limite dei parametri SQLite: a blocchi
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cur.execute(
+                    "SELECT * FROM target_bid_state WHERE target_id IN (%s);"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                rows.extend(cur.fetchall())
+    return {r["target_id"]: row_to_dict(r) for r in rows}
+
+
+def get_bids_changed_since(since: str) -> Dict[str, float]:
+    """
+    {target_id: bid} dei target modificati (da una regola o a mano) con
+    last_change_at >= since: i bid da sovrapporre a uno snapshot creato a
+    since, che li conosce ancora con il valore precedente.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT target_id, bid FROM target_bid_state WHERE last_change_at >= ? AND bid IS NOT NULL;",
+            (since,),
+        )
+        return {r["target_id"]: r["bid"] for r in cur.fetchall()}
+
+
+def load_bid_state_index(now: Optional[datetime] = None, target_ids: Optional[Iterable[Any]] = None):
+    """target_bid_state in un rules.cooldown.BidStateIndex (ore trascorse rispetto a now)."""
+    from rules.cooldown import BidStateIndex
+
+    return BidStateIndex(get_bid_states(target_ids).values(), now)
+
+
 # ------------------------
 # Regole "due" per scheduler
 # ------------------------
@@ -264,7 +807,7 @@ def log_rule_execution(
     action: str,
     message: str = "",
 ) -> None:
-    """Salva un log per una singola keyword o target."""
+    """Salva un log per una singola keyword o target (nello scheduler: log_rule_run)."""
 
     run_str = run_at.isoformat(timespec="seconds") + "Z"
 
@@ -273,36 +816,347 @@ def log_rule_execution(
         cur.execute(
             """
             INSERT INTO rule_executions (
-                rule_id,
-                run_at,
-                target_id,
-                campaign_id,
-                keyword_text,
-                match_type,
-                old_bid,
-                new_bid,
-                acos,
-                clicks,
-                impressions,
-                action,
-                message
+                rule_id, run_at, target_id, campaign_id, keyword_text, match_type,
+                old_bid, new_bid, acos, clicks, impressions, action, message
             )
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
             """,
-            (
-                rule_id,
-                run_str,
-                target.get("target_id"),
-                target.get("campaign_id"),
-                target.get("keyword_text"),
-                target.get("match_type"),
-                old_bid,
-                new_bid,
-                target.get("acos"),
-                target.get("clicks"),
-                target.get("impressions"),
-                action,
-                message,
-            ),
+            _execution_row(rule_id, run_str, target, old_bid, new_bid, action, message),
+        )
+        conn.commit()
+
+
+# modifica manuale dall'app: rule_id MANUAL_RULE_ID (nessuna regola)
+MANUAL_ACTION = "MANUAL"
+MANUAL_RULE_ID = 0
+# azioni sempre registrate per target; le altre solo nel riepilogo del run
+CHANGE_ACTIONS = ("INCREASE", "DECREASE", MANUAL_ACTION)
+# riga aggregata per (regola, run): target_id NULL, conteggi per azione in message (JSON)
+RUN_SUMMARY_ACTION = "RUN_SUMMARY"
+EXECUTION_LOG_DETAIL_KEY = "execution_log_detail"
+
+
+def get_execution_log_detail() -> bool:
+    """True = log completo (una riga per target, anche SKIP_* e NO_ACTION), per debug."""
+    return get_setting(EXECUTION_LOG_DETAIL_KEY, "0") == "1"
+
+
+def set_execution_log_detail(full: bool) -> None:
+    set_setting(EXECUTION_LOG_DETAIL_KEY, "1" if full else "0")
+
+
+def _execution_row(rule_id, run_str, target, old_bid, new_bid, action, message) -> tuple:
+    return (
+        rule_id,
+        run_str,
+        target.get("target_id"),
+        target.get("campaign_id"),
+        target.get("keyword_text"),
+        target.get("match_type"),
+        old_bid,
+        new_bid,
+        target.get("acos"),
+        target.get("clicks"),
+        target.get("impressions"),
+        action,
+        message,
+    )
+
+
+def log_rule_run(
+    rule_id: int,
+    run_at: datetime,
+    entries: Sequence[Tuple[Dict[str, Any], Optional[float], Optional[float], str, str]],
+    full: bool = False,
+) -> int:
+    """
+    Log di un'esecuzione di regola in una transazione (executemany).
+
+    entries: (target, old_bid, new_bid, action, message) per ogni target
+    valutato. Di default solo INCREASE/DECREASE diventano righe per target;
+    tutte le azioni sono contate nella riga RUN_SUMMARY. full=True (debug):
+    una riga per target qualunque sia l'azione, più il riepilogo.
+    Ritorna il numero di righe scritte.
+    """
+    run_str = run_at.isoformat(timespec="seconds") + "Z"
+    counts = Counter(e[3] for e in entries)
+    rows = [
+        _execution_row(rule_id, run_str, *e)
+        for e in entries
+        if full or e[3] in CHANGE_ACTIONS
+    ]
+    rows.append(
+        _execution_row(
+            rule_id, run_str, {}, None, None, RUN_SUMMARY_ACTION,
+            json.dumps(dict(counts), sort_keys=True),
+        )
+    )
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT INTO rule_executions (
+                rule_id, run_at, target_id, campaign_id, keyword_text, match_type,
+                old_bid, new_bid, acos, clicks, impressions, action, message
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            rows,
         )
         conn.commit()
+    return len(rows)
+
+
+def log_manual_bid_changes(
+    changes: Sequence[Dict[str, Any]],
+    run_at: Optional[datetime] = None,
+) -> int:
+    """
+    Registra le modifiche manuali di bid come quelle delle regole: una riga
+    MANUAL per target in rule_executions (rule_id MANUAL_RULE_ID) e
+    target_bid_state aggiornato, così bid di inizio giornata, cooldown e
+    isteresi tengono conto anche di queste.
+
+    changes: dict con target_id, old_bid, new_bid e opzionali profile_id,
+    campaign_id, keyword_text, match_type. Le righe con bid invariato sono
+    ignorate. Ritorna il numero di target registrati.
+    """
+    if run_at is None:
+        run_at = datetime.utcnow()
+    run_str = run_at.isoformat(timespec="seconds") + "Z"
+    changed = [
+        c for c in changes
+        if c.get("old_bid") is not None and c.get("new_bid") is not None
+        and round(c["new_bid"] - c["old_bid"], 4) != 0
+    ]
+    if not changed:
+        return 0
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT INTO rule_executions (
+                rule_id, run_at, target_id, campaign_id, keyword_text, match_type,
+                old_bid, new_bid, acos, clicks, impressions, action, message
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            [
+                _execution_row(
+                    MANUAL_RULE_ID, run_str,
+                    {**c, "target_id": str(c["target_id"]),
+                     "campaign_id": None if c.get("campaign_id") is None else str(c["campaign_id"])},
+                    c["old_bid"], c["new_bid"], MANUAL_ACTION,
+                    f"Modifica manuale: {c['old_bid']} -> {c['new_bid']}",
+                )
+                for c in changed
+            ],
+        )
+        conn.commit()
+    return record_bid_changes(
+        [{**c, "rule_id": None} for c in changed], run_at
+    )
+
+
+# ------------------------
+# Riepilogo dei run (rule_runs)
+# ------------------------
+
+RULE_RUN_FIELDS = (
+    "run_id", "rule_id", "started_at", "finished_at", "duration_ms", "targets",
+    "increases", "decreases", "actions", "bid_delta", "api_calls", "errors", "error",
+)
+
+
+def record_rule_runs(rows: Sequence[Dict[str, Any]]) -> None:
+    """
+    Scrive in una transazione il riepilogo di un run dello scheduler: una
+    riga per regola eseguita (campi di RULE_RUN_FIELDS; actions può essere
+    un dict, salvato come JSON).
+    """
+    if not rows:
+        return
+    values = []
+    for r in rows:
+        actions = r.get("actions")
+        if actions is not None and not isinstance(actions, str):
+            actions = json.dumps(dict(actions), sort_keys=True)
+        values.append(tuple(actions if f == "actions" else r.get(f) for f in RULE_RUN_FIELDS))
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            f"""
+            INSERT INTO rule_runs ({", ".join(RULE_RUN_FIELDS)})
+            VALUES ({", ".join(["?"] * len(RULE_RUN_FIELDS))});
+            """,
+            values,
+        )
+        conn.commit()
+
+
+def get_recent_runs(limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    Ultimi run dello scheduler, più recenti per primi, con i totali delle
+    regole eseguite. Legge solo rule_runs (poche righe per run, indicizzate
+    per run_id), mai rule_executions.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT
+                r.run_id,
+                MIN(r.started_at) AS started_at,
+                MAX(r.finished_at) AS finished_at,
+                SUM(r.duration_ms) AS duration_ms,
+                COUNT(*) AS rules,
+                SUM(r.targets) AS targets,
+                SUM(r.increases) AS increases,
+                SUM(r.decreases) AS decreases,
+                ROUND(SUM(r.bid_delta), 2) AS bid_delta,
+                SUM(r.api_calls) AS api_calls,
+                SUM(r.errors) AS errors
+            FROM rule_runs r
+            WHERE r.run_id IN (
+                -- run_id è l'istante del run: ordine cronologico sull'indice
+                SELECT run_id
+                FROM rule_runs
+                GROUP BY run_id
+                ORDER BY run_id DESC
+                LIMIT ?
+            )
+            GROUP BY r.run_id
+            ORDER BY r.run_id DESC;
+            """,
+            (limit,),
+        )
+        return [row_to_dict(r) for r in cur.fetchall()]
+
+
+def get_rule_runs(
+    run_id: Optional[str] = None,
+    rule_id: Optional[int] = None,
+    limit: int = 200,
+) -> List[Dict[str, Any]]:
+    """Righe di rule_runs di un run e/o di una regola, più recenti per prime (actions come dict)."""
+    where = []
+    params: List[Any] = []
+    if run_id is not None:
+        where.append("run_id = ?")
+        params.append(run_id)
+    if rule_id is not None:
+        where.append("rule_id = ?")
+        params.append(rule_id)
+    clause = ("WHERE " + " AND ".join(where)) if where else ""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT * FROM rule_runs {clause} ORDER BY started_at DESC, id DESC LIMIT ?;",
+            params + [limit],
+        )
+        rows = [row_to_dict(r) for r in cur.fetchall()]
+    for r in rows:
+        r["actions"] = json.loads(r["actions"]) if r.get("actions") else {}
+    return rows
+
+
+def get_execution_run_times(limit: int = 100) -> List[str]:
+    """Istanti (run_at) delle ultime esecuzioni registrate, più recenti per primi."""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT DISTINCT run_at FROM rule_executions ORDER BY run_at DESC LIMIT ?;",
+            (limit,),
+        )
+        return [r["run_at"] for r in cur.fetchall()]
+
+
+def get_executions_after(after_id: int, limit: int = 50_000) -> List[Dict[str, Any]]:
+    """
+    Righe di rule_executions con id > after_id, in ordine di id, al massimo
+    limit (export incrementale, scheduler/export.py). Il profilo non è nel
+    log: viene dal mirror dei target, o da target_bid_state. Letture brevi
+    per intervallo di chiave primaria: nessun lock lungo sul DB.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT e.*, COALESCE(m.profile_id, s.profile_id) AS profile_id
+            FROM rule_executions e
+            LEFT JOIN targets_mirror m ON m.target_id = e.target_id
+            LEFT JOIN target_bid_state s ON s.target_id = e.target_id
+            WHERE e.id > ?
+            ORDER BY e.id
+            LIMIT ?;
+            """,
+            (after_id, limit),
+        )
+        return [row_to_dict(r) for r in cur.fetchall()]
+
+
+def get_targets_as_of(as_of: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Target noti (targets_mirror più quelli di target_bid_state) con il bid in
+    vigore a as_of (None = adesso):
+
+    - ultima modifica registrata con run_at <= as_of: il suo new_bid;
+    - altrimenti, prima modifica successiva: il suo old_bid;
+    - altrimenti il bid attuale (target_bid_state, poi mirror).
+
+    Il log compatto registra solo i target modificati: le metriche qui sono
+    quelle dell'ultima riga di log del target fino a as_of (None se mai
+    registrato); scheduler.simulation.history_columns le sostituisce con lo
+    storico giornaliero, se presente. Il marketplace è quello della regola
+    di quella riga.
+    """
+    cutoff = as_of or "9999-12-31T23:59:59Z"
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            WITH universe AS (
+                SELECT target_id FROM targets_mirror
+                UNION
+                SELECT target_id FROM target_bid_state
+            ),
+            points AS (
+                SELECT
+                    u.target_id,
+                    (SELECT e.new_bid FROM rule_executions e
+                     WHERE e.target_id = u.target_id AND e.run_at <= :cutoff
+                       AND e.action IN {_CHANGE_ACTIONS}
+                     ORDER BY e.run_at DESC, e.id DESC LIMIT 1) AS bid_before,
+                    (SELECT e.old_bid FROM rule_executions e
+                     WHERE e.target_id = u.target_id AND e.run_at > :cutoff
+                       AND e.action IN {_CHANGE_ACTIONS}
+                     ORDER BY e.run_at, e.id LIMIT 1) AS bid_after,
+                    (SELECT e.id FROM rule_executions e
+                     WHERE e.target_id = u.target_id AND e.run_at <= :cutoff
+                     ORDER BY e.run_at DESC, e.id DESC LIMIT 1) AS last_id
+                FROM universe u
+            )
+            SELECT
+                p.target_id,
+                COALESCE(m.profile_id, s.profile_id) AS profile_id,
+                COALESCE(m.campaign_id, s.campaign_id, e.campaign_id) AS campaign_id,
+                COALESCE(m.keyword_text, e.keyword_text) AS keyword_text,
+                COALESCE(m.match_type, e.match_type) AS match_type,
+                COALESCE(p.bid_before, p.bid_after, s.bid, m.bid) AS bid,
+                e.acos,
+                e.clicks,
+                e.impressions,
+                r.marketplace
+            FROM points p
+            LEFT JOIN targets_mirror m ON m.target_id = p.target_id
+            LEFT JOIN target_bid_state s ON s.target_id = p.target_id
+            LEFT JOIN rule_executions e ON e.id = p.last_id
+            LEFT JOIN rules r ON r.id = e.rule_id;
+            """,
+            {"cutoff": cutoff},
+        )
+        rows = cur.fetchall()
+    return [row_to_dict(r) for r in rows]
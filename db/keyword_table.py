@@ -0,0 +1,153 @@
+# db/keyword_table.py
+
+"""
+Tabella keyword/target lato server per la pagina Keyword dell'app.
+
+I target restano in un SQLite in memoria (uno per profilo + insieme di
+campagne, tenuto in cache da Streamlit): filtri, ordinamento e paginazione
+girano in SQL e al browser arriva solo la pagina visibile.
+"""
+
+import math
+import sqlite3
+import threading
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+CAMPAIGN_COL = "CAMPAIGN_ID"
+MATCH_TYPE_COL = "MATCH_TYPE"
+ACOS_COL = "ACOS"
+CLICKS_COL = "CLICKS"
+
+INDEXED_COLUMNS = (CAMPAIGN_COL, MATCH_TYPE_COL, ACOS_COL, CLICKS_COL)
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+
+def _sql_value(value: Any) -> Any:
+    """NaN -> NULL, scalari numpy -> tipi Python (sqlite3 non li accetta)."""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        return None if math.isnan(value) else float(value)
+    if hasattr(value, "item"):
+        return _sql_value(value.item())
+    return value
+
+
+def _quote(column: str) -> str:
+    return '"' + column.replace('"', '""') + '"'
+
+
+class KeywordTable:
+    """
+    Target in un SQLite :memory: con indici sulle colonne filtrabili.
+
+    Thread-safe: Streamlit serve le sessioni da thread diversi e la stessa
+    istanza è condivisa tramite st.cache_resource.
+    """
+
+    def __init__(self, columns: Sequence[str], records: Iterable[Sequence[Any]]):
+        self.columns = list(columns)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+
+        cols_sql = ", ".join(_quote(c) for c in self.columns)
+        placeholders = ", ".join("?" * len(self.columns))
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE targets ({cols_sql});")
+            self._conn.executemany(
+                f"INSERT INTO targets VALUES ({placeholders});",
+                ([_sql_value(v) for v in rec] for rec in records),
+            )
+            for col in INDEXED_COLUMNS:
+                if col in self.columns:
+                    self._conn.execute(
+                        f"CREATE INDEX idx_{col.lower()} ON targets ({_quote(col)});"
+                    )
+
+        self._total = self._conn.execute("SELECT COUNT(*) FROM targets;").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._total
+
+    def distinct(self, column: str) -> List[Any]:
+        if column not in self.columns:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT {_quote(column)} FROM targets "
+                f"WHERE {_quote(column)} IS NOT NULL ORDER BY 1;"
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def bounds(self, column: str) -> Tuple[Optional[float], Optional[float]]:
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT MIN({_quote(column)}), MAX({_quote(column)}) FROM targets;"
+            ).fetchone()
+
+    def query(
+        self,
+        campaign_ids: Optional[Sequence[Any]] = None,
+        match_types: Optional[Sequence[str]] = None,
+        acos_min: Optional[float] = None,
+        acos_max: Optional[float] = None,
+        clicks_min: Optional[int] = None,
+        clicks_max: Optional[int] = None,
+        sort_by: Optional[str] = None,
+        descending: bool = False,
+        page: int = 0,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> Tuple[List[Tuple[Any, ...]], int]:
+        """
+        Restituisce (righe della pagina, totale righe filtrate).
+
+        Un range ACOS esclude i target senza ACOS; i click mancanti
+        contano come 0.
+        """
+        where: List[str] = []
+        params: List[Any] = []
+
+        if campaign_ids:
+            where.append(f"{_quote(CAMPAIGN_COL)} IN ({', '.join('?' * len(campaign_ids))})")
+            params.extend(_sql_value(c) for c in campaign_ids)
+        if match_types:
+            where.append(f"{_quote(MATCH_TYPE_COL)} IN ({', '.join('?' * len(match_types))})")
+            params.extend(match_types)
+        if acos_min is not None:
+            where.append(f"{_quote(ACOS_COL)} >= ?")
+            params.append(acos_min)
+        if acos_max is not None:
+            where.append(f"{_quote(ACOS_COL)} <= ?")
+            params.append(acos_max)
+        if clicks_min is not None:
+            where.append(f"COALESCE({_quote(CLICKS_COL)}, 0) >= ?")
+            params.append(clicks_min)
+        if clicks_max is not None:
+            where.append(f"COALESCE({_quote(CLICKS_COL)}, 0) <= ?")
+            params.append(clicks_max)
+
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+        order_sql = "ORDER BY rowid"
+        if sort_by in self.columns:
+            col = _quote(sort_by)
+            # i NULL in fondo, in entrambe le direzioni
+            order_sql = f"ORDER BY {col} IS NULL, {col} {'DESC' if descending else 'ASC'}, rowid"
+
+        page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+        offset = max(0, int(page)) * page_size
+
+        with self._lock:
+            total = self._conn.execute(
+                f"SELECT COUNT(*) FROM targets {where_sql};", params
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT * FROM targets {where_sql} {order_sql} LIMIT ? OFFSET ?;",
+                params + [page_size, offset],
+            ).fetchall()
+        return rows, total
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,333 @@
+# db/mirror.py
+
+"""
+Mirror locale (SQLite) di campagne e target Amazon Ads.
+
+Ogni riga conserva il JSON restituito dalle API e il suo hash: il sync
+incrementale (scheduler/sync.py) riscrive solo le righe con hash diverso e
+registra in target_changes quali target sono nuovi, modificati o rimossi
+(tenuti TARGET_CHANGES_RETENTION_DAYS giorni, vedi prune_target_changes).
+Scheduler e UI leggono da qui invece di riscaricare tutta la configurazione.
+"""
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .database import get_connection, row_to_dict, utc_now_str
+
+CAMPAIGNS_SCOPE = "campaigns"
+TARGET_CHANGES_RETENTION_DAYS = 30
+
+
+def targets_scope(campaign_id: Any) -> str:
+    return f"targets:{campaign_id}"
+
+
+def content_hash(obj: Any) -> str:
+    """Hash stabile di un oggetto JSON (ordine delle chiavi ininfluente)."""
+    raw = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def page_hash(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+# ------------------------
+# Stato del sync
+# ------------------------
+
+def get_sync_state(profile_id: Any, scope: str) -> Optional[Dict[str, Any]]:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT synced_at, page_hashes FROM sync_state WHERE profile_id = ? AND scope = ?;",
+            (str(profile_id), scope),
+        )
+        row = cur.fetchone()
+    if row is None:
+        return None
+    return {
+        "synced_at": row["synced_at"],
+        "page_hashes": json.loads(row["page_hashes"] or "[]"),
+    }
+
+
+def invalidate_mirror(profile_id: Any, campaign_ids: Optional[Iterable[Any]] = None) -> None:
+    """
+    Segna il mirror come da risincronizzare (es. dopo un aggiornamento bid).
+    Gli hash di pagina vengono azzerati, le righe restano: il prossimo sync
+    riscrive solo quelle effettivamente cambiate.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        if campaign_ids is None:
+            cur.execute(
+                "UPDATE sync_state SET synced_at = NULL, page_hashes = NULL WHERE profile_id = ?;",
+                (str(profile_id),),
+            )
+        else:
+            cur.executemany(
+                "UPDATE sync_state SET synced_at = NULL, page_hashes = NULL "
+                "WHERE profile_id = ? AND scope = ?;",
+                [(str(profile_id), targets_scope(c)) for c in campaign_ids],
+            )
+        conn.commit()
+
+
+def _set_sync_state(cur, profile_id: Any, scope: str, synced_at: str, page_hashes: List[str]) -> None:
+    cur.execute(
+        """
+        INSERT INTO sync_state (profile_id, scope, synced_at, page_hashes)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (profile_id, scope) DO UPDATE SET
+            synced_at = excluded.synced_at,
+            page_hashes = excluded.page_hashes;
+        """,
+        (str(profile_id), scope, synced_at, json.dumps(page_hashes)),
+    )
+
+
+def mark_synced(profile_id: Any, scope: str, page_hashes: List[str]) -> None:
+    """Aggiorna solo lo stato del sync (nessuna riga cambiata)."""
+    with get_connection() as conn:
+        _set_sync_state(conn.cursor(), profile_id, scope, utc_now_str(), page_hashes)
+        conn.commit()
+
+
+# ------------------------
+# Campagne
+# ------------------------
+
+def get_campaign_hashes(profile_id: Any) -> Dict[str, str]:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT campaign_id, content_hash FROM campaigns_mirror WHERE profile_id = ?;",
+            (str(profile_id),),
+        )
+        return {r["campaign_id"]: r["content_hash"] for r in cur.fetchall()}
+
+
+def apply_campaign_changes(
+    profile_id: Any,
+    upserts: Sequence[Tuple[Dict[str, Any], str]],
+    removed: Sequence[str],
+    page_hashes: List[str],
+) -> None:
+    """Scrive in una transazione le campagne nuove/modificate e quelle rimosse."""
+    now = utc_now_str()
+    pid = str(profile_id)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT INTO campaigns_mirror
+                (profile_id, campaign_id, name, state, data, content_hash, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (profile_id, campaign_id) DO UPDATE SET
+                name = excluded.name,
+                state = excluded.state,
+                data = excluded.data,
+                content_hash = excluded.content_hash,
+                updated_at = excluded.updated_at;
+            """,
+            [
+                (pid, str(c["campaignId"]), c.get("name"), c.get("state"), json.dumps(c), h, now)
+                for c, h in upserts
+            ],
+        )
+        cur.executemany(
+            "DELETE FROM campaigns_mirror WHERE profile_id = ? AND campaign_id = ?;",
+            [(pid, cid) for cid in removed],
+        )
+        _set_sync_state(cur, pid, CAMPAIGNS_SCOPE, now, page_hashes)
+        conn.commit()
+
+
+def get_mirror_campaigns(profile_id: Any) -> List[Dict[str, Any]]:
+    """Campagne del profilo nel formato delle API (/sp/campaigns/list)."""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT data FROM campaigns_mirror WHERE profile_id = ? ORDER BY campaign_id;",
+            (str(profile_id),),
+        )
+        return [json.loads(r["data"]) for r in cur.fetchall()]
+
+
+# ------------------------
+# Target
+# ------------------------
+
+def get_target_hashes(profile_id: Any, campaign_id: Any) -> Dict[str, str]:
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT target_id, content_hash FROM targets_mirror "
+            "WHERE profile_id = ? AND campaign_id = ?;",
+            (str(profile_id), str(campaign_id)),
+        )
+        return {r["target_id"]: r["content_hash"] for r in cur.fetchall()}
+
+
+def apply_target_changes(
+    profile_id: Any,
+    campaign_id: Any,
+    upserts: Sequence[Tuple[Dict[str, Any], Dict[str, Any], str, str]],
+    removed: Sequence[str],
+    page_hashes: List[str],
+    sync_id: str,
+) -> None:
+    """
+    Scrive in una transazione i target cambiati di una campagna.
+
+    upserts: (target API, target piatto, hash, 'NEW' | 'UPDATED').
+    Ogni riga scritta o rimossa finisce anche in target_changes.
+    """
+    now = utc_now_str()
+    pid = str(profile_id)
+    cid = str(campaign_id)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT INTO targets_mirror (
+                target_id, profile_id, campaign_id, ad_group_id, keyword_text,
+                match_type, state, target_type, bid, data, content_hash, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (target_id) DO UPDATE SET
+                profile_id = excluded.profile_id,
+                campaign_id = excluded.campaign_id,
+                ad_group_id = excluded.ad_group_id,
+                keyword_text = excluded.keyword_text,
+                match_type = excluded.match_type,
+                state = excluded.state,
+                target_type = excluded.target_type,
+                bid = excluded.bid,
+                data = excluded.data,
+                content_hash = excluded.content_hash,
+                updated_at = excluded.updated_at;
+            """,
+            [
+                (
+                    flat["target_id"], pid, flat["campaign_id"] or cid, flat["ad_group_id"],
+                    flat["keyword_text"], flat["match_type"], flat["state"],
+                    flat["target_type"], flat["bid"], json.dumps(raw), h, now,
+                )
+                for raw, flat, h, _ in upserts
+            ],
+        )
+        cur.executemany(
+            "DELETE FROM targets_mirror WHERE target_id = ?;",
+            [(tid,) for tid in removed],
+        )
+        cur.executemany(
+            """
+            INSERT INTO target_changes (sync_id, profile_id, campaign_id, target_id, change, changed_at)
+            VALUES (?, ?, ?, ?, ?, ?);
+            """,
+            [(sync_id, pid, cid, flat["target_id"], change, now) for _, flat, _, change in upserts]
+            + [(sync_id, pid, cid, tid, "REMOVED", now) for tid in removed],
+        )
+        _set_sync_state(cur, pid, targets_scope(cid), now, page_hashes)
+        conn.commit()
+
+
+def purge_orphan_targets(profile_id: Any, sync_id: Optional[str] = None) -> int:
+    """
+    Rimuove i target del profilo la cui campagna non è più in
+    campaigns_mirror (campagna sparita dall'ultimo sync completo delle
+    campagne), con lo stato di sync delle loro campagne. Le rimozioni
+    finiscono in target_changes come REMOVED. Ritorna il numero di target
+    rimossi.
+    """
+    now = utc_now_str()
+    pid = str(profile_id)
+    if sync_id is None:
+        sync_id = now
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT target_id, campaign_id FROM targets_mirror
+            WHERE profile_id = ? AND campaign_id NOT IN (
+                SELECT campaign_id FROM campaigns_mirror WHERE profile_id = ?
+            );
+            """,
+            (pid, pid),
+        )
+        orphans = [(r["target_id"], r["campaign_id"]) for r in cur.fetchall()]
+        if not orphans:
+            return 0
+        cur.executemany(
+            "DELETE FROM targets_mirror WHERE target_id = ?;",
+            [(tid,) for tid, _ in orphans],
+        )
+        cur.executemany(
+            """
+            INSERT INTO target_changes (sync_id, profile_id, campaign_id, target_id, change, changed_at)
+            VALUES (?, ?, ?, ?, 'REMOVED', ?);
+            """,
+            [(sync_id, pid, cid, tid, now) for tid, cid in orphans],
+        )
+        cur.executemany(
+            "DELETE FROM sync_state WHERE profile_id = ? AND scope = ?;",
+            [(pid, targets_scope(cid)) for cid in {cid for _, cid in orphans}],
+        )
+        conn.commit()
+    return len(orphans)
+
+
+def get_mirror_targets(profile_id: Any, campaign_ids: Optional[Iterable[Any]] = None) -> List[Dict[str, Any]]:
+    """Target del mirror nel formato delle API (/adsApi/v1/query/targets)."""
+    sql = "SELECT data FROM targets_mirror WHERE profile_id = ?"
+    params: List[Any] = [str(profile_id)]
+    if campaign_ids is not None:
+        ids = [str(c) for c in campaign_ids]
+        if not ids:
+            return []
+        sql += f" AND campaign_id IN ({', '.join('?' * len(ids))})"
+        params.extend(ids)
+    sql += " ORDER BY campaign_id, target_id;"
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        return [json.loads(r["data"]) for r in cur.fetchall()]
+
+
+def get_target_changes(
+    profile_id: Any,
+    since: Optional[str] = None,
+    limit: int = 1000,
+) -> List[Dict[str, Any]]:
+    """Ultimi cambiamenti registrati dal sync (più recenti per primi)."""
+    sql = "SELECT * FROM target_changes WHERE profile_id = ?"
+    params: List[Any] = [str(profile_id)]
+    if since:
+        sql += " AND changed_at >= ?"
+        params.append(since)
+    sql += " ORDER BY id DESC LIMIT ?;"
+    params.append(limit)
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        return [row_to_dict(r) for r in cur.fetchall()]
+
+
+def prune_target_changes(profile_id: Any, keep_days: int = TARGET_CHANGES_RETENTION_DAYS) -> int:
+    """Elimina i cambiamenti del profilo più vecchi di keep_days giorni. Restituisce quanti."""
+    cutoff = (datetime.utcnow() - timedelta(days=keep_days)).isoformat(timespec="seconds") + "Z"
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM target_changes WHERE profile_id = ? AND changed_at < ?;",
+            (str(profile_id), cutoff),
+        )
+        conn.commit()
+        return cur.rowcount
@@ -0,0 +1,342 @@
+# db/snapshot.py
+
+"""
+Snapshot su disco dell'ultima tabella target+metriche per profilo.
+
+Ogni colonna è un file .npy (formato NumPy v1.0) scritto con la sola libreria
+standard e letto con mmap: aprire uno snapshot costa qualche millisecondo,
+non copia i dati e le pagine sono condivise tra processi (app Streamlit,
+scheduler, analisi ad-hoc). Con NumPy installato si può fare direttamente
+np.load(path, mmap_mode="r").
+
+Le colonne testuali sono salvate come coppia <nome>.offsets.npy (int64, n+1)
++ <nome>.data.npy (uint8, UTF-8 concatenato); stringa vuota = None.
+
+Struttura:
+    data/snapshots/<profile_id>/tf<giorni>-<timestamp>/   (una versione)
+    data/snapshots/<profile_id>/LATEST_tf<giorni>         (puntatore atomico)
+    data/snapshots/<profile_id>/LATEST                    (ultima scritta)
+"""
+
+import ast
+import json
+import math
+import mmap
+import os
+import shutil
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from .database import BASE_DIR
+
+SNAPSHOT_DIR = BASE_DIR / "data" / "snapshots"
+KEEP_VERSIONS = 2
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+_ORDER = "<" if sys.byteorder == "little" else ">"
+
+NUMERIC_COLUMNS = {
+    "target_id": "q",
+    "campaign_id": "q",
+    "ad_group_id": "q",
+    "bid": "d",
+    "impressions": "q",
+    "clicks": "q",
+    "cost": "d",
+    "orders": "q",
+    "sales": "d",
+    "acos": "d",
+}
+STRING_COLUMNS = ("keyword_text", "match_type", "marketplace", "state", "target_type")
+# colonne restituite come stringa nel dict target (come nel resto della pipeline)
+ID_COLUMNS = ("target_id", "campaign_id", "ad_group_id")
+
+_DESCR = {"q": _ORDER + "i8", "d": _ORDER + "f8", "B": "|u1"}
+_TYPECODE = {v: k for k, v in _DESCR.items()}
+
+NAN = float("nan")
+
+
+# ------------------------
+# Formato .npy
+# ------------------------
+
+def _write_npy(path: Path, values: array) -> None:
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        _DESCR[values.typecode],
+        len(values),
+    )
+    # header allineato a 64 byte: i dati restano allineati anche in mmap
+    pad = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header_bytes = (header + " " * pad + "\n").encode("latin1")
+
+    with open(path, "wb") as f:
+        f.write(NPY_MAGIC)
+        f.write(len(header_bytes).to_bytes(2, "little"))
+        f.write(header_bytes)
+        values.tofile(f)
+
+
+def _map_npy(path: Path) -> "tuple[mmap.mmap, memoryview]":
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[: len(NPY_MAGIC)] != NPY_MAGIC:
+        mm.close()
+        raise ValueError(f"{path} non è un file .npy v1.0")
+
+    header_len = int.from_bytes(mm[8:10], "little")
+    header = ast.literal_eval(mm[10 : 10 + header_len].decode("latin1"))
+    typecode = _TYPECODE.get(header["descr"])
+    if typecode is None:
+        mm.close()
+        raise ValueError(f"{path}: dtype non supportato {header['descr']}")
+
+    data = memoryview(mm)[10 + header_len :]
+    return mm, data.cast(typecode) if typecode != "B" else data
+
+
+# ------------------------
+# Lettura
+# ------------------------
+
+class StringColumn:
+    """Colonna testuale su mmap: decodifica solo le celle lette."""
+
+    def __init__(self, offsets: memoryview, data: memoryview):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        if start == end:
+            return None
+        return bytes(self._data[start:end]).decode("utf-8")
+
+    def tolist(self) -> List[Optional[str]]:
+        """Tutta la colonna in una passata (una sola copia dei dati)."""
+        data = bytes(self._data)
+        offsets = self._offsets.tolist()
+        return [
+            data[a:b].decode("utf-8") if a != b else None
+            for a, b in zip(offsets, offsets[1:])
+        ]
+
+
+class TargetSnapshot:
+    """
+    Snapshot aperto in sola lettura. Le colonne numeriche sono memoryview
+    zero-copy sul file; i target sono ordinati per target_id.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            self.meta: Dict[str, Any] = json.load(f)
+
+        self._maps: List[mmap.mmap] = []
+        self._views: List[memoryview] = []
+        self.columns: Dict[str, Any] = {}
+
+        for name in NUMERIC_COLUMNS:
+            self.columns[name] = self._open(path / f"{name}.npy")
+        for name in STRING_COLUMNS:
+            offsets = self._open(path / f"{name}.offsets.npy")
+            data = self._open(path / f"{name}.data.npy")
+            self.columns[name] = StringColumn(offsets, data)
+
+    def _open(self, path: Path) -> memoryview:
+        mm, view = _map_npy(path)
+        self._maps.append(mm)
+        self._views.append(view)
+        return view
+
+    def __len__(self) -> int:
+        return len(self.columns["target_id"])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def __enter__(self) -> "TargetSnapshot":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    @property
+    def profile_id(self) -> str:
+        return self.meta["profile_id"]
+
+    @property
+    def created_at(self) -> str:
+        return self.meta["created_at"]
+
+    def age_seconds(self) -> float:
+        return time.time() - self.meta["created_ts"]
+
+    def index_of(self, target_id: Any) -> Optional[int]:
+        ids = self.columns["target_id"]
+        try:
+            tid = int(target_id)
+        except (TypeError, ValueError):
+            return None
+        i = bisect_left(ids, tid)
+        if i < len(ids) and ids[i] == tid:
+            return i
+        return None
+
+    def row(self, i: int) -> Dict[str, Any]:
+        """Target i nel formato di fetch_targets_for_rule / rules.engine."""
+        out: Dict[str, Any] = {"profile_id": self.meta["profile_id"]}
+        for name in NUMERIC_COLUMNS:
+            out[name] = self.columns[name][i]
+        for name in STRING_COLUMNS:
+            out[name] = self.columns[name][i]
+        for name in ID_COLUMNS:
+            out[name] = str(out[name]) if out[name] >= 0 else None
+        if math.isnan(out["acos"]):
+            out["acos"] = None
+        if math.isnan(out["bid"]):
+            out["bid"] = None
+        return out
+
+    def get(self, target_id: Any) -> Optional[Dict[str, Any]]:
+        i = self.index_of(target_id)
+        return None if i is None else self.row(i)
+
+    def close(self) -> None:
+        self.columns.clear()
+        for view in self._views:
+            view.release()
+        self._views.clear()
+        for mm in self._maps:
+            mm.close()
+        self._maps.clear()
+
+
+def _profile_dir(profile_id: Any) -> Path:
+    return SNAPSHOT_DIR / str(profile_id)
+
+
+def _read_pointer(path: Path) -> Optional[Path]:
+    try:
+        name = path.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    target = path.parent / name
+    return target if target.is_dir() else None
+
+
+def open_snapshot(profile_id: Any, timeframe_days: Optional[int] = None) -> Optional[TargetSnapshot]:
+    """
+    Apre l'ultimo snapshot del profilo (per un timeframe specifico, oppure
+    l'ultimo scritto in assoluto). None se non esiste.
+    """
+    pointer = "LATEST" if timeframe_days is None else f"LATEST_tf{timeframe_days}"
+    path = _read_pointer(_profile_dir(profile_id) / pointer)
+    if path is None:
+        return None
+    return TargetSnapshot(path)
+
+
+# ------------------------
+# Scrittura
+# ------------------------
+
+def _id_or_missing(value: Any) -> int:
+    return int(value) if value not in (None, "") else -1
+
+
+def write_snapshot(
+    profile_id: Any,
+    targets: Iterable[Dict[str, Any]],
+    timeframe_days: int,
+    extra_meta: Optional[Dict[str, Any]] = None,
+) -> Path:
+    """
+    Scrive una nuova versione dello snapshot e sposta i puntatori LATEST in
+    modo atomico: i lettori vedono sempre uno snapshot completo.
+
+    targets: dict nel formato di rules.engine (target_id, campaign_id,
+    keyword_text, match_type, marketplace, bid, acos, clicks, ...).
+    """
+    rows = sorted(targets, key=lambda t: int(t["target_id"]))
+
+    numeric = {name: array(code) for name, code in NUMERIC_COLUMNS.items()}
+    strings = {name: (array("q", [0]), bytearray()) for name in STRING_COLUMNS}
+
+    for t in rows:
+        for name in ID_COLUMNS:
+            numeric[name].append(_id_or_missing(t.get(name)))
+        for name in ("impressions", "clicks", "orders"):
+            numeric[name].append(int(t.get(name) or 0))
+        for name in ("cost", "sales"):
+            numeric[name].append(float(t.get(name) or 0.0))
+        for name in ("bid", "acos"):
+            value = t.get(name)
+            numeric[name].append(NAN if value is None else float(value))
+
+        for name, (offsets, data) in strings.items():
+            value = t.get(name)
+            if value:
+                data += str(value).encode("utf-8")
+            offsets.append(len(data))
+
+    now = time.time()
+    stamp = datetime.utcfromtimestamp(now).strftime("%Y%m%dT%H%M%S%f")
+    base = _profile_dir(profile_id)
+    version = f"tf{timeframe_days}-{stamp}-{os.getpid()}"
+    tmp = base / f".{version}.tmp"
+    final = base / version
+
+    tmp.mkdir(parents=True, exist_ok=True)
+    for name, values in numeric.items():
+        _write_npy(tmp / f"{name}.npy", values)
+    for name, (offsets, data) in strings.items():
+        _write_npy(tmp / f"{name}.offsets.npy", offsets)
+        _write_npy(tmp / f"{name}.data.npy", array("B", data))
+
+    meta = {
+        "profile_id": str(profile_id),
+        "timeframe_days": timeframe_days,
+        "rows": len(rows),
+        "created_at": datetime.utcfromtimestamp(now).isoformat(timespec="seconds") + "Z",
+        "created_ts": now,
+        "columns": list(NUMERIC_COLUMNS) + list(STRING_COLUMNS),
+        **(extra_meta or {}),
+    }
+    with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    os.replace(tmp, final)
+    for pointer in (f"LATEST_tf{timeframe_days}", "LATEST"):
+        _write_pointer(base / pointer, version)
+
+    _prune(base, timeframe_days)
+    return final
+
+
+def _write_pointer(path: Path, version: str) -> None:
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    tmp.write_text(version, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _prune(base: Path, timeframe_days: int) -> None:
+    """Tiene solo le ultime KEEP_VERSIONS versioni per timeframe."""
+    versions = sorted(
+        (p for p in base.glob(f"tf{timeframe_days}-*") if p.is_dir()),
+        key=lambda p: p.name,
+    )
+    for old in versions[:-KEEP_VERSIONS]:
+        # su Windows un lettore con mmap aperto blocca la cancellazione: riproveremo
+        shutil.rmtree(old, ignore_errors=True)
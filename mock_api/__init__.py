@@ -0,0 +1,4 @@
+# mock_api/__init__.py
+
+from .accounts import AccountConfig, SyntheticAccount
+from .server import MockAdsServer, ServerBehaviour
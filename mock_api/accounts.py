@@ -0,0 +1,293 @@
+# mock_api/accounts.py
+
+"""
+Generazione di account Amazon Ads sintetici per il mock server.
+
+Tutto è deterministico e calcolato "al volo" a partire dagli indici:
+nessuna lista di target viene tenuta in memoria, così si possono simulare
+account con milioni di target senza pagare RAM per ognuno.
+"""
+
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+PROFILE_ID_BASE = 1_000_000_000
+CAMPAIGN_ID_BASE = 300_000_000_000
+AD_GROUP_ID_BASE = 350_000_000_000
+TARGET_ID_BASE = 400_000_000_000
+
+MARKETPLACES = {
+    "US": ("USD", "America/Los_Angeles", "ATVPDKIKX0DER"),
+    "IT": ("EUR", "Europe/Rome", "APJ6JRA9NG5V4"),
+    "DE": ("EUR", "Europe/Berlin", "A1PA6795UKMFR9"),
+    "FR": ("EUR", "Europe/Paris", "A13V1IB3VIYZZH"),
+    "ES": ("EUR", "Europe/Madrid", "A1RKKUPIHCS9HS"),
+    "UK": ("GBP", "Europe/London", "A1F83G8C2ARO7P"),
+}
+
+MATCH_TYPES = ("EXACT", "PHRASE", "BROAD")
+WORDS = (
+    "organic", "coffee", "mug", "yoga", "mat", "kids", "book", "water",
+    "bottle", "steel", "garden", "tool", "phone", "case", "gift", "set",
+    "dog", "toy", "led", "lamp", "kitchen", "knife", "travel", "bag",
+)
+
+
+def mix(value: int) -> int:
+    """Hash intero veloce (splitmix64): pseudo-casuale ma deterministico."""
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+def unit(value: int) -> float:
+    """Numero in [0, 1) derivato da un intero."""
+    return (mix(value) >> 11) / float(1 << 53)
+
+
+@dataclass
+class AccountConfig:
+    """Dimensioni dell'account sintetico."""
+
+    marketplaces: List[str] = field(default_factory=lambda: ["US"])
+    campaigns_per_profile: int = 10
+    targets_per_campaign: int = 100
+    seed: int = 42
+
+    @property
+    def targets_per_profile(self) -> int:
+        return self.campaigns_per_profile * self.targets_per_campaign
+
+
+class SyntheticAccount:
+    """
+    Account finto: profili, campagne, target e metriche report.
+
+    Gli unici dati mutabili sono i bid aggiornati tramite update/targets,
+    salvati in un dict {targetId: bid}.
+    """
+
+    def __init__(self, config: AccountConfig):
+        self.config = config
+        self.bid_overrides: Dict[int, float] = {}
+
+    # ------------------------
+    # Profili
+    # ------------------------
+
+    def profiles(self) -> List[Dict[str, Any]]:
+        out = []
+        for idx, country in enumerate(self.config.marketplaces):
+            currency, timezone, marketplace_id = MARKETPLACES.get(
+                country, ("USD", "America/Los_Angeles", "ATVPDKIKX0DER")
+            )
+            out.append(
+                {
+                    "profileId": PROFILE_ID_BASE + idx,
+                    "countryCode": country,
+                    "currencyCode": currency,
+                    "timezone": timezone,
+                    "accountInfo": {
+                        "marketplaceStringId": marketplace_id,
+                        "id": f"MOCKSELLER{idx}",
+                        "type": "seller",
+                        "name": f"Mock seller {country}",
+                    },
+                }
+            )
+        return out
+
+    def profile_index(self, profile_id: Any) -> Optional[int]:
+        try:
+            idx = int(profile_id) - PROFILE_ID_BASE
+        except (TypeError, ValueError):
+            return None
+        if 0 <= idx < len(self.config.marketplaces):
+            return idx
+        return None
+
+    # ------------------------
+    # Campagne
+    # ------------------------
+
+    def campaign_id(self, profile_idx: int, camp_idx: int) -> int:
+        return CAMPAIGN_ID_BASE + profile_idx * self.config.campaigns_per_profile + camp_idx
+
+    def campaign_index(self, profile_idx: int, campaign_id: Any) -> Optional[int]:
+        try:
+            idx = int(campaign_id) - CAMPAIGN_ID_BASE - profile_idx * self.config.campaigns_per_profile
+        except (TypeError, ValueError):
+            return None
+        if 0 <= idx < self.config.campaigns_per_profile:
+            return idx
+        return None
+
+    def campaign(self, profile_idx: int, camp_idx: int) -> Dict[str, Any]:
+        cid = self.campaign_id(profile_idx, camp_idx)
+        h = mix(cid ^ self.config.seed)
+        return {
+            "campaignId": str(cid),
+            "name": f"SP {WORDS[h % len(WORDS)]} {camp_idx:05d}",
+            "state": "ENABLED" if h % 10 else "PAUSED",
+            "targetingType": "MANUAL",
+            "budget": {"budgetType": "DAILY", "budget": float(10 + h % 90)},
+            "tags": {"ASIN": f"B0MOCK{cid % 100000:05d}"},
+        }
+
+    # ------------------------
+    # Target
+    # ------------------------
+
+    def target_id(self, profile_idx: int, camp_idx: int, idx: int) -> int:
+        camp_global = profile_idx * self.config.campaigns_per_profile + camp_idx
+        return TARGET_ID_BASE + camp_global * self.config.targets_per_campaign + idx
+
+    def locate_target(self, target_id: Any) -> Optional[Tuple[int, int, int]]:
+        """targetId -> (profile_idx, camp_idx, idx) oppure None se non esiste."""
+        try:
+            offset = int(target_id) - TARGET_ID_BASE
+        except (TypeError, ValueError):
+            return None
+        if offset < 0:
+            return None
+        camp_global, idx = divmod(offset, self.config.targets_per_campaign)
+        profile_idx, camp_idx = divmod(camp_global, self.config.campaigns_per_profile)
+        if profile_idx >= len(self.config.marketplaces):
+            return None
+        return profile_idx, camp_idx, idx
+
+    def base_bid(self, target_id: int) -> float:
+        return round(0.2 + unit(target_id ^ self.config.seed) * 1.8, 2)
+
+    def target(self, profile_idx: int, camp_idx: int, idx: int) -> Dict[str, Any]:
+        tid = self.target_id(profile_idx, camp_idx, idx)
+        cid = self.campaign_id(profile_idx, camp_idx)
+        h = mix(tid ^ self.config.seed)
+        bid = self.bid_overrides.get(tid)
+        if bid is None:
+            bid = self.base_bid(tid)
+
+        # ~80% keyword, ~20% product/auto target
+        if h % 5:
+            words = (WORDS[h % 24], WORDS[(h >> 8) % 24], WORDS[(h >> 16) % 24])
+            details = {
+                "keywordTarget": {
+                    "keyword": " ".join(words[: 1 + (h >> 24) % 3]),
+                    "matchType": MATCH_TYPES[(h >> 32) % 3],
+                }
+            }
+            target_type = "KEYWORD"
+        else:
+            details = {"productTarget": {"matchType": "PRODUCT_EXACT", "product": {"productId": f"B0{h % 10**8:08d}"}}}
+            target_type = "PRODUCT"
+
+        return {
+            "targetId": str(tid),
+            "campaignId": str(cid),
+            "adGroupId": str(AD_GROUP_ID_BASE + cid - CAMPAIGN_ID_BASE),
+            "adProduct": "SPONSORED_PRODUCTS",
+            "targetType": target_type,
+            "state": "ENABLED" if h % 17 else "PAUSED",
+            "bid": {"bid": bid, "currencyCode": self.currency(profile_idx)},
+            "targetDetails": details,
+        }
+
+    def _campaign_idxs(self, profile_idx: int, campaign_ids: Optional[List[Any]]) -> Sequence[int]:
+        if campaign_ids:
+            return sorted(
+                {
+                    ci
+                    for ci in (self.campaign_index(profile_idx, c) for c in campaign_ids)
+                    if ci is not None
+                }
+            )
+        return range(self.config.campaigns_per_profile)
+
+    def iter_target_positions(
+        self,
+        profile_idx: int,
+        campaign_ids: Optional[List[Any]] = None,
+    ) -> Iterator[Tuple[int, int]]:
+        """(camp_idx, idx) di tutti i target del profilo, eventualmente filtrati per campagna."""
+        for camp_idx in self._campaign_idxs(profile_idx, campaign_ids):
+            for idx in range(self.config.targets_per_campaign):
+                yield camp_idx, idx
+
+    def target_positions(
+        self,
+        profile_idx: int,
+        campaign_ids: Optional[List[Any]] = None,
+        start: int = 0,
+        stop: Optional[int] = None,
+    ) -> List[Tuple[int, int]]:
+        """
+        iter_target_positions()[start:stop] calcolato per indice: una pagina
+        costa quanto la sua dimensione, non quanto l'offset.
+        """
+        camp_idxs = self._campaign_idxs(profile_idx, campaign_ids)
+        per_campaign = self.config.targets_per_campaign
+        total = len(camp_idxs) * per_campaign
+        stop = total if stop is None else min(stop, total)
+        return [
+            (camp_idxs[pos // per_campaign], pos % per_campaign)
+            for pos in range(max(start, 0), stop)
+        ]
+
+    def currency(self, profile_idx: int) -> str:
+        country = self.config.marketplaces[profile_idx]
+        return MARKETPLACES.get(country, ("USD",))[0]
+
+    # ------------------------
+    # Metriche report
+    # ------------------------
+
+    def report_row(self, profile_idx: int, camp_idx: int, idx: int, days: int) -> Dict[str, Any]:
+        """Riga report spTargeting (nomi colonne v3) per il periodo richiesto."""
+        tid = self.target_id(profile_idx, camp_idx, idx)
+        cid = self.campaign_id(profile_idx, camp_idx)
+        h = mix(tid ^ (self.config.seed << 1))
+
+        # distribuzione a coda lunga: pochi target con molto traffico
+        traffic = unit(h) ** 3
+        impressions = int(traffic * 400 * days)
+        clicks = int(impressions * (0.002 + unit(h >> 7) * 0.02))
+        cpc = 0.2 + unit(h >> 13) * 1.5
+        cost = round(clicks * cpc, 2)
+        purchases = int(clicks * unit(h >> 19) * 0.2)
+        sales = round(purchases * (8 + unit(h >> 23) * 40), 2)
+
+        return {
+            "campaignId": cid,
+            "adGroupId": AD_GROUP_ID_BASE + cid - CAMPAIGN_ID_BASE,
+            "targetId": tid,
+            "impressions": impressions,
+            "clicks": clicks,
+            "cost": cost,
+            "purchases14d": purchases,
+            "sales14d": sales,
+        }
+
+    def report_row_daily(self, profile_idx: int, camp_idx: int, idx: int, day: date) -> Dict[str, Any]:
+        """Riga report con timeUnit DAILY: stesso target, rumore diverso per giorno."""
+        row = self.report_row(profile_idx, camp_idx, idx, 1)
+        h = mix(row["targetId"] ^ (day.toordinal() << 20) ^ self.config.seed)
+
+        # il traffico giornaliero oscilla tra 0x e 2x la media del target
+        factor = unit(h) * 2
+        impressions = int(row["impressions"] * factor + unit(h >> 3))
+        clicks = min(impressions, int(row["clicks"] * factor + unit(h >> 5)))
+        cpc = row["cost"] / row["clicks"] if row["clicks"] else 0.2 + unit(h >> 9) * 1.5
+        purchases = int(clicks * unit(h >> 13) * 0.4)
+        aov = row["sales14d"] / row["purchases14d"] if row["purchases14d"] else 8 + unit(h >> 17) * 40
+
+        row.update(
+            date=day.isoformat(),
+            impressions=impressions,
+            clicks=clicks,
+            cost=round(clicks * cpc, 2),
+            purchases14d=purchases,
+            sales14d=round(purchases * aov, 2),
+        )
+        return row
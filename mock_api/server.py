@@ -0,0 +1,516 @@
+# mock_api/server.py
+
+"""
+Mock locale delle Amazon Ads API, per test di carico offline.
+
+Endpoint simulati:
+    POST /auth/o2/token
+    GET  /v2/profiles
+    POST /sp/campaigns/list
+    POST /adsApi/v1/query/targets
+    POST /adsApi/v1/update/targets
+    POST /reporting/reports
+    GET  /reporting/reports/{reportId}
+    GET  /reports/{reportId}/download      (GZIP, una riga JSON per target; per target
+                                            e giorno con timeUnit DAILY)
+    GET  /mock/stats                       (contatori richieste, solo mock)
+
+I report scadono report_ttl secondi dopo la creazione (poi 404, come un URL
+di download scaduto); il payload non resta in memoria dopo il download.
+
+Avvio:
+    python -m mock_api.server --campaigns 1000 --targets-per-campaign 1000
+
+Poi nel .env (o nell'ambiente) del processo da testare:
+    AMAZON_ADS_API_BASE_URL=http://127.0.0.1:8765
+    AMAZON_ADS_TOKEN_URL=http://127.0.0.1:8765/auth/o2/token
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from .accounts import AccountConfig, SyntheticAccount
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+REPORT_STATUS_RE = re.compile(r"^/reporting/reports/([\w-]+)$")
+REPORT_DOWNLOAD_RE = re.compile(r"^/reports/([\w-]+)/download$")
+
+
+@dataclass
+class ServerBehaviour:
+    """Comportamento "di rete" del mock: latenza, throttling, tempi dei report."""
+
+    latency_ms: float = 0.0             # latenza media per richiesta (jitter ±50%)
+    rate_limit: float = 0.0             # richieste/secondo ammesse, 0 = nessun limite
+    burst: int = 10                     # dimensione del token bucket
+    throttle_probability: float = 0.0   # 429 casuali, oltre al rate limit
+    report_delay: float = 2.0           # secondi prima che un report sia SUCCESS
+    report_ttl: float = 3600.0          # secondi dopo i quali un report (e il suo URL) scade
+    token_ttl: int = 3600               # durata degli access token emessi
+    max_page_size: int = 1000           # maxResults massimo per le list/query
+    max_update_batch: int = 0           # target massimi per update, 0 = nessun limite
+
+
+class MockState:
+    """Stato condiviso tra i thread del server."""
+
+    def __init__(self, account: SyntheticAccount, behaviour: ServerBehaviour):
+        self.account = account
+        self.behaviour = behaviour
+        self.lock = threading.Lock()
+        self.reports: Dict[str, Dict[str, Any]] = {}
+        self.tokens: Dict[str, float] = {}
+        self.stats: Dict[str, int] = {}
+        self._counter = itertools.count(1)
+        self._bucket = float(behaviour.burst)
+        self._bucket_ts = time.monotonic()
+        self._rng = random.Random(account.config.seed)
+
+    def next_id(self) -> int:
+        with self.lock:
+            return next(self._counter)
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def throttled(self) -> bool:
+        b = self.behaviour
+        with self.lock:
+            if b.throttle_probability and self._rng.random() < b.throttle_probability:
+                return True
+            if b.rate_limit <= 0:
+                return False
+            now = time.monotonic()
+            self._bucket = min(
+                float(b.burst), self._bucket + (now - self._bucket_ts) * b.rate_limit
+            )
+            self._bucket_ts = now
+            if self._bucket < 1.0:
+                return True
+            self._bucket -= 1.0
+            return False
+
+    def purge_reports(self) -> int:
+        """Elimina i report creati da più di report_ttl secondi. Restituisce quanti."""
+        cutoff = time.monotonic() - self.behaviour.report_ttl
+        with self.lock:
+            expired = [rid for rid, r in self.reports.items() if r["created"] < cutoff]
+            for rid in expired:
+                del self.reports[rid]
+        return len(expired)
+
+    def latency(self) -> float:
+        ms = self.behaviour.latency_ms
+        if ms <= 0:
+            return 0.0
+        with self.lock:
+            return ms * (0.5 + self._rng.random()) / 1000.0
+
+
+class MockAdsHandler(BaseHTTPRequestHandler):
+    server_version = "AgentSPMockAds/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self) -> MockState:
+        return self.server.state  # type: ignore[attr-defined]
+
+    # evita una riga di log su stderr per ogni richiesta
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:  # type: ignore[attr-defined]
+            super().log_message(format, *args)
+
+    # ------------------------
+    # Helper risposta
+    # ------------------------
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status: int, data: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json", headers)
+
+    def _error(self, status: int, code: str, details: str) -> None:
+        self._json(status, {"code": code, "details": details})
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+
+    def _profile_idx(self) -> Optional[int]:
+        pid = self.headers.get("Amazon-Ads-CustomerId") or self.headers.get(
+            "Amazon-Advertising-API-Scope"
+        )
+        return self.state.account.profile_index(pid)
+
+    def _check_auth(self) -> bool:
+        auth = self.headers.get("Authorization") or ""
+        if not auth.startswith("Bearer ") or not auth[7:].strip():
+            self._error(401, "UNAUTHORIZED", "Missing bearer token")
+            return False
+
+        token = auth[7:].strip()
+        expires_at = self.state.tokens.get(token)
+        if expires_at is not None and time.time() >= expires_at:
+            self._error(401, "UNAUTHORIZED", "Access token expired")
+            return False
+        return True
+
+    def _pre(self, key: str) -> bool:
+        """Latenza + throttling comuni; False se la richiesta è già stata risposta."""
+        self.state.count(key)
+        delay = self.state.latency()
+        if delay:
+            time.sleep(delay)
+        if self.state.throttled():
+            self.state.count("throttled")
+            self._json(429, {"code": "THROTTLED", "details": "Too many requests"}, {"Retry-After": "1"})
+            return False
+        return True
+
+    @staticmethod
+    def _page(body: Dict[str, Any], limit: int) -> Tuple[int, int]:
+        offset = int(body.get("nextToken") or 0)
+        size = min(int(body.get("maxResults") or limit), limit)
+        return offset, max(size, 1)
+
+    def _base_url(self) -> str:
+        host = self.headers.get("Host") or "%s:%s" % self.server.server_address[:2]
+        return f"http://{host}"
+
+    # ------------------------
+    # Routing
+    # ------------------------
+
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+
+        if path == "/mock/stats":
+            with self.state.lock:
+                stats = dict(self.state.stats)
+            return self._json(200, stats)
+
+        if path == "/v2/profiles":
+            if self._pre("profiles") and self._check_auth():
+                self._json(200, self.state.account.profiles())
+            return
+
+        m = REPORT_STATUS_RE.match(path)
+        if m:
+            if self._pre("report_status") and self._check_auth():
+                self._report_status(m.group(1))
+            return
+
+        m = REPORT_DOWNLOAD_RE.match(path)
+        if m:
+            # l'URL di download è pre-firmato (S3): niente auth né throttling
+            self.state.count("report_download")
+            return self._report_download(m.group(1))
+
+        self._error(404, "NOT_FOUND", path)
+
+    def do_POST(self) -> None:
+        path = urlparse(self.path).path
+        # il body va sempre consumato, anche se si risponde con errore (keep-alive)
+        raw = self._body()
+
+        if path == "/auth/o2/token":
+            self.state.count("token")
+            return self._token(raw)
+
+        routes = {
+            "/sp/campaigns/list": ("campaigns_list", self._campaigns_list),
+            "/adsApi/v1/query/targets": ("targets_query", self._targets_query),
+            "/adsApi/v1/update/targets": ("targets_update", self._targets_update),
+            "/reporting/reports": ("report_create", self._report_create),
+        }
+        route = routes.get(path)
+        if route is None:
+            return self._error(404, "NOT_FOUND", path)
+
+        key, handler = route
+        if not self._pre(key) or not self._check_auth():
+            return
+
+        profile_idx = self._profile_idx()
+        if profile_idx is None:
+            return self._error(400, "INVALID_ARGUMENT", "Unknown profile scope")
+
+        try:
+            body = json.loads(raw.decode("utf-8")) if raw else {}
+        except ValueError:
+            return self._error(400, "INVALID_ARGUMENT", "Malformed JSON body")
+
+        handler(profile_idx, body)
+
+    # ------------------------
+    # Endpoint
+    # ------------------------
+
+    def _token(self, raw: bytes) -> None:
+        form = {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+        grant = form.get("grant_type")
+        if grant not in ("authorization_code", "refresh_token"):
+            return self._json(400, {"error": "unsupported_grant_type"})
+
+        n = self.state.next_id()
+        token = f"mock-access-{n}"
+        ttl = self.state.behaviour.token_ttl
+        with self.state.lock:
+            self.state.tokens[token] = time.time() + ttl
+
+        self._json(
+            200,
+            {
+                "access_token": token,
+                "refresh_token": form.get("refresh_token") or f"mock-refresh-{n}",
+                "token_type": "bearer",
+                "expires_in": ttl,
+            },
+        )
+
+    def _campaigns_list(self, profile_idx: int, body: Dict[str, Any]) -> None:
+        account = self.state.account
+        total = account.config.campaigns_per_profile
+        offset, size = self._page(body, self.state.behaviour.max_page_size)
+
+        camps = [account.campaign(profile_idx, i) for i in range(offset, min(offset + size, total))]
+        data: Dict[str, Any] = {"campaigns": camps, "totalResults": total}
+        if offset + size < total:
+            data["nextToken"] = str(offset + size)
+        self._json(200, data)
+
+    def _targets_query(self, profile_idx: int, body: Dict[str, Any]) -> None:
+        account = self.state.account
+        campaign_ids = (body.get("campaignIdFilter") or {}).get("include")
+        offset, size = self._page(body, self.state.behaviour.max_page_size)
+
+        # una riga in più per sapere se c'è una pagina successiva
+        page = account.target_positions(profile_idx, campaign_ids, offset, offset + size + 1)
+
+        data: Dict[str, Any] = {
+            "targets": [account.target(profile_idx, c, i) for c, i in page[:size]]
+        }
+        if len(page) > size:
+            data["nextToken"] = str(offset + size)
+        self._json(200, data)
+
+    def _targets_update(self, profile_idx: int, body: Dict[str, Any]) -> None:
+        account = self.state.account
+        updates = body.get("targets") or []
+        limit = self.state.behaviour.max_update_batch
+        if limit and len(updates) > limit:
+            return self._error(400, "INVALID_ARGUMENT", f"Max {limit} targets per request")
+
+        success, errors = [], []
+        with self.state.lock:
+            for index, u in enumerate(updates):
+                loc = account.locate_target(u.get("targetId"))
+                bid = (u.get("bid") or {}).get("bid")
+                if loc is None or loc[0] != profile_idx:
+                    errors.append({"index": index, "code": "NOT_FOUND"})
+                    continue
+                if not isinstance(bid, (int, float)) or bid < 0.02:
+                    errors.append({"index": index, "code": "INVALID_ARGUMENT"})
+                    continue
+                account.bid_overrides[int(u["targetId"])] = float(bid)
+                success.append({"index": index, "targetId": str(u["targetId"])})
+
+        self._json(207 if errors else 200, {"success": success, "error": errors})
+
+    def _report_create(self, profile_idx: int, body: Dict[str, Any]) -> None:
+        try:
+            start = date.fromisoformat(body["startDate"])
+            end = date.fromisoformat(body["endDate"])
+        except (KeyError, ValueError):
+            return self._error(400, "INVALID_ARGUMENT", "startDate/endDate richiesti")
+
+        configuration = body.get("configuration") or {}
+        campaign_ids = None
+        for f in configuration.get("filters") or []:
+            if f.get("field") == "campaignId":
+                campaign_ids = f.get("values")
+
+        self.state.purge_reports()
+        report_id = f"mock-report-{self.state.next_id()}"
+        with self.state.lock:
+            self.state.reports[report_id] = {
+                "profile_idx": profile_idx,
+                "created": time.monotonic(),
+                "days": max((end - start).days + 1, 1),
+                "start": start,
+                "daily": configuration.get("timeUnit") == "DAILY",
+                "campaign_ids": campaign_ids,
+            }
+        self._json(200, {"reportId": report_id, "status": "PENDING"})
+
+    def _report_status(self, report_id: str) -> None:
+        report = self.state.reports.get(report_id)
+        if report is None:
+            return self._error(404, "NOT_FOUND", report_id)
+
+        elapsed = time.monotonic() - report["created"]
+        delay = self.state.behaviour.report_delay
+        if elapsed < delay / 2:
+            status = "PENDING"
+        elif elapsed < delay:
+            status = "PROCESSING"
+        else:
+            # il client si aspetta SUCCESS + 'location'; il v3 reale usa 'url'
+            status = "SUCCESS"
+
+        data: Dict[str, Any] = {"reportId": report_id, "status": status}
+        if status == "SUCCESS":
+            url = f"{self._base_url()}/reports/{report_id}/download"
+            data.update({"url": url, "location": url})
+        self._json(200, data)
+
+    def _report_download(self, report_id: str) -> None:
+        report = self.state.reports.get(report_id)
+        if report is None:
+            return self._error(404, "NOT_FOUND", report_id)
+
+        # payload non conservato: deterministico, un secondo download lo ricostruisce
+        payload = build_report_payload(self.state.account, report)
+        self._send(200, payload, "application/octet-stream")
+
+
+def build_report_payload(account: SyntheticAccount, report: Dict[str, Any]) -> bytes:
+    """GZIP di righe JSON, come si aspetta download_report_gzip_json."""
+    profile_idx = report["profile_idx"]
+    days = report["days"]
+    if report.get("daily"):
+        # timeUnit DAILY: una riga per target e per giorno, con colonna "date"
+        dates = [report["start"] + timedelta(days=d) for d in range(days)]
+        lines = (
+            json.dumps(account.report_row_daily(profile_idx, c, i, day))
+            for day in dates
+            for c, i in account.iter_target_positions(profile_idx, report["campaign_ids"])
+        )
+    else:
+        lines = (
+            json.dumps(account.report_row(profile_idx, c, i, days))
+            for c, i in account.iter_target_positions(profile_idx, report["campaign_ids"])
+        )
+    raw = "\n".join(lines).encode("utf-8")
+    return gzip.compress(raw, compresslevel=1)
+
+
+class MockAdsServer:
+    """
+    Server HTTP multi-thread. Usabile da riga di comando o in-process:
+
+        server = MockAdsServer(AccountConfig(...), ServerBehaviour(...)).start()
+        ...
+        server.stop()
+    """
+
+    def __init__(
+        self,
+        config: Optional[AccountConfig] = None,
+        behaviour: Optional[ServerBehaviour] = None,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        verbose: bool = False,
+    ):
+        self.state = MockState(SyntheticAccount(config or AccountConfig()), behaviour or ServerBehaviour())
+        self.httpd = ThreadingHTTPServer((host, port), MockAdsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state  # type: ignore[attr-defined]
+        self.httpd.verbose = verbose  # type: ignore[attr-defined]
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockAdsServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def serve_forever(self) -> None:
+        self.httpd.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock locale delle Amazon Ads API")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--marketplaces", default="US", help="es. US,IT,DE (un profilo ciascuno)")
+    parser.add_argument("--campaigns", type=int, default=10, help="campagne per profilo")
+    parser.add_argument("--targets-per-campaign", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="richieste/s, 0 = illimitate")
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--throttle-probability", type=float, default=0.0)
+    parser.add_argument("--report-delay", type=float, default=2.0, help="secondi")
+    parser.add_argument("--report-ttl", type=float, default=3600.0, help="secondi prima che un report scada")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="secondi")
+    parser.add_argument("--max-page-size", type=int, default=1000)
+    parser.add_argument("--max-update-batch", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    config = AccountConfig(
+        marketplaces=[m.strip().upper() for m in args.marketplaces.split(",") if m.strip()],
+        campaigns_per_profile=args.campaigns,
+        targets_per_campaign=args.targets_per_campaign,
+        seed=args.seed,
+    )
+    behaviour = ServerBehaviour(
+        latency_ms=args.latency_ms,
+        rate_limit=args.rate_limit,
+        burst=args.burst,
+        throttle_probability=args.throttle_probability,
+        report_delay=args.report_delay,
+        report_ttl=args.report_ttl,
+        token_ttl=args.token_ttl,
+        max_page_size=args.max_page_size,
+        max_update_batch=args.max_update_batch,
+    )
+
+    server = MockAdsServer(config, behaviour, args.host, args.port, args.verbose)
+    print(
+        f"[MOCK] Amazon Ads mock su {server.url} — "
+        f"{len(config.marketplaces)} profili x {config.targets_per_profile} target"
+    )
+    print(f"[MOCK] AMAZON_ADS_API_BASE_URL={server.url}")
+    print(f"[MOCK] AMAZON_ADS_TOKEN_URL={server.url}/auth/o2/token")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[MOCK] Arresto.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,36 @@
+from pathlib import Path
+
 import streamlit as st
 
+from amazon_api.profiles import load_profile_registry
 from db.database import (
     init_db,
     get_all_rules,
     create_rule,
     delete_rule,
     set_rule_enabled,
+    get_execution_run_times,
+    get_rule_analysis,
+    get_conflict_policy,
+    set_conflict_policy,
+    update_rule,
+    get_guardrails,
+    set_guardrail,
+    delete_guardrail,
+    load_guardrail_index,
+    load_bid_state_index,
+    get_recent_runs,
+    get_rule_runs,
+    get_execution_log_detail,
+    set_execution_log_detail,
 )
+from db.snapshot import TargetSnapshot, open_snapshot
+from rules.batch import TargetColumns, simulate_rules
+from rules.conflicts import FIRST_MATCH, POLICIES, SEQUENTIAL, resolution_order
+from rules.conditions import METRIC_LABELS, METRIC_RULE_TYPE, METRICS, describe_conditions
+from rules.expressions import EXPRESSION_RULE_TYPE, compile_expression
+from rules.guardrails import DEFAULT_MIN_BID, SCOPES
+from scheduler.simulation import history_columns
 
 # Inizializza DB (idempotente)
 init_db()
@@ -33,6 +57,10 @@ def format_rule_type(rt: str) -> str:
         return "ACOS band"
     if rt == "LOW_TRAFFIC":
         return "Low traffic"
+    if rt == METRIC_RULE_TYPE:
+        return "Metriche"
+    if rt == EXPRESSION_RULE_TYPE:
+        return "Espressione"
     return rt
 
 
@@ -54,6 +82,10 @@ def format_conditions(r: dict) -> str:
         if cmax is not None:
             return f"Click < {int(cmax)}"
         return "-"
+    if r["rule_type"] == METRIC_RULE_TYPE:
+        return describe_conditions(r.get("conditions"))
+    if r["rule_type"] == EXPRESSION_RULE_TYPE:
+        return r.get("expression") or "-"
     return "-"
 
 
@@ -75,11 +107,37 @@ st.subheader("Crea nuova regola")
 # Selezione tipo regola fuori dalla form per permettere il rerender immediato dei campi condizione
 rule_type = st.selectbox(
     "Tipo regola",
-    options=["ACOS_BAND", "LOW_TRAFFIC"],
+    options=["ACOS_BAND", "LOW_TRAFFIC", METRIC_RULE_TYPE, EXPRESSION_RULE_TYPE],
     format_func=format_rule_type,
     key="rule_type_select",
 )
 
+condition_metrics = []
+if rule_type == METRIC_RULE_TYPE:
+    condition_metrics = st.multiselect(
+        "Metriche della condizione (tutte devono essere soddisfatte)",
+        options=list(METRICS),
+        default=["cpc"],
+        format_func=METRIC_LABELS.get,
+        key="metric_select",
+        help="Esempio spesa senza ordini: Spesa minimo 10, Ordini massimo 0.",
+    )
+
+expression = None
+if rule_type == EXPRESSION_RULE_TYPE:
+    # fuori dalla form: la validazione si aggiorna a ogni modifica
+    expression = st.text_area(
+        "Espressione",
+        value="clicks >= 20 and orders == 0 and cost > 10",
+        key="rule_expression",
+        help="Metriche: " + ", ".join(METRICS) + ". Operatori: + - * /, confronti, and, or, not.",
+    )
+    try:
+        compiled = compile_expression(expression)
+        st.caption(f"Espressione valida: `{compiled.normalized}`")
+    except ValueError as exc:
+        st.error(f"Espressione non valida: {exc}")
+
 with st.form("create_rule_form"):
     col1, col2, col3 = st.columns(3)
 
@@ -122,6 +180,29 @@ with st.form("create_rule_form"):
             format="%.2f",
         )
 
+        priority = st.number_input(
+            "Priorità (minore = applicata prima)",
+            value=100,
+            step=1,
+            min_value=0,
+        )
+
+        cooldown_hours = st.number_input(
+            "Cooldown per target (ore, 0 = nessuno)",
+            value=0,
+            step=12,
+            min_value=0,
+            help="Non modificare un target cambiato da meno di queste ore",
+        )
+        hysteresis_pct = st.number_input(
+            "Isteresi (%)",
+            value=0.0,
+            step=5.0,
+            min_value=0.0,
+            max_value=99.0,
+            help="Per invertire l'ultima modifica di un target la soglia attraversata si stringe di questo margine",
+        )
+
         enabled = st.checkbox("Regola attiva", value=True)
 
     st.markdown("### Condizioni logiche")
@@ -132,6 +213,7 @@ with st.form("create_rule_form"):
     acos_max = None
     clicks_min = None
     clicks_max = None
+    conditions = []
 
     with colc1:
         if rule_type == "ACOS_BAND":
@@ -162,6 +244,15 @@ with st.form("create_rule_form"):
             acos_min = None
             acos_max = None
 
+        elif rule_type == METRIC_RULE_TYPE:
+            for metric in condition_metrics:
+                label = METRIC_LABELS[metric]
+                m1, m2 = st.columns(2)
+                # vuoto = nessun limite su quel lato
+                lo = m1.number_input(f"{label} minimo", value=None, step=0.01, key=f"cond_min_{metric}")
+                hi = m2.number_input(f"{label} massimo", value=None, step=0.01, key=f"cond_max_{metric}")
+                conditions.append({"metric": metric, "min": lo, "max": hi})
+
     submit = st.form_submit_button("Crea regola")
 
     if submit:
@@ -177,16 +268,25 @@ with st.form("create_rule_form"):
             "acos_max": acos_max,
             "clicks_min": clicks_min,
             "clicks_max": clicks_max,
+            "conditions": conditions or None,
+            "expression": expression,
             "adjustment_type": adjustment_type,
             "adjustment_value": float(adjustment_value),
             "timeframe_days": timeframe_days,
             "frequency_days": int(frequency_days),
             "enabled": 1 if enabled else 0,
+            "priority": int(priority),
+            "cooldown_hours": float(cooldown_hours) or None,
+            "hysteresis_pct": float(hysteresis_pct) or None,
         }
 
-        rule_id = create_rule(data)
-        st.success(f"Regola creata con ID: {rule_id}")
-        do_rerun()
+        try:
+            rule_id = create_rule(data)
+        except ValueError as exc:
+            st.error(f"Regola non valida: {exc}")
+        else:
+            st.success(f"Regola creata con ID: {rule_id}")
+            do_rerun()
 
 st.markdown("---")
 
@@ -226,6 +326,10 @@ else:
         )
 
         cond_str = format_conditions(r)
+        if r.get("cooldown_hours"):
+            cond_str += f" · cooldown {r['cooldown_hours']:g}h"
+        if r.get("hysteresis_pct"):
+            cond_str += f" · isteresi {r['hysteresis_pct']:g}%"
 
         with cols[0]:
             st.write(rule_id)
@@ -257,3 +361,318 @@ else:
             if st.button("Elimina", key=f"delete_{rule_id}"):
                 delete_rule(rule_id)
                 do_rerun()
+
+st.markdown("---")
+
+st.subheader("Sovrapposizioni e ordine di applicazione")
+
+POLICY_LABELS = {
+    SEQUENTIAL: "In sequenza: le variazioni di regole sovrapposte si sommano",
+    FIRST_MATCH: "Prima regola: un target viene modificato solo dalla prima regola in ordine",
+}
+
+
+def render_conflicts(all_rules: list) -> None:
+    current_policy = get_conflict_policy()
+    policy = st.radio(
+        "Regole sovrapposte nello stesso run",
+        options=list(POLICIES),
+        index=list(POLICIES).index(current_policy),
+        format_func=POLICY_LABELS.get,
+        key="conflict_policy",
+    )
+    if policy != current_policy:
+        set_conflict_policy(policy)
+
+    analysis = get_rule_analysis()
+    names = {r["id"]: r["name"] for r in all_rules}
+    if analysis.order:
+        st.caption(
+            "Ordine di applicazione (priorità, poi ID): "
+            + " → ".join(f"{rid} {names.get(rid, '')}" for rid in analysis.order)
+        )
+
+    if not analysis.overlaps:
+        st.success("Nessuna sovrapposizione tra le regole attive.")
+    else:
+        for o in analysis.overlaps:
+            message = o.describe()
+            if o.opposite:
+                st.error(message)
+            else:
+                st.warning(message)
+
+    if all_rules:
+        c1, c2, c3 = st.columns([3, 2, 1])
+        rid = c1.selectbox(
+            "Regola",
+            options=[r["id"] for r in all_rules],
+            format_func=lambda x: f"{x} — {names.get(x, '')}",
+            key="priority_rule",
+        )
+        current = next(r for r in all_rules if r["id"] == rid).get("priority")
+        new_priority = c2.number_input(
+            "Priorità",
+            value=int(current if current is not None else 100),
+            step=1,
+            min_value=0,
+            key=f"priority_{rid}",
+        )
+        if c3.button("Aggiorna priorità", key="priority_save"):
+            update_rule(rid, {"priority": int(new_priority)})
+            do_rerun()
+
+
+render_conflicts(rules)
+
+st.markdown("---")
+
+st.subheader("Limiti bid")
+st.caption(
+    "Bid minimo/massimo e variazione massima al giorno, per profilo, campagna o "
+    "target: vale il livello più specifico che definisce il limite. Senza limiti "
+    f"il bid minimo è {DEFAULT_MIN_BID:.2f}."
+)
+
+SCOPE_LABELS = {
+    "GLOBAL": "Tutti i target",
+    "PROFILE": "Profilo",
+    "CAMPAIGN": "Campagna",
+    "TARGET": "Target",
+}
+
+
+def render_guardrails() -> None:
+    guardrails = get_guardrails()
+    if guardrails:
+        for g in guardrails:
+            c1, c2, c3, c4, c5, c6 = st.columns([2, 3, 2, 2, 2, 1])
+            c1.write(SCOPE_LABELS.get(g["scope"], g["scope"]))
+            c2.write("-" if g["scope"] == "GLOBAL" else g["scope_id"])
+            c3.write("-" if g["min_bid"] is None else f"min {g['min_bid']:.2f}")
+            c4.write("-" if g["max_bid"] is None else f"max {g['max_bid']:.2f}")
+            c5.write("-" if g["max_change_pct"] is None else f"±{g['max_change_pct']:g}% / giorno")
+            if c6.button("Elimina", key=f"guardrail_delete_{g['id']}"):
+                delete_guardrail(g["id"])
+                do_rerun()
+    else:
+        st.info("Nessun limite configurato.")
+
+    with st.form("guardrail_form"):
+        c1, c2 = st.columns(2)
+        scope = c1.selectbox("Livello", options=list(SCOPES), format_func=SCOPE_LABELS.get)
+        scope_id = c2.text_input("ID profilo / campagna / target (vuoto per tutti i target)")
+        c3, c4, c5 = st.columns(3)
+        # None = non definito a questo livello (eredita dal livello superiore)
+        min_bid = c3.number_input("Bid minimo", value=None, min_value=0.0, step=0.01, format="%.2f")
+        max_bid = c4.number_input("Bid massimo", value=None, min_value=0.0, step=0.01, format="%.2f")
+        max_change_pct = c5.number_input(
+            "Variazione massima al giorno (%)", value=None, min_value=0.0, step=1.0, format="%.1f"
+        )
+        if st.form_submit_button("Salva limite"):
+            if scope != "GLOBAL" and not scope_id.strip():
+                st.error("Indica l'ID per questo livello.")
+            else:
+                try:
+                    set_guardrail(scope, scope_id.strip(), min_bid, max_bid, max_change_pct)
+                    do_rerun()
+                except ValueError as exc:
+                    st.error(str(exc))
+
+
+render_guardrails()
+
+st.markdown("---")
+
+st.subheader("Storico esecuzioni")
+st.caption("Riepilogo dei run dello scheduler (tabella rule_runs), più recenti per primi.")
+
+
+def render_run_history(all_rules: list) -> None:
+    import pandas as pd  # import pigro, come in app.py
+
+    runs = get_recent_runs(30)
+    if not runs:
+        st.info("Lo scheduler non ha ancora eseguito regole.")
+    else:
+        df = pd.DataFrame(runs).rename(
+            columns={
+                "run_id": "Run",
+                "duration_ms": "Durata (ms)",
+                "rules": "Regole",
+                "targets": "Target valutati",
+                "increases": "Aumenti",
+                "decreases": "Diminuzioni",
+                "bid_delta": "Delta bid",
+                "api_calls": "Chiamate API",
+                "errors": "Errori",
+            }
+        )
+        st.dataframe(df.drop(columns=["started_at", "finished_at"]), hide_index=True)
+
+        run_id = st.selectbox("Dettaglio run", options=[r["run_id"] for r in runs], key="history_run")
+        names = {r["id"]: r["name"] for r in all_rules}
+        detail = [
+            {
+                "Regola": names.get(r["rule_id"], f"#{r['rule_id']}"),
+                "Inizio": r["started_at"],
+                "Durata (ms)": r["duration_ms"],
+                "Target": r["targets"],
+                "Aumenti": r["increases"],
+                "Diminuzioni": r["decreases"],
+                "Delta bid": round(r["bid_delta"], 2),
+                "Chiamate API": r["api_calls"],
+                "Azioni": ", ".join(f"{a}: {n}" for a, n in sorted(r["actions"].items())),
+                "Errore": r["error"] or "",
+            }
+            for r in get_rule_runs(run_id=run_id)
+        ]
+        st.dataframe(pd.DataFrame(detail), hide_index=True)
+
+    full = get_execution_log_detail()
+    new_full = st.checkbox(
+        "Log completo per target (debug): registra anche SKIP_* e NO_ACTION",
+        value=full,
+        key="execution_log_detail",
+    )
+    if new_full != full:
+        set_execution_log_detail(new_full)
+
+
+render_run_history(rules)
+
+st.markdown("---")
+
+st.subheader("Simulazione (dry-run)")
+st.caption(
+    "Proietta cosa farebbero le regole selezionate, applicate in sequenza, "
+    "senza modificare i bid su Amazon né scrivere log."
+)
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def cached_snapshot_columns(snapshot_path: str) -> TargetColumns:
+    # la chiave è la versione dello snapshot: uno snapshot nuovo invalida la cache
+    with TargetSnapshot(Path(snapshot_path)) as snap:
+        return TargetColumns.from_snapshot(snap)
+
+
+@st.cache_resource(ttl=60, max_entries=4, show_spinner=False)
+def cached_history_columns(as_of) -> TargetColumns:
+    return history_columns(as_of)
+
+
+def render_simulation(all_rules: list) -> None:
+    import pandas as pd
+
+    if not all_rules:
+        st.info("Crea almeno una regola per simularla.")
+        return
+
+    source = st.radio(
+        "Dati",
+        ["Snapshot metriche", "Storico esecuzioni"],
+        horizontal=True,
+        key="sim_source",
+    )
+
+    cols = None
+    if source == "Snapshot metriche":
+        try:
+            profiles = load_profile_registry().profiles
+        except RuntimeError:
+            st.info("Nessun profilo in cache: apri prima l'app principale e collega Amazon.")
+            return
+
+        profile = st.selectbox(
+            "Profilo",
+            options=profiles,
+            format_func=lambda p: f"{p.get('countryCode', '')} — {p['profileId']}",
+            key="sim_profile",
+        )
+        timeframe_label = st.selectbox(
+            "Timeframe snapshot",
+            options=["Ultimo disponibile"] + list(TIMEFRAME_OPTIONS.keys()),
+            key="sim_timeframe",
+        )
+        timeframe = TIMEFRAME_OPTIONS.get(timeframe_label)
+
+        snap = open_snapshot(profile["profileId"], timeframe)
+        if snap is None:
+            st.info("Nessuno snapshot per questo profilo/timeframe: verrà creato dal prossimo run dello scheduler.")
+            return
+        st.caption(f"Snapshot del {snap.created_at}, {len(snap)} target.")
+        snapshot_path = str(snap.path)
+        snap.close()
+        cols = cached_snapshot_columns(snapshot_path)
+    else:
+        run_times = get_execution_run_times()
+        if not run_times:
+            st.info("Lo storico esecuzioni è vuoto.")
+            return
+        as_of = st.selectbox(
+            "Stato dei target all'esecuzione del",
+            options=run_times,
+            key="sim_as_of",
+        )
+        cols = cached_history_columns(as_of)
+
+    selected = st.multiselect(
+        "Regole (applicate per priorità, come nello scheduler)",
+        options=[r["id"] for r in all_rules],
+        default=[r["id"] for r in all_rules if r["enabled"]],
+        format_func=lambda rid: next(f"{r['id']} — {r['name']}" for r in all_rules if r["id"] == rid),
+        key="sim_rules",
+    )
+
+    if not st.button("Simula", key="sim_run"):
+        return
+    if not selected:
+        st.warning("Seleziona almeno una regola.")
+        return
+
+    by_id = {r["id"]: r for r in all_rules}
+    result = simulate_rules(
+        cols,
+        resolution_order([by_id[rid] for rid in selected]),
+        first_match=get_conflict_policy() == FIRST_MATCH,
+        guardrails=load_guardrail_index(),
+        bid_states=load_bid_state_index(),
+    )
+    summary = result.summary()
+
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Target valutati", summary["targets"])
+    m2.metric("Target modificati", summary["affected"])
+    m3.metric("Aumenti / diminuzioni", f"{summary['increases']} / {summary['decreases']}")
+    m4.metric("Delta bid totale", f"{summary['total_bid_delta']:+.2f}")
+
+    st.markdown("**Distribuzione per azione**")
+    actions = pd.Series(summary["actions"], name="target").sort_index()
+    st.bar_chart(actions)
+
+    st.markdown("**Per regola**")
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "ID": r["rule_id"],
+                    "Nome": r["name"],
+                    "Modifiche": r["affected"],
+                    "Delta bid": r["bid_delta"],
+                    **r["actions"],
+                }
+                for r in summary["rules"]
+            ]
+        ).fillna(0),
+        use_container_width=True,
+        hide_index=True,
+    )
+
+    changes = result.changes(limit=200)
+    if changes:
+        st.markdown("**Variazioni più grandi** (prime 200)")
+        st.dataframe(pd.DataFrame(changes), use_container_width=True, hide_index=True)
+
+
+render_simulation(rules)
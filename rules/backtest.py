@@ -0,0 +1,488 @@
+# rules/backtest.py
+
+"""
+Backtest delle regole sullo storico metriche giornaliero.
+
+Riproduce la cadenza dello scheduler: per ogni giorno del periodo, le
+regole "dovute" (mai eseguite o ultima esecuzione da almeno frequency_days
+giorni) vengono applicate in ordine, con la semantica di
+apply_rules_to_target e bid concatenati da una regola all'altra e da un
+run al successivo. Le metriche di ogni run sono quelle della finestra
+timeframe_days che termina il giorno prima (come il report reale).
+
+Tutte le operazioni sono vettoriali (NumPy) sull'intero insieme di target:
+le somme sulle finestre si ricavano da somme cumulative per giorno, quindi
+ogni run costa poche operazioni su array, indipendentemente dalla finestra.
+
+Limiti: le metriche sono quelle storiche, quindi un bid diverso non cambia
+il traffico simulato; il bid di partenza è quello attuale (o start_bids).
+"""
+
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .batch import TargetColumns
+from .conditions import METRIC_RULE_TYPE, RATIO_METRICS, parse_conditions, required_metrics
+from .cooldown import rule_direction, tighten_rule, uses_bid_state
+from .expressions import EXPRESSION_RULE_TYPE, compile_expression
+
+# timeframe "Lifetime" (-1): come scheduler.pipeline.LIFETIME_TIMEFRAME_DAYS
+LIFETIME_DAYS = 95
+
+
+class MetricHistory:
+    """
+    Somme cumulative giornaliere delle metriche (di default click, costo e
+    vendite), allineate all'ordine dei target dell'universo: la somma su
+    qualsiasi finestra di giorni è una sottrazione tra due righe.
+    """
+
+    def __init__(self, first_day: date, cum: Dict[str, np.ndarray]):
+        self.first_day = first_day
+        self.cum = cum
+        self.n_days = next(iter(cum.values())).shape[0] - 1
+
+    @property
+    def metrics(self) -> Tuple[str, ...]:
+        return tuple(self.cum)
+
+    @property
+    def last_day(self) -> date:
+        return self.first_day + timedelta(days=self.n_days - 1)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self.cum.values())
+
+    def _bounds(self, start: date, end: date) -> Tuple[int, int]:
+        lo = min(max((start - self.first_day).days, 0), self.n_days)
+        hi = min(max((end - self.first_day).days + 1, 0), self.n_days)
+        return lo, max(hi, lo)
+
+    def sums(self, start: date, end: date) -> Dict[str, np.ndarray]:
+        """Metriche sommate sui giorni [start, end], estremi inclusi."""
+        lo, hi = self._bounds(start, end)
+        return {name: cum[hi] - cum[lo] for name, cum in self.cum.items()}
+
+    def window(self, start: date, end: date) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(click, costo, vendite) sommati sui giorni [start, end], estremi inclusi."""
+        sums = self.sums(start, end)
+        return sums["clicks"], sums["cost"], sums["sales"]
+
+
+# metriche sempre presenti (ACOS_BAND / LOW_TRAFFIC)
+HISTORY_METRICS = ("clicks", "cost", "sales")
+# tipo numpy per metrica (come db.daily_metrics.DAILY_COLUMNS)
+METRIC_DTYPES = {
+    "impressions": np.int64,
+    "clicks": np.int64,
+    "cost": np.float64,
+    "orders": np.int64,
+    "sales": np.float64,
+}
+
+
+def history_metrics(rules: Sequence[Dict[str, Any]]) -> Tuple[str, ...]:
+    """Metriche da caricare per le regole: le base più quelle delle regole METRIC / EXPRESSION."""
+    needed = set(HISTORY_METRICS)
+    for rule in rules:
+        if rule.get("rule_type") == METRIC_RULE_TYPE:
+            needed |= required_metrics(parse_conditions(rule.get("conditions")))
+        elif rule.get("rule_type") == EXPRESSION_RULE_TYPE and rule.get("expression"):
+            needed |= compile_expression(rule["expression"]).base_metrics
+    return tuple(m for m in METRIC_DTYPES if m in needed)
+
+
+def build_history(
+    target_ids: Sequence[Any],
+    days: Sequence[str],
+    load_day: Callable[[str], Optional[Dict[str, Any]]],
+    metrics: Sequence[str] = HISTORY_METRICS,
+) -> MetricHistory:
+    """
+    Costruisce la MetricHistory per i target dati.
+
+    days: giorni disponibili ("AAAA-MM-GG"); i buchi nell'intervallo
+    contano come giorni senza traffico.
+    load_day: giorno -> colonne (target_id e le metriche richieste) con
+    buffer protocol (array.array, memoryview, ndarray), vedi
+    db.daily_metrics.read_daily_metrics.
+    metrics: metriche da accumulare (history_metrics(rules)); ognuna costa
+    (giorni + 1) x target valori in memoria.
+    """
+    uid = np.array([int(t) for t in target_ids], dtype=np.int64)
+    n = len(uid)
+    order = np.argsort(uid, kind="stable")
+    sorted_uid = uid[order]
+
+    if not days:
+        return MetricHistory(
+            date.today(), {m: np.zeros((1, n), dtype=METRIC_DTYPES[m]) for m in metrics}
+        )
+
+    parsed = sorted(date.fromisoformat(d) for d in days)
+    first, last = parsed[0], parsed[-1]
+    n_days = (last - first).days + 1
+
+    cum = {m: np.zeros((n_days + 1, n), dtype=METRIC_DTYPES[m]) for m in metrics}
+    present = set(parsed)
+
+    for k in range(n_days):
+        day = first + timedelta(days=k)
+        for values in cum.values():
+            values[k + 1] = values[k]
+        if day not in present:
+            continue
+        cols = load_day(day.isoformat())
+        if not cols:
+            continue
+
+        tid = np.frombuffer(cols["target_id"], dtype=np.int64)
+        if not len(tid) or not n:
+            continue
+        pos = np.searchsorted(sorted_uid, tid)
+        valid = pos < n
+        valid[valid] = sorted_uid[pos[valid]] == tid[valid]
+        idx = order[pos[valid]]
+
+        for name, values in cum.items():
+            values[k + 1, idx] += np.frombuffer(cols[name], dtype=METRIC_DTYPES[name])[valid]
+
+    return MetricHistory(first, cum)
+
+
+@dataclass
+class RunEvent:
+    """Un'esecuzione simulata di una regola."""
+
+    run_date: date
+    rule_id: Any
+    matched: int
+    increases: int
+    decreases: int
+    bid_delta: float
+    indices: np.ndarray     # posizioni dei target con bid cambiato (ordinate)
+    new_bids: np.ndarray
+
+
+@dataclass
+class BacktestResult:
+    target_ids: List[Any]
+    run_dates: List[date]
+    events: List[RunEvent]
+    start_bids: np.ndarray
+    final_bids: np.ndarray
+    total_bid_by_date: List[float]
+    changed_by_date: List[int]
+    seconds: float
+
+    def trajectory(self, target_id: Any) -> List[Tuple[date, float]]:
+        """Bid del target dopo ogni run che l'ha modificato (primo elemento: bid iniziale)."""
+        try:
+            i = self.target_ids.index(str(target_id))
+        except ValueError:
+            return []
+        out = [(self.run_dates[0] if self.run_dates else None, float(self.start_bids[i]))]
+        for ev in self.events:
+            k = np.searchsorted(ev.indices, i)
+            if k < len(ev.indices) and ev.indices[k] == i:
+                out.append((ev.run_date, float(ev.new_bids[k])))
+        return out
+
+    def summary(self) -> Dict[str, Any]:
+        valid = ~np.isnan(self.start_bids)
+        diff = (self.final_bids - self.start_bids)[valid]
+        changed = diff[np.abs(diff) > 1e-9]
+
+        per_rule: Dict[Any, Dict[str, Any]] = {}
+        for ev in self.events:
+            r = per_rule.setdefault(
+                ev.rule_id,
+                {"rule_id": ev.rule_id, "runs": 0, "matched": 0, "increases": 0, "decreases": 0, "bid_delta": 0.0},
+            )
+            r["runs"] += 1
+            r["matched"] += ev.matched
+            r["increases"] += ev.increases
+            r["decreases"] += ev.decreases
+            r["bid_delta"] += ev.bid_delta
+
+        for r in per_rule.values():
+            r["bid_delta"] = round(r["bid_delta"], 2)
+
+        stats: Dict[str, Any] = {}
+        if len(changed):
+            stats = {
+                "mean": round(float(changed.mean()), 4),
+                "median": round(float(np.median(changed)), 4),
+                "p10": round(float(np.percentile(changed, 10)), 4),
+                "p90": round(float(np.percentile(changed, 90)), 4),
+                "max_increase": round(float(changed.max()), 2),
+                "max_decrease": round(float(changed.min()), 2),
+            }
+
+        return {
+            "targets": int(len(self.start_bids)),
+            "period": [
+                self.run_dates[0].isoformat() if self.run_dates else None,
+                self.run_dates[-1].isoformat() if self.run_dates else None,
+            ],
+            "runs": len(self.events),
+            "targets_changed": int(len(changed)),
+            "start_total_bid": round(float(np.nansum(self.start_bids)), 2),
+            "final_total_bid": round(float(np.nansum(self.final_bids)), 2),
+            "bid_change": stats,
+            "rules": list(per_rule.values()),
+            "seconds": round(self.seconds, 3),
+        }
+
+
+def _round_cents(values: np.ndarray) -> np.ndarray:
+    """
+    round(v, 2) di Python, vettoriale. np.round arrotonda i casi .xx5 al
+    pari (0.945 -> 0.94, Python dà 0.95): solo quei casi passano da round().
+    """
+    scaled = values * 100.0
+    rounded = np.round(scaled) / 100.0
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    if len(ties):
+        rounded[ties] = [round(v, 2) for v in values[ties].tolist()]
+    return rounded
+
+
+def _filter_mask(universe: TargetColumns, arrays: Dict[str, np.ndarray], rule: Dict[str, Any]) -> np.ndarray:
+    """matches_filters su tutti i target (maschera booleana)."""
+    mask = np.ones(len(universe), dtype=bool)
+    for column in ("campaign_id", "marketplace", "match_type"):
+        value = rule.get(column)
+        if value:
+            mask &= arrays[column] == value
+    return mask
+
+
+def _metric_array(metric: str, sums: Dict[str, np.ndarray]) -> np.ndarray:
+    """Metrica di finestra come float64, NaN dove non definita (come ratio())."""
+    if metric in RATIO_METRICS:
+        num, den, scale, need_num = RATIO_METRICS[metric]
+        a, b = _metric_array(num, sums), _metric_array(den, sums)
+        defined = b != 0
+        if need_num:
+            defined &= a > 0
+        out = np.full(len(a), np.nan)
+        np.divide(a, b, out=out, where=defined)
+        return out * scale
+    if metric not in sums:
+        raise ValueError(f"Metrica {metric!r} non caricata nello storico (vedi history_metrics)")
+    return sums[metric].astype(np.float64)
+
+
+def _condition_mask(rule: Dict[str, Any], sums: Dict[str, np.ndarray]) -> np.ndarray:
+    """rule_condition_matches su metriche di finestra (maschera booleana)."""
+    rule_type = rule.get("rule_type")
+    clicks, cost, sales = sums["clicks"], sums["cost"], sums["sales"]
+
+    if rule_type == "ACOS_BAND":
+        has_acos = (sales > 0) & (cost > 0)
+        acos = np.full(len(cost), np.nan)
+        np.divide(cost, sales, out=acos, where=has_acos)
+        acos *= 100.0
+        mask = has_acos
+        if rule.get("acos_min") is not None:
+            mask = mask & (acos >= rule["acos_min"])
+        if rule.get("acos_max") is not None:
+            mask = mask & (acos <= rule["acos_max"])
+        return mask
+
+    if rule_type == "LOW_TRAFFIC":
+        mask = clicks >= (rule.get("clicks_min") or 0)
+        if rule.get("clicks_max") is not None:
+            mask &= clicks < rule["clicks_max"]
+        return mask
+
+    if rule_type == METRIC_RULE_TYPE:
+        conditions = parse_conditions(rule.get("conditions"))
+        mask = np.full(len(cost), bool(conditions))
+        for c in conditions:
+            values = _metric_array(c.metric, sums)
+            # NaN: confronti sempre falsi, come None nel motore
+            mask &= ~np.isnan(values)
+            if c.min is not None:
+                mask &= values >= c.min
+            if c.max is not None:
+                mask &= values <= c.max
+        return mask
+
+    if rule_type == EXPRESSION_RULE_TYPE:
+        if not rule.get("expression"):
+            return np.zeros(len(cost), dtype=bool)
+        compiled = compile_expression(rule["expression"])
+        return compiled.mask({name: _metric_array(name, sums) for name in compiled.names}, len(cost))
+
+    # tipo non riconosciuto: come nel motore, non applicare
+    return np.zeros(len(cost), dtype=bool)
+
+
+def backtest_rules(
+    universe: TargetColumns,
+    history: MetricHistory,
+    rules: Sequence[Dict[str, Any]],
+    period_days: int = 90,
+    end_date: Optional[date] = None,
+    start_bids: Optional[Sequence[Optional[float]]] = None,
+    min_bid: Optional[float] = None,
+    max_bid: Optional[float] = None,
+    first_match: bool = False,
+    guardrails=None,
+) -> BacktestResult:
+    """
+    Simula period_days giorni di scheduler fino a end_date (incluso).
+
+    end_date di default: il giorno dopo l'ultimo dello storico, cioè il run
+    che userebbe come ultimo giorno di dati "ieri".
+    history deve essere costruita sugli stessi target di universe
+    (build_history(universe.target_id, ...)).
+    first_match: in ogni giorno un target viene modificato al massimo da una
+    regola (politica FIRST_MATCH di rules.conflicts).
+    guardrails: rules.guardrails.GuardrailIndex; i limiti per target si
+    leggono una volta, la variazione giornaliera si misura dal bid di inizio
+    di ogni giorno simulato.
+    Cooldown e isteresi delle regole (rules.cooldown) usano lo stato dei
+    target come lo scheduler: ultima modifica e sua direzione, aggiornate a
+    fine giornata; all'inizio del periodo nessun target risulta modificato.
+    """
+    started = time.perf_counter()
+    n = len(universe)
+
+    if end_date is None:
+        end_date = history.last_day + timedelta(days=1)
+    run_dates = [end_date - timedelta(days=d) for d in range(period_days - 1, -1, -1)]
+
+    arrays = {
+        column: np.array(getattr(universe, column), dtype=object)
+        for column in ("campaign_id", "marketplace", "match_type")
+    }
+    filters = [_filter_mask(universe, arrays, rule) for rule in rules]
+
+    source = universe.bid if start_bids is None else start_bids
+    start = np.array([np.nan if b is None else float(b) for b in source], dtype=np.float64)
+    bids = start.copy()
+    has_bid = ~np.isnan(bids)
+
+    lows = highs = pct = None
+    if guardrails is not None:
+        limits = {k: np.frombuffer(v, dtype=np.float64) for k, v in guardrails.column_limits(universe).items()}
+        lows, highs, pct = limits["min_bid"], limits["max_bid"], limits["max_change_pct"]
+        has_rate = bool((~np.isnan(pct)).any())
+
+    # stato per cooldown / isteresi: giorno (ordinale) e segno dell'ultima modifica
+    track_state = any(uses_bid_state(rule) for rule in rules)
+    if track_state:
+        last_change = np.full(n, np.nan)
+        last_direction = np.zeros(n, dtype=np.int8)
+
+    last_run: Dict[int, date] = {}
+    events: List[RunEvent] = []
+    total_by_date: List[float] = []
+    changed_by_date: List[int] = []
+
+    for run_date in run_dates:
+        touched = np.zeros(n, dtype=bool) if first_match else None
+        if track_state:
+            day_start = bids.copy()
+            moved_today = np.zeros(n, dtype=bool)
+            hours_since = (run_date.toordinal() - last_change) * 24.0
+        if pct is not None:
+            day_lo, day_hi = lows, highs
+            if has_rate:
+                # stessa logica di rules.guardrails.combine_bounds, su tutto il vettore
+                step = np.abs(bids) * pct / 100.0
+                rated = ~np.isnan(pct)
+                day_lo = np.where(rated, np.fmin(np.fmax(bids - step, lows), highs), lows)
+                day_hi = np.where(rated, np.fmin(np.fmax(bids + step, lows), highs), highs)
+        for k, rule in enumerate(rules):
+            prev = last_run.get(k)
+            frequency = rule.get("frequency_days") or 1
+            if prev is not None and (run_date - prev).days < frequency:
+                continue
+            last_run[k] = run_date
+
+            timeframe = rule.get("timeframe_days")
+            if timeframe is None or timeframe <= 0:
+                timeframe = LIFETIME_DAYS
+            sums = history.sums(
+                run_date - timedelta(days=timeframe), run_date - timedelta(days=1)
+            )
+
+            active = filters[k] & has_bid & _condition_mask(rule, sums)
+            if track_state:
+                if rule.get("cooldown_hours"):
+                    # NaN (mai modificato): confronto falso
+                    with np.errstate(invalid="ignore"):
+                        active &= ~(hours_since < rule["cooldown_hours"])
+                if rule.get("hysteresis_pct") and rule_direction(rule):
+                    reversal = last_direction == -rule_direction(rule)
+                    if reversal.any():
+                        active &= ~reversal | _condition_mask(tighten_rule(rule), sums)
+            if touched is not None:
+                active &= ~touched
+            idx = np.flatnonzero(active)
+            current = bids[idx]
+
+            value = float(rule.get("adjustment_value") or 0.0)
+            if rule.get("adjustment_type") == "ABS":
+                delta = np.full(len(idx), value)
+            elif rule.get("adjustment_type") == "PCT":
+                delta = current * value / 100.0
+            else:
+                delta = np.zeros(len(idx))
+
+            # delta == 0 -> NO_ACTION, bid invariato
+            new = np.where(delta != 0, current + delta, current)
+            if pct is not None:
+                # fmax/fmin ignorano i NaN (nessun limite)
+                new = np.where(delta != 0, np.fmin(np.fmax(new, day_lo[idx]), day_hi[idx]), new)
+            if min_bid is not None:
+                new = np.where(delta != 0, np.maximum(new, min_bid), new)
+            if max_bid is not None:
+                new = np.where(delta != 0, np.minimum(new, max_bid), new)
+            new = np.where(delta != 0, _round_cents(new), current)
+
+            moved = new != current
+            bids[idx] = new
+            if touched is not None:
+                touched[idx[moved]] = True
+            if track_state:
+                moved_today[idx[moved]] = True
+            events.append(
+                RunEvent(
+                    run_date=run_date,
+                    rule_id=rule.get("id"),
+                    matched=int(len(idx)),
+                    increases=int(np.count_nonzero(new > current)),
+                    decreases=int(np.count_nonzero(new < current)),
+                    bid_delta=float((new - current).sum()),
+                    indices=idx[moved],
+                    new_bids=new[moved],
+                )
+            )
+
+        if track_state and moved_today.any():
+            # come record_bid_changes a fine run: direzione della variazione netta
+            last_change[moved_today] = run_date.toordinal()
+            last_direction[moved_today] = np.sign(bids[moved_today] - day_start[moved_today])
+        total_by_date.append(float(np.nansum(bids)))
+        changed_by_date.append(int(np.count_nonzero(bids[has_bid] != start[has_bid])))
+
+    return BacktestResult(
+        target_ids=[str(t) for t in universe.target_id],
+        run_dates=run_dates,
+        events=events,
+        start_bids=start,
+        final_bids=bids,
+        total_bid_by_date=total_by_date,
+        changed_by_date=changed_by_date,
+        seconds=time.perf_counter() - started,
+    )
@@ -0,0 +1,200 @@
+# rules/conditions.py
+
+"""
+Condizioni generiche sulle metriche (regole di tipo METRIC).
+
+La colonna rules.conditions contiene una lista JSON di condizioni in AND,
+con estremi inclusi (null = nessun limite):
+
+    [{"metric": "cost", "min": 10}, {"metric": "orders", "max": 0}]
+
+Metriche di base (dal report): impressions, clicks, cost, orders, sales.
+Metriche derivate: acos, cpc, ctr, cvr (rapporti, None se il denominatore
+è zero: una condizione su un valore None non è soddisfatta, come per
+l'ACOS in ACOS_BAND).
+
+Il JSON viene validato al salvataggio (normalize_conditions) e interpretato
+una volta sola per testo distinto (parse_conditions è memoizzata): la
+valutazione per target non rilegge mai il JSON.
+"""
+
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+METRIC_RULE_TYPE = "METRIC"
+
+BASE_METRICS = ("impressions", "clicks", "cost", "orders", "sales")
+
+# metrica derivata -> (numeratore, denominatore, scala, numeratore > 0 richiesto)
+RATIO_METRICS = {
+    "acos": ("cost", "sales", 100.0, True),   # come MetricsTable: serve anche spesa > 0
+    "cpc": ("cost", "clicks", 1.0, False),
+    "ctr": ("clicks", "impressions", 100.0, False),
+    "cvr": ("orders", "clicks", 100.0, False),
+}
+
+METRICS = BASE_METRICS + tuple(RATIO_METRICS)
+
+# verso del bid quando la metrica cresce: -1 = valori alti portano a ridurlo
+# (ACOS, costo, click senza esito), 1 = ad alzarlo (ordini, vendite). Dice
+# all'isteresi (rules.cooldown) da che lato arriva la modifica opposta.
+METRIC_BID_POLARITY = {
+    "impressions": -1,
+    "clicks": -1,
+    "cost": -1,
+    "orders": 1,
+    "sales": 1,
+    "acos": -1,
+    "cpc": -1,
+    "ctr": 1,
+    "cvr": 1,
+}
+
+METRIC_LABELS = {
+    "impressions": "Impression",
+    "clicks": "Click",
+    "cost": "Spesa",
+    "orders": "Ordini",
+    "sales": "Vendite",
+    "acos": "ACOS (%)",
+    "cpc": "CPC",
+    "ctr": "CTR (%)",
+    "cvr": "Conversion rate (%)",
+}
+
+
+@dataclass(frozen=True)
+class Condition:
+    metric: str
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+    def matches(self, value: Optional[float]) -> bool:
+        if value is None:
+            return False
+        if self.min is not None and value < self.min:
+            return False
+        if self.max is not None and value > self.max:
+            return False
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"metric": self.metric}
+        if self.min is not None:
+            out["min"] = self.min
+        if self.max is not None:
+            out["max"] = self.max
+        return out
+
+    def describe(self) -> str:
+        label = METRIC_LABELS.get(self.metric, self.metric)
+        if self.min is not None and self.max is not None:
+            if self.min == self.max:
+                return f"{label} = {self.min:g}"
+            return f"{label} {self.min:g} - {self.max:g}"
+        if self.min is not None:
+            return f"{label} >= {self.min:g}"
+        if self.max is not None:
+            return f"{label} <= {self.max:g}"
+        return label
+
+
+def _number(value: Any, what: str) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{what}: valore non numerico {value!r}")
+    return float(value)
+
+
+def _build(items: Any) -> Tuple[Condition, ...]:
+    if not isinstance(items, list):
+        raise ValueError("Le condizioni devono essere una lista")
+    out = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError(f"Condizione non valida: {item!r}")
+        metric = item.get("metric")
+        if metric not in METRICS:
+            raise ValueError(f"Metrica sconosciuta: {metric!r}")
+        lo = _number(item.get("min"), metric)
+        hi = _number(item.get("max"), metric)
+        if lo is None and hi is None:
+            raise ValueError(f"{metric}: indicare almeno min o max")
+        if lo is not None and hi is not None and lo > hi:
+            raise ValueError(f"{metric}: min maggiore di max")
+        out.append(Condition(metric, lo, hi))
+    return tuple(out)
+
+
+@lru_cache(maxsize=256)
+def _parse_text(raw: str) -> Tuple[Condition, ...]:
+    try:
+        items = json.loads(raw)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"JSON condizioni non valido: {exc}") from None
+    return _build(items)
+
+
+def parse_conditions(raw: Any) -> Tuple[Condition, ...]:
+    """Condizioni da testo JSON (memoizzato), lista di dict o None (nessuna)."""
+    if raw is None or raw == "":
+        return ()
+    if isinstance(raw, str):
+        return _parse_text(raw)
+    return _build(list(raw))
+
+
+def normalize_conditions(raw: Any) -> Optional[str]:
+    """JSON canonico da salvare in rules.conditions (ValueError se non valido)."""
+    conditions = parse_conditions(raw)
+    if not conditions:
+        return None
+    return json.dumps([c.to_dict() for c in conditions], sort_keys=True)
+
+
+def describe_conditions(raw: Any) -> str:
+    return " e ".join(c.describe() for c in parse_conditions(raw)) or "-"
+
+
+def base_metrics(metrics: Iterable[str]) -> Set[str]:
+    """Metriche di base da cui si calcolano quelle date (derivate -> numeratore e denominatore)."""
+    out: Set[str] = set()
+    for metric in metrics:
+        if metric in RATIO_METRICS:
+            num, den, _, _ = RATIO_METRICS[metric]
+            out.update((num, den))
+        else:
+            out.add(metric)
+    return out
+
+
+def required_metrics(conditions: Iterable[Condition]) -> Set[str]:
+    """Metriche di base necessarie per valutare le condizioni."""
+    return base_metrics(c.metric for c in conditions)
+
+
+def ratio(num: Optional[float], den: Optional[float], scale: float, need_num: bool) -> Optional[float]:
+    if num is None or not den or (need_num and not num > 0):
+        return None
+    return num / den * scale
+
+
+def metric_value(target: Dict[str, Any], metric: str) -> Optional[float]:
+    """Valore della metrica per un target nel formato di rules.engine."""
+    if metric in RATIO_METRICS:
+        # valore già calcolato (es. acos del report) se presente
+        if target.get(metric) is not None:
+            return target[metric]
+        num, den, scale, need_num = RATIO_METRICS[metric]
+        return ratio(target.get(num), target.get(den), scale, need_num)
+    return target.get(metric)
+
+
+def conditions_match(target: Dict[str, Any], conditions: Iterable[Condition]) -> bool:
+    for c in conditions:
+        if not c.matches(metric_value(target, c.metric)):
+            return False
+    return True
@@ -0,0 +1,241 @@
+# rules/conflicts.py
+
+"""
+Analisi delle sovrapposizioni tra regole.
+
+apply_rules_to_target applica le regole in sequenza: se due bande ACOS si
+sovrappongono (o più regole LOW_TRAFFIC coprono gli stessi click) sullo
+stesso ambito, lo stesso target riceve più variazioni nello stesso run.
+
+L'analisi costruisce per ogni tipo di regola gli intervalli sulla metrica
+(ACOS o click) e li scorre ordinati per estremo inferiore (sweep line): si
+confrontano solo le coppie di intervalli che si intersecano davvero, poi si
+verifica l'ambito (campagna / marketplace / match type, None = tutti).
+
+Le regole METRIC (condizioni JSON su più metriche, rules.conditions) ed
+EXPRESSION (rules.expressions) sono poche e vengono confrontate a coppie:
+si sovrappongono se su ogni metrica in comune gli intervalli si
+intersecano (per le espressioni, gli intervalli ricavabili dai confronti
+in AND; il resto è considerato compatibile).
+
+Viene calcolata al salvataggio delle regole (db.database.refresh_rule_analysis)
+e letta dallo scheduler, che così sa in anticipo quali regole devono
+controllare i target già modificati da una regola precedente.
+"""
+
+import math
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .conditions import METRIC_LABELS, METRIC_RULE_TYPE, parse_conditions
+from .expressions import EXPRESSION_RULE_TYPE, compile_expression
+
+# tipi confrontati a coppie tramite condition_box
+PAIRWISE_TYPES = (METRIC_RULE_TYPE, EXPRESSION_RULE_TYPE)
+
+SCOPE_FIELDS = ("campaign_id", "marketplace", "match_type")
+
+# politiche di risoluzione
+SEQUENTIAL = "SEQUENTIAL"     # come apply_rules_to_target: le variazioni si sommano
+FIRST_MATCH = "FIRST_MATCH"   # un target viene modificato solo dalla prima regola in ordine
+POLICIES = (SEQUENTIAL, FIRST_MATCH)
+
+DEFAULT_PRIORITY = 100
+
+INF = math.inf
+
+
+@dataclass
+class Overlap:
+    rule_id: Any
+    other_rule_id: Any
+    kind: str                   # 'ACOS', 'CLICKS', 'CROSS' (ACOS vs click, possibile) o 'METRIC' (coppie METRIC / EXPRESSION)
+    low: Optional[float]
+    high: Optional[float]
+    opposite: bool              # una regola alza, l'altra abbassa
+    metrics: List[str] = field(default_factory=list)    # per METRIC: metriche in comune
+
+    def describe(self) -> str:
+        if self.kind == "CROSS":
+            what = "ACOS e click (target con ACOS nella banda e pochi click)"
+        elif self.kind == "METRIC":
+            if self.metrics:
+                what = "condizioni compatibili su " + ", ".join(METRIC_LABELS.get(m, m) for m in self.metrics)
+            else:
+                what = "condizioni su metriche diverse (possibili target comuni)"
+        else:
+            lo = "-inf" if self.low is None else f"{self.low:g}"
+            hi = "+inf" if self.high is None else f"{self.high:g}"
+            what = f"{'ACOS' if self.kind == 'ACOS' else 'click'} in [{lo}, {hi}]"
+        effect = "direzioni opposte" if self.opposite else "variazioni sommate"
+        return f"regole {self.rule_id} e {self.other_rule_id}: {what}, {effect}"
+
+
+@dataclass
+class RuleAnalysis:
+    order: List[Any]                                    # ordine di risoluzione
+    overlaps: List[Overlap] = field(default_factory=list)
+
+    def overlapping_earlier(self, rule_id: Any) -> List[Any]:
+        """Regole che precedono rule_id nell'ordine e si sovrappongono a essa."""
+        pos = {rid: i for i, rid in enumerate(self.order)}
+        mine = pos.get(rule_id)
+        if mine is None:
+            return []
+        out = []
+        for o in self.overlaps:
+            other = o.other_rule_id if o.rule_id == rule_id else o.rule_id if o.other_rule_id == rule_id else None
+            if other is not None and pos.get(other, mine) < mine:
+                out.append(other)
+        return sorted(set(out), key=pos.__getitem__)
+
+    def for_rule(self, rule_id: Any) -> List[Overlap]:
+        return [o for o in self.overlaps if rule_id in (o.rule_id, o.other_rule_id)]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"order": self.order, "overlaps": [asdict(o) for o in self.overlaps]}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RuleAnalysis":
+        return cls(data.get("order", []), [Overlap(**o) for o in data.get("overlaps", [])])
+
+
+def resolution_order(rules: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Ordine deterministico: priorità crescente (None = DEFAULT_PRIORITY), poi ID."""
+    return sorted(
+        rules,
+        key=lambda r: (
+            r.get("priority") if r.get("priority") is not None else DEFAULT_PRIORITY,
+            r.get("id") or 0,
+        ),
+    )
+
+
+def metric_interval(rule: Dict[str, Any]) -> Optional[Tuple[str, float, float]]:
+    """(metrica, low, high) chiuso della condizione; None se il tipo non è noto."""
+    rule_type = rule.get("rule_type")
+    if rule_type == "ACOS_BAND":
+        lo = rule.get("acos_min")
+        hi = rule.get("acos_max")
+        return "ACOS", -INF if lo is None else float(lo), INF if hi is None else float(hi)
+    if rule_type == "LOW_TRAFFIC":
+        lo = rule.get("clicks_min") or 0
+        hi = rule.get("clicks_max")
+        # click interi, clicks < clicks_max -> intervallo chiuso [lo, max - 1]
+        return "CLICKS", float(lo), INF if hi is None else float(hi) - 1
+    return None
+
+
+def condition_box(rule: Dict[str, Any]) -> Optional[Dict[str, Tuple[float, float]]]:
+    """Condizione della regola come {metrica: (low, high)} chiusi (rules.conditions)."""
+    if rule.get("rule_type") == METRIC_RULE_TYPE:
+        box: Dict[str, Tuple[float, float]] = {}
+        for c in parse_conditions(rule.get("conditions")):
+            lo = -INF if c.min is None else c.min
+            hi = INF if c.max is None else c.max
+            prev = box.get(c.metric, (-INF, INF))
+            box[c.metric] = (max(prev[0], lo), min(prev[1], hi))
+        return box or None
+    if rule.get("rule_type") == EXPRESSION_RULE_TYPE:
+        expression = rule.get("expression")
+        # {} = nessun vincolo ricavabile: compatibile con qualsiasi regola
+        return dict(compile_expression(expression).box) if expression else None
+    interval = metric_interval(rule)
+    if interval is None:
+        return None
+    metric, lo, hi = interval
+    return {"acos" if metric == "ACOS" else "clicks": (lo, hi)}
+
+
+def scopes_intersect(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    for f in SCOPE_FIELDS:
+        va, vb = a.get(f), b.get(f)
+        if va and vb and va != vb:
+            return False
+    return True
+
+
+def _direction(rule: Dict[str, Any]) -> int:
+    value = rule.get("adjustment_value") or 0
+    return (value > 0) - (value < 0)
+
+
+def _finite(value: float) -> Optional[float]:
+    return None if math.isinf(value) else value
+
+
+def analyze_rules(rules: Sequence[Dict[str, Any]]) -> RuleAnalysis:
+    """Ordine di risoluzione e sovrapposizioni tra le regole (tipicamente quelle attive)."""
+    ordered = resolution_order(rules)
+    analysis = RuleAnalysis([r.get("id") for r in ordered])
+
+    by_metric: Dict[str, List[Tuple[float, float, Dict[str, Any]]]] = {}
+    for r in ordered:
+        interval = metric_interval(r)
+        if interval is None or interval[1] > interval[2]:
+            continue
+        metric, lo, hi = interval
+        by_metric.setdefault(metric, []).append((lo, hi, r))
+
+    # sweep line per metrica
+    for metric, items in by_metric.items():
+        items.sort(key=lambda x: x[0])
+        active: List[Tuple[float, float, Dict[str, Any]]] = []
+        for lo, hi, rule in items:
+            active = [a for a in active if a[1] >= lo]
+            for a_lo, a_hi, other in active:
+                if not scopes_intersect(rule, other):
+                    continue
+                analysis.overlaps.append(
+                    Overlap(
+                        rule_id=other.get("id"),
+                        other_rule_id=rule.get("id"),
+                        kind=metric,
+                        low=_finite(max(lo, a_lo)),
+                        high=_finite(min(hi, a_hi)),
+                        opposite=_direction(rule) * _direction(other) < 0,
+                    )
+                )
+            active.append((lo, hi, rule))
+
+    # ACOS vs click: metriche diverse, possono colpire lo stesso target
+    for acos_rule in (x[2] for x in by_metric.get("ACOS", [])):
+        for clicks_rule in (x[2] for x in by_metric.get("CLICKS", [])):
+            if scopes_intersect(acos_rule, clicks_rule):
+                analysis.overlaps.append(
+                    Overlap(
+                        rule_id=acos_rule.get("id"),
+                        other_rule_id=clicks_rule.get("id"),
+                        kind="CROSS",
+                        low=None,
+                        high=None,
+                        opposite=_direction(acos_rule) * _direction(clicks_rule) < 0,
+                    )
+                )
+
+    # regole METRIC / EXPRESSION: confronto a coppie con tutte le altre
+    boxes = {id(r): condition_box(r) for r in ordered}
+    for i, rule in enumerate(ordered):
+        for other in ordered[i + 1:]:
+            if rule.get("rule_type") not in PAIRWISE_TYPES and other.get("rule_type") not in PAIRWISE_TYPES:
+                continue
+            a, b = boxes[id(rule)], boxes[id(other)]
+            if a is None or b is None or not scopes_intersect(rule, other):
+                continue
+            if any(lo > hi for lo, hi in list(a.values()) + list(b.values())):
+                continue
+            common = sorted(set(a) & set(b))
+            if all(max(a[m][0], b[m][0]) <= min(a[m][1], b[m][1]) for m in common):
+                analysis.overlaps.append(
+                    Overlap(
+                        rule_id=rule.get("id"),
+                        other_rule_id=other.get("id"),
+                        kind="METRIC",
+                        low=None,
+                        high=None,
+                        opposite=_direction(rule) * _direction(other) < 0,
+                        metrics=common,
+                    )
+                )
+
+    return analysis
@@ -0,0 +1,181 @@
+# rules/cooldown.py
+
+"""
+Cooldown e isteresi per target (colonne rules.cooldown_hours e
+rules.hysteresis_pct), contro l'effetto "altalena": un target alzato in un
+run e riabbassato nel successivo perché l'ACOS oscilla sul bordo di una
+banda.
+
+- cooldown_hours: un target modificato (da qualsiasi regola, in un run
+  precedente) da meno di N ore non viene toccato: SKIP_COOLDOWN.
+- hysteresis_pct: se la regola invertirebbe la direzione dell'ultima
+  modifica del target (aumento dopo una diminuzione o viceversa), si
+  stringe del margine la soglia che il target attraversa, quella dal lato
+  da cui arriva la modifica opposta (rules.conditions.METRIC_BID_POLARITY):
+  es. 10, ACOS <= 30 diventa ACOS <= 27 in una regola che alza i bid,
+  clicks >= 20 diventa clicks >= 22 in una che li abbassa. L'altra soglia
+  resta com'è. Se la condizione non vale anche con il margine:
+  SKIP_HYSTERESIS.
+
+Lo stato è quello di target_bid_state (db.get_bid_states), caricato una
+volta per run in un BidStateIndex: ogni controllo è un lookup, nessuna
+query per target. Le modifiche fatte durante il run non aggiornano
+l'indice: la concatenazione di più regole nello stesso run resta regolata
+dalla politica di rules.conflicts.
+"""
+
+import json
+from array import array
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from .conditions import METRIC_BID_POLARITY, METRIC_RULE_TYPE, parse_conditions
+from .expressions import EXPRESSION_RULE_TYPE, tighten_expression
+
+
+class TargetState(NamedTuple):
+    hours_since_change: float
+    direction: int              # segno dell'ultima variazione: 1, -1 o 0
+
+
+@lru_cache(maxsize=4096)
+def _parse_time(value: str) -> datetime:
+    # molti target condividono lo stesso istante (un run): parse una volta
+    return datetime.fromisoformat(value.rstrip("Z"))
+
+
+class BidStateIndex:
+    """Stato dell'ultima modifica per target_id, con ore trascorse rispetto a now."""
+
+    def __init__(self, rows: Iterable[Dict[str, Any]], now: Optional[datetime] = None):
+        if now is None:
+            now = datetime.utcnow()
+        self.now = now
+        self._states: Dict[str, TargetState] = {}
+        for r in rows:
+            changed_at = r.get("last_change_at")
+            if not changed_at:
+                continue
+            hours = (now - _parse_time(changed_at)).total_seconds() / 3600.0
+            delta = r.get("last_change_delta") or 0.0
+            direction = 1 if delta > 0 else -1 if delta < 0 else 0
+            self._states[str(r["target_id"])] = TargetState(hours, direction)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def state(self, target_id: Any) -> Optional[TargetState]:
+        return self._states.get(str(target_id))
+
+    def column_state(self, cols) -> Tuple[array, array]:
+        """
+        (ore dall'ultima modifica, direzione) allineati a un
+        rules.batch.TargetColumns; NaN / 0 per i target mai modificati.
+        """
+        nan = float("nan")
+        hours = array("d")
+        directions = array("b")
+        get = self._states.get
+        for tid in cols.target_id:
+            s = get(str(tid))
+            if s is None:
+                hours.append(nan)
+                directions.append(0)
+            else:
+                hours.append(s.hours_since_change)
+                directions.append(s.direction)
+        return hours, directions
+
+
+def uses_bid_state(rule: Dict[str, Any]) -> bool:
+    """True se la regola ha cooldown o isteresi (serve lo stato dei target)."""
+    return bool(rule.get("cooldown_hours")) or bool(rule.get("hysteresis_pct"))
+
+
+def rule_direction(rule: Dict[str, Any]) -> int:
+    """Direzione della variazione della regola (ABS e PCT: segno del valore)."""
+    value = rule.get("adjustment_value") or 0.0
+    return 1 if value > 0 else -1 if value < 0 else 0
+
+
+def in_cooldown(rule: Dict[str, Any], state: Optional[TargetState]) -> bool:
+    cooldown = rule.get("cooldown_hours")
+    return bool(cooldown) and state is not None and state.hours_since_change < cooldown
+
+
+def is_reversal(rule: Dict[str, Any], state: Optional[TargetState]) -> bool:
+    """La regola invertirebbe l'ultima modifica del target (e ha un margine di isteresi)."""
+    if not rule.get("hysteresis_pct") or state is None or not state.direction:
+        return False
+    return state.direction == -rule_direction(rule)
+
+
+def _lower(value: Optional[float], factor: float) -> Optional[float]:
+    # soglia minima più alta (anche per valori negativi)
+    return None if value is None else value + abs(value) * factor
+
+
+def _upper(value: Optional[float], factor: float) -> Optional[float]:
+    return None if value is None else value - abs(value) * factor
+
+
+def _tightened_sides(metric: str, direction: int) -> Tuple[bool, bool]:
+    """(stringe il minimo, stringe il massimo) per una regola di verso direction."""
+    side = direction * METRIC_BID_POLARITY.get(metric, 0)
+    # side < 0: la modifica opposta arriva da valori più alti
+    return side >= 0, side <= 0
+
+
+def _tighten_conditions(raw: Any, factor: float, direction: int) -> Optional[str]:
+    """JSON delle condizioni strette; None (nessun target) se un intervallo si svuota."""
+    if isinstance(raw, str):
+        return _tighten_conditions_text(raw, factor, direction)
+    return _tighten_conditions_text(json.dumps(raw), factor, direction)
+
+
+@lru_cache(maxsize=256)
+def _tighten_conditions_text(raw: str, factor: float, direction: int) -> Optional[str]:
+    items = []
+    for c in parse_conditions(raw):
+        low_side, high_side = _tightened_sides(c.metric, direction)
+        lo = _lower(c.min, factor) if low_side else c.min
+        hi = _upper(c.max, factor) if high_side else c.max
+        if lo is not None and hi is not None and lo > hi:
+            return None
+        items.append({"metric": c.metric, "min": lo, "max": hi})
+    # testo JSON: parse_conditions lo interpreta una volta sola
+    return json.dumps(items, sort_keys=True) if items else None
+
+
+def tighten_rule(rule: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copia della regola con le soglie della condizione strette di
+    hysteresis_pct, per una regola che inverte l'ultima modifica: solo la
+    soglia dal lato della modifica opposta (minimo alzato o massimo
+    abbassato, di una frazione del suo valore). Per EXPRESSION vale per i
+    confronti metrica/costante (vedi rules.expressions.tighten_expression).
+    """
+    factor = float(rule.get("hysteresis_pct") or 0.0) / 100.0
+    if not factor:
+        return rule
+    rule_type = rule.get("rule_type")
+    direction = rule_direction(rule)
+
+    if rule_type in ("ACOS_BAND", "LOW_TRAFFIC"):
+        metric, low_key, high_key = (
+            ("acos", "acos_min", "acos_max") if rule_type == "ACOS_BAND"
+            else ("clicks", "clicks_min", "clicks_max")
+        )
+        low_side, high_side = _tightened_sides(metric, direction)
+        tight = dict(rule)
+        if low_side:
+            tight[low_key] = _lower(rule.get(low_key), factor)
+        if high_side:
+            tight[high_key] = _upper(rule.get(high_key), factor)
+        return tight
+    if rule_type == METRIC_RULE_TYPE:
+        return {**rule, "conditions": _tighten_conditions(rule.get("conditions"), factor, direction)}
+    if rule_type == EXPRESSION_RULE_TYPE and rule.get("expression"):
+        return {**rule, "expression": tighten_expression(rule["expression"], factor, direction)}
+    return rule
@@ -2,6 +2,10 @@
 
 from typing import Any, Dict, List, Tuple, Optional
 
+from .conditions import METRIC_RULE_TYPE, conditions_match, parse_conditions
+from .cooldown import TargetState, in_cooldown, is_reversal, tighten_rule
+from .expressions import EXPRESSION_RULE_TYPE, compile_expression
+
 
 def matches_filters(target: Dict[str, Any], rule: Dict[str, Any]) -> bool:
     """Controlla filtri base: campaign, marketplace, match type."""
@@ -51,6 +55,16 @@ def rule_condition_matches(target: Dict[str, Any], rule: Dict[str, Any]) -> bool
 
         return True
 
+    if rule_type == METRIC_RULE_TYPE:
+        # condizioni JSON (rules.conditions), interpretate una volta per testo
+        conditions = parse_conditions(rule.get("conditions"))
+        return bool(conditions) and conditions_match(target, conditions)
+
+    if rule_type == EXPRESSION_RULE_TYPE:
+        # compilata una volta per espressione (rules.expressions), qui solo la chiamata
+        expression = rule.get("expression")
+        return bool(expression) and compile_expression(expression).matches(target)
+
     # Tipo non riconosciuto, per sicurezza non applicare
     return False
 
@@ -76,19 +90,29 @@ def apply_rule_to_target(
     rule: Dict[str, Any],
     min_bid: Optional[float] = None,
     max_bid: Optional[float] = None,
+    state: Optional[TargetState] = None,
 ) -> Tuple[float, str]:
     """
     Applica una singola regola a un target.
 
+    state: ultima modifica del target (rules.cooldown.BidStateIndex.state),
+    per cooldown e isteresi della regola; None = mai modificato.
+
     Ritorna:
         new_bid, action_string
     """
     if not matches_filters(target, rule):
         return target["bid"], "SKIP_FILTER"
 
+    if in_cooldown(rule, state):
+        return target["bid"], "SKIP_COOLDOWN"
+
     if not rule_condition_matches(target, rule):
         return target["bid"], "SKIP_CONDITION"
 
+    if is_reversal(rule, state) and not rule_condition_matches(target, tighten_rule(rule)):
+        return target["bid"], "SKIP_HYSTERESIS"
+
     current_bid = float(target["bid"])
     delta = compute_delta(current_bid, rule)
 
@@ -121,6 +145,7 @@ def apply_rules_to_target(
     rules: List[Dict[str, Any]],
     min_bid: Optional[float] = None,
     max_bid: Optional[float] = None,
+    state: Optional[TargetState] = None,
 ) -> Tuple[float, List[Dict[str, Any]]]:
     """
     Applica più regole in sequenza allo stesso target.
@@ -138,6 +163,7 @@ def apply_rules_to_target(
             rule,
             min_bid=min_bid,
             max_bid=max_bid,
+            state=state,
         )
 
         logs.append(
@@ -0,0 +1,364 @@
+# rules/expressions.py
+
+"""
+Regole a espressione (rule_type EXPRESSION, colonna rules.expression).
+
+Un piccolo linguaggio sulle metriche del target, con la sintassi Python
+delle espressioni:
+
+    clicks >= 20 and orders == 0 and cost > 10
+    cpc > 1.5 or (ctr < 0.2 and impressions > 5000)
+    10 <= clicks < 50 and not cvr > 5
+
+Ammessi: le metriche di rules.conditions (impressions, clicks, cost,
+orders, sales, acos, cpc, ctr, cvr), numeri, + - * /, confronti (anche
+concatenati), and / or / not e parentesi. Ogni confronto deve usare almeno
+una metrica. Nient'altro: l'albero sintattico viene controllato nodo per
+nodo prima di generare codice.
+
+Una metrica non disponibile (o un rapporto con denominatore zero) vale NaN,
+quindi ogni confronto che la usa è falso (!= escluso, come in Python).
+
+L'espressione viene analizzata una volta sola e compilata in due forme:
+- scalare: una lambda Python (bytecode in cache) per rules.engine;
+- vettoriale: la stessa espressione su array NumPy (& | ~ al posto di
+  and / or / not), per rules.batch e rules.backtest.
+I compilati sono memoizzati per hash della forma normalizzata: testi
+equivalenti (spazi, parentesi superflue) condividono lo stesso oggetto.
+"""
+
+import ast
+import hashlib
+import math
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .conditions import METRIC_BID_POLARITY, METRICS, base_metrics, metric_value
+
+EXPRESSION_RULE_TYPE = "EXPRESSION"
+
+MAX_EXPRESSION_LENGTH = 500
+MAX_NODES = 200
+
+NAN = math.nan
+
+_COMPARE_OPS = {
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+}
+_ARITH_OPS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*"}
+
+
+class ExpressionError(ValueError):
+    """Espressione non valida (sintassi o costrutto non ammesso)."""
+
+
+def _div(a: float, b: float) -> float:
+    # b NaN è "vero": a / NaN = NaN
+    return a / b if b else NAN
+
+
+def _np_div(a, b):
+    import numpy as np
+
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    out = np.full(a.shape, np.nan)
+    np.divide(a, b, out=out, where=b != 0)
+    return out
+
+
+class _Generator:
+    """Valida l'albero e genera il sorgente scalare e quello vettoriale."""
+
+    def __init__(self):
+        self.names = []
+        self.metric_seen = False
+
+    def boolean(self, node: ast.AST) -> Tuple[str, str]:
+        if isinstance(node, ast.BoolOp):
+            parts = [self.boolean(v) for v in node.values]
+            if isinstance(node.op, ast.And):
+                return (
+                    "(" + " and ".join(p[0] for p in parts) + ")",
+                    "(" + " & ".join(p[1] for p in parts) + ")",
+                )
+            return (
+                "(" + " or ".join(p[0] for p in parts) + ")",
+                "(" + " | ".join(p[1] for p in parts) + ")",
+            )
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            scalar, vector = self.boolean(node.operand)
+            return f"(not {scalar})", f"(~{vector})"
+        if isinstance(node, ast.Compare):
+            self.metric_seen = False
+            operands = [self.number(node.left)] + [self.number(c) for c in node.comparators]
+            if not self.metric_seen:
+                # costante: nel sorgente NumPy sarebbe un bool Python (~True == -2)
+                raise ExpressionError("Confronto senza metriche: " + _describe(node))
+            scalar = [operands[0][0]]
+            vector = []
+            for k, op in enumerate(node.ops):
+                symbol = _COMPARE_OPS.get(type(op))
+                if symbol is None:
+                    raise ExpressionError(f"Confronto non ammesso: {type(op).__name__}")
+                scalar.append(f"{symbol} {operands[k + 1][0]}")
+                vector.append(f"({operands[k][1]} {symbol} {operands[k + 1][1]})")
+            return "(" + " ".join(scalar) + ")", "(" + " & ".join(vector) + ")"
+        raise ExpressionError(
+            "Attesa una condizione (confronto, and, or, not), trovato: " + _describe(node)
+        )
+
+    def number(self, node: ast.AST) -> Tuple[str, str]:
+        if isinstance(node, ast.Name):
+            if node.id not in METRICS:
+                raise ExpressionError(
+                    f"Metrica sconosciuta: {node.id!r} (ammesse: {', '.join(METRICS)})"
+                )
+            if node.id not in self.names:
+                self.names.append(node.id)
+            self.metric_seen = True
+            return node.id, node.id
+        if isinstance(node, ast.Constant):
+            value = node.value
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ExpressionError(f"Costante non ammessa: {value!r}")
+            text = repr(float(value))
+            return text, text
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            scalar, vector = self.number(node.operand)
+            sign = "-" if isinstance(node.op, ast.USub) else "+"
+            return f"({sign}{scalar})", f"({sign}{vector})"
+        if isinstance(node, ast.BinOp):
+            left, right = self.number(node.left), self.number(node.right)
+            if isinstance(node.op, ast.Div):
+                return f"_div({left[0]}, {right[0]})", f"_div({left[1]}, {right[1]})"
+            symbol = _ARITH_OPS.get(type(node.op))
+            if symbol is None:
+                raise ExpressionError(f"Operatore non ammesso: {type(node.op).__name__}")
+            return f"({left[0]} {symbol} {right[0]})", f"({left[1]} {symbol} {right[1]})"
+        raise ExpressionError("Atteso un valore numerico, trovato: " + _describe(node))
+
+
+def _describe(node: ast.AST) -> str:
+    try:
+        return f"{type(node).__name__} ({ast.unparse(node)})"
+    except Exception:
+        return type(node).__name__
+
+
+class CompiledExpression:
+    """Espressione validata e compilata (una istanza per forma normalizzata)."""
+
+    def __init__(self, text: str, tree: ast.Expression):
+        self.text = text
+        self.normalized = ast.unparse(tree)
+        self.hash = expression_hash(self.normalized)
+
+        gen = _Generator()
+        scalar_src, vector_src = gen.boolean(tree.body)
+        if not gen.names:
+            raise ExpressionError("L'espressione deve usare almeno una metrica")
+        self.names: Tuple[str, ...] = tuple(gen.names)
+        self._vector_src = vector_src
+        self._vector: Optional[Callable[..., Any]] = None
+
+        args = ", ".join(self.names)
+        code = compile(f"lambda {args}: {scalar_src}", f"<rule expression {self.hash[:8]}>", "eval")
+        self._scalar = eval(code, {"__builtins__": {}, "_div": _div})
+        self.box = _condition_box(tree.body)
+
+    def __repr__(self) -> str:
+        return f"CompiledExpression({self.normalized!r})"
+
+    @property
+    def base_metrics(self):
+        """Metriche di base da caricare (es. storico del backtest)."""
+        return base_metrics(self.names)
+
+    def matches(self, target: Dict[str, Any]) -> bool:
+        """Valuta su un target nel formato di rules.engine (metriche derivate incluse)."""
+        args = []
+        for name in self.names:
+            v = metric_value(target, name)
+            args.append(NAN if v is None else v)
+        return bool(self._scalar(*args))
+
+    def mask(self, arrays: Dict[str, Any], n: int):
+        """
+        Maschera booleana NumPy di lunghezza n; arrays: metrica -> array float
+        (NaN = non disponibile), solo per self.names.
+        """
+        import numpy as np
+
+        if self._vector is None:
+            code = compile(
+                f"lambda {', '.join(self.names)}: {self._vector_src}",
+                f"<rule expression {self.hash[:8]} (numpy)>",
+                "eval",
+            )
+            self._vector = eval(code, {"__builtins__": {}, "_div": _np_div})
+        with np.errstate(invalid="ignore"):
+            result = self._vector(*(arrays[name] for name in self.names))
+        return np.broadcast_to(np.asarray(result, dtype=bool), (n,)).copy()
+
+
+def expression_hash(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+_BY_HASH: Dict[str, CompiledExpression] = {}
+
+
+@lru_cache(maxsize=512)
+def compile_expression(text: str) -> CompiledExpression:
+    """
+    Analizza e compila un'espressione (ExpressionError se non valida).
+    Memoizzata per testo e, sotto, per hash della forma normalizzata.
+    """
+    if not isinstance(text, str) or not text.strip():
+        raise ExpressionError("Espressione vuota")
+    if len(text) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError(f"Espressione troppo lunga (max {MAX_EXPRESSION_LENGTH} caratteri)")
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError as exc:
+        raise ExpressionError(f"Sintassi non valida: {exc.msg}") from None
+    if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+        raise ExpressionError("Espressione troppo complessa")
+
+    h = expression_hash(ast.unparse(tree))
+    compiled = _BY_HASH.get(h)
+    if compiled is None:
+        compiled = CompiledExpression(text.strip(), tree)
+        _BY_HASH[h] = compiled
+    return compiled
+
+
+def normalize_expression(text: Any) -> Optional[str]:
+    """Testo da salvare in rules.expression (ValueError se non valido)."""
+    if text is None or (isinstance(text, str) and not text.strip()):
+        return None
+    return compile_expression(text).text
+
+
+# ------------------------
+# Intervalli per l'analisi delle sovrapposizioni (rules.conflicts)
+# ------------------------
+
+_FLIP = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE, ast.Eq: ast.Eq}
+
+
+def _constant(node: ast.AST) -> Optional[float]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return float(node.value)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant(node.operand)
+        return None if value is None else -value
+    return None
+
+
+def _condition_box(node: ast.AST) -> Dict[str, Tuple[float, float]]:
+    """
+    Intervalli {metrica: (low, high)} implicati dall'espressione, per i soli
+    confronti metrica/costante in AND al primo livello. Il resto non
+    restringe nulla: il box contiene sempre tutti i target che soddisfano
+    l'espressione (sovrapposizioni "possibili", mai perse).
+    """
+    terms = node.values if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And) else [node]
+    box: Dict[str, Tuple[float, float]] = {}
+
+    def narrow(metric: str, op: type, value: float) -> None:
+        lo, hi = box.get(metric, (-math.inf, math.inf))
+        # estremi stretti trattati come inclusi: stima conservativa
+        if op in (ast.Gt, ast.GtE):
+            lo = max(lo, value)
+        elif op in (ast.Lt, ast.LtE):
+            hi = min(hi, value)
+        elif op is ast.Eq:
+            lo, hi = max(lo, value), min(hi, value)
+        else:
+            return
+        box[metric] = (lo, hi)
+
+    for term in terms:
+        if not isinstance(term, ast.Compare):
+            continue
+        operands = [term.left] + list(term.comparators)
+        for k, op in enumerate(term.ops):
+            left, right = operands[k], operands[k + 1]
+            if isinstance(left, ast.Name) and _constant(right) is not None:
+                narrow(left.id, type(op), _constant(right))
+            elif isinstance(right, ast.Name) and _constant(left) is not None and type(op) in _FLIP:
+                narrow(right.id, _FLIP[type(op)], _constant(left))
+    return box
+
+
+
+# ------------------------
+# Soglie strette per l'isteresi (rules.cooldown)
+# ------------------------
+
+_LOWER_OPS = (ast.Gt, ast.GtE)      # metrica > costante: soglia minima
+_UPPER_OPS = (ast.Lt, ast.LtE)
+
+
+def _tighten_constant(value: float, lower: bool, factor: float) -> ast.AST:
+    shift = abs(value) * factor
+    new = round(value + shift if lower else value - shift, 6)
+    return ast.UnaryOp(ast.USub(), ast.Constant(-new)) if new < 0 else ast.Constant(new)
+
+
+def _tighten(node: ast.AST, factor: float, polarity: bool, direction: int) -> None:
+    """
+    Stringe in place i confronti metrica/costante; sotto un not il verso si
+    inverte. direction (rules.cooldown.rule_direction): solo la soglia dal
+    lato della modifica opposta (METRIC_BID_POLARITY); 0 = entrambe.
+    """
+    if isinstance(node, ast.BoolOp):
+        for value in node.values:
+            _tighten(value, factor, polarity, direction)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        _tighten(node.operand, factor, not polarity, direction)
+    elif isinstance(node, ast.Compare):
+        operands = [node.left] + list(node.comparators)
+        last = len(node.ops)
+        for k, op in enumerate(node.ops):
+            left, right = operands[k], operands[k + 1]
+            # solo costanti agli estremi della catena: una costante in mezzo
+            # (a < 5 < b) è minimo per un lato e massimo per l'altro
+            if isinstance(left, ast.Name) and k + 1 == last and _constant(right) is not None:
+                pos, metric_op, metric = k + 1, type(op), left.id
+            elif isinstance(right, ast.Name) and k == 0 and _constant(left) is not None and type(op) in _FLIP:
+                pos, metric_op, metric = 0, _FLIP[type(op)], right.id
+            else:
+                continue
+            if metric_op in _LOWER_OPS:
+                lower = polarity
+            elif metric_op in _UPPER_OPS:
+                lower = not polarity
+            else:
+                continue
+            side = direction * METRIC_BID_POLARITY.get(metric, 0)
+            if (side > 0 and not lower) or (side < 0 and lower):
+                # soglia lontana dalla modifica opposta: invariata
+                continue
+            operands[pos] = _tighten_constant(_constant(operands[pos]), lower, factor)
+        node.left, node.comparators = operands[0], operands[1:]
+
+
+@lru_cache(maxsize=512)
+def tighten_expression(text: str, factor: float, direction: int = 0) -> str:
+    """
+    Espressione con le soglie strette di factor (0.1 = 10%): nei confronti
+    metrica/costante i minimi si alzano e i massimi si abbassano (== e !=
+    invariati, costanti dentro operazioni aritmetiche comprese). Con
+    direction (verso della regola) solo le soglie dal lato della modifica
+    opposta, come rules.cooldown.tighten_rule.
+    """
+    tree = ast.parse(compile_expression(text).normalized, mode="eval")
+    _tighten(tree.body, factor, True, direction)
+    return ast.unparse(tree)
@@ -0,0 +1,206 @@
+# rules/guardrails.py
+
+"""
+Limiti di sicurezza sui bid (tabella bid_guardrails).
+
+Ogni limite ha un ambito: GLOBAL, PROFILE, CAMPAIGN o TARGET. Per ciascun
+campo (min_bid, max_bid, max_change_pct) vale l'ambito più specifico che lo
+definisce: un limite di target sovrascrive quello della campagna, che
+sovrascrive quello del profilo, e così via. Senza righe resta il vecchio
+minimo fisso di 0.02.
+
+max_change_pct limita la variazione giornaliera rispetto al bid di inizio
+giornata (UTC), ricavato dalle esecuzioni di oggi (rule_executions): più
+regole o più run nello stesso giorno non possono superarlo sommandosi.
+I limiti assoluti prevalgono su quello di variazione.
+
+GuardrailIndex si costruisce una volta per run (db.database.load_guardrail_index):
+la ricerca dei limiti di un target sono lookup su dict, senza query al DB.
+"""
+
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# dal meno al più specifico
+SCOPES = ("GLOBAL", "PROFILE", "CAMPAIGN", "TARGET")
+GLOBAL_SCOPE_ID = "*"
+
+# minimo storico di build_bid_updates, usato se nessun limite lo ridefinisce
+DEFAULT_MIN_BID = 0.02
+
+LIMIT_FIELDS = ("min_bid", "max_bid", "max_change_pct")
+
+
+@dataclass(frozen=True)
+class Limits:
+    min_bid: Optional[float] = None
+    max_bid: Optional[float] = None
+    max_change_pct: Optional[float] = None
+
+    def merged(self, specific: Optional["Limits"]) -> "Limits":
+        """I campi definiti in specific sovrascrivono quelli di self."""
+        if specific is None:
+            return self
+        return Limits(*(
+            getattr(specific, f) if getattr(specific, f) is not None else getattr(self, f)
+            for f in LIMIT_FIELDS
+        ))
+
+
+def combine_bounds(limits: Limits, ref_bid: Optional[float]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    (min, max) effettivi per un target con bid di inizio giornata ref_bid:
+    l'intervallo di variazione consentito, riportato dentro i limiti assoluti.
+    """
+    lo, hi = limits.min_bid, limits.max_bid
+    if limits.max_change_pct is None or ref_bid is None:
+        return lo, hi
+
+    step = abs(ref_bid) * limits.max_change_pct / 100.0
+
+    def clamp(value: float) -> float:
+        if lo is not None:
+            value = max(lo, value)
+        if hi is not None:
+            value = min(hi, value)
+        return value
+
+    return clamp(ref_bid - step), clamp(ref_bid + step)
+
+
+def clamp_bid(bid: float, lo: Optional[float], hi: Optional[float]) -> float:
+    """Stesso ordine di rules.engine.apply_rule_to_target: prima il minimo, poi il massimo."""
+    if lo is not None:
+        bid = max(lo, bid)
+    if hi is not None:
+        bid = min(hi, bid)
+    return bid
+
+
+class GuardrailIndex:
+    """
+    Limiti indicizzati per ambito, più i bid di inizio giornata.
+
+    day_start_bids: {target_id: bid prima della prima modifica di oggi}; i
+    target non presenti non sono ancora stati modificati oggi, quindi il loro
+    bid corrente è anche quello di inizio giornata.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Dict[str, Any]] = (),
+        day_start_bids: Optional[Dict[str, float]] = None,
+    ):
+        self._by_scope: Dict[str, Dict[str, Limits]] = {scope: {} for scope in SCOPES}
+        for row in rows:
+            scope = row.get("scope")
+            if scope not in self._by_scope:
+                continue
+            self._by_scope[scope][str(row.get("scope_id"))] = Limits(
+                *(None if row.get(f) is None else float(row[f]) for f in LIMIT_FIELDS)
+            )
+
+        base = Limits(min_bid=DEFAULT_MIN_BID)
+        self._global = base.merged(self._by_scope["GLOBAL"].get(GLOBAL_SCOPE_ID))
+        self.day_start_bids: Dict[str, float] = dict(day_start_bids or {})
+        # (profile_id, campaign_id) -> limiti fusi: poche combinazioni, molti target
+        self._cache: Dict[Tuple[Optional[str], Optional[str]], Limits] = {}
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._by_scope.values())
+
+    @property
+    def has_rate_limits(self) -> bool:
+        """True se almeno un limite usa max_change_pct (servono i bid di inizio giornata)."""
+        return any(
+            lim.max_change_pct is not None
+            for by_id in self._by_scope.values()
+            for lim in by_id.values()
+        )
+
+    def limits(self, profile_id: Any, campaign_id: Any, target_id: Any) -> Limits:
+        key = (
+            None if profile_id is None else str(profile_id),
+            None if campaign_id is None else str(campaign_id),
+        )
+        merged = self._cache.get(key)
+        if merged is None:
+            merged = self._global
+            if key[0] is not None:
+                merged = merged.merged(self._by_scope["PROFILE"].get(key[0]))
+            if key[1] is not None:
+                merged = merged.merged(self._by_scope["CAMPAIGN"].get(key[1]))
+            self._cache[key] = merged
+
+        if target_id is None:
+            return merged
+        return merged.merged(self._by_scope["TARGET"].get(str(target_id)))
+
+    def day_start_bid(self, target_id: Any, current_bid: Optional[float]) -> Optional[float]:
+        return self.day_start_bids.get(str(target_id), current_bid)
+
+    def bounds(
+        self,
+        profile_id: Any,
+        campaign_id: Any,
+        target_id: Any,
+        current_bid: Optional[float],
+    ) -> Tuple[Optional[float], Optional[float]]:
+        """(min_bid, max_bid) da passare a apply_rule_to_target per questo target."""
+        return combine_bounds(
+            self.limits(profile_id, campaign_id, target_id),
+            self.day_start_bid(target_id, current_bid),
+        )
+
+    def bounds_for(self, target: Dict[str, Any]) -> Tuple[Optional[float], Optional[float]]:
+        """bounds() per un dict nel formato di rules.engine."""
+        bid = target.get("bid")
+        return self.bounds(
+            target.get("profile_id"),
+            target.get("campaign_id"),
+            target.get("target_id"),
+            None if bid is None else float(bid),
+        )
+
+    def note_change(self, target_id: Any, old_bid: float) -> None:
+        """Registra una modifica fatta durante il run (il primo old_bid del giorno resta)."""
+        self.day_start_bids.setdefault(str(target_id), old_bid)
+
+    def column_bounds(self, cols, profile_id: Any = None) -> Tuple[array, array]:
+        """
+        Limiti per tutte le posizioni di un rules.batch.TargetColumns, come
+        due array("d") allineati (NaN = nessun limite). profile_id vale per
+        tutti i target se cols non ha la colonna profile_id.
+        """
+        nan = float("nan")
+        lows = array("d")
+        highs = array("d")
+        profiles = getattr(cols, "profile_id", None)
+        for i in range(len(cols)):
+            bid = cols.bid[i]
+            lo, hi = self.bounds(
+                profiles[i] if profiles is not None else profile_id,
+                cols.campaign_id[i],
+                cols.target_id[i],
+                None if bid is None else float(bid),
+            )
+            lows.append(nan if lo is None else lo)
+            highs.append(nan if hi is None else hi)
+        return lows, highs
+
+    def column_limits(self, cols, profile_id: Any = None) -> Dict[str, array]:
+        """Limiti grezzi per posizione (per il backtest, che ricalcola i bound ogni giorno)."""
+        nan = float("nan")
+        out = {f: array("d") for f in LIMIT_FIELDS}
+        profiles = getattr(cols, "profile_id", None)
+        for i in range(len(cols)):
+            lim = self.limits(
+                profiles[i] if profiles is not None else profile_id,
+                cols.campaign_id[i],
+                cols.target_id[i],
+            )
+            for f in LIMIT_FIELDS:
+                value = getattr(lim, f)
+                out[f].append(nan if value is None else value)
+        return out
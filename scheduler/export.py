@@ -0,0 +1,243 @@
+# scheduler/export.py
+
+"""
+Export incrementale dello storico in Parquet, per le analisi fuori dal DB
+di produzione (ads_rules.db resta allo scheduler).
+
+Layout (partizioni stile Hive, leggibili con pyarrow.dataset, DuckDB,
+pandas.read_parquet):
+
+    data/export/rule_executions/date=AAAA-MM-GG/profile_id=<id>/part-<primo id>-<ultimo id>.parquet
+    data/export/daily_metrics/date=AAAA-MM-GG/profile_id=<id>/part-0.parquet
+
+- rule_executions: solo le righe con id oltre il watermark (tabella
+  settings), lette a blocchi per chiave primaria: ogni lettura è breve e non
+  blocca gli scrittori. Il watermark avanza dopo la scrittura dei file; un
+  export interrotto riscrive lo stesso blocco con gli stessi nomi.
+- daily_metrics (db.daily_metrics): i giorni scritti o sostituiti dopo
+  l'ultimo export (mtime della cartella del giorno, watermark per profilo).
+
+pyarrow è una dipendenza opzionale, importata solo qui dentro.
+
+Da riga di comando:
+    python -m scheduler.export [--only executions|metrics] [--output DIR]
+"""
+
+import json
+import os
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from db.database import BASE_DIR, get_executions_after, get_setting, set_setting
+
+EXPORT_DIR = BASE_DIR / "data" / "export"
+BATCH_ROWS = 50_000
+COMPRESSION = "zstd"
+
+EXECUTIONS_WATERMARK_KEY = "export_watermark:rule_executions"
+METRICS_WATERMARK_KEY = "export_watermark:daily_metrics"
+
+# valore di partizione per profilo non noto (letto come null da pyarrow)
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+@dataclass
+class ExportResult:
+    table: str
+    rows: int = 0
+    files: List[str] = field(default_factory=list)
+    watermark: Any = None
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "table": self.table,
+            "rows": self.rows,
+            "files": len(self.files),
+            "watermark": self.watermark,
+        }
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Export Parquet: installare pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+
+def _write_parquet(table, path: Path) -> None:
+    """Scrittura atomica: file temporaneo nella stessa cartella, poi os.replace."""
+    pa = _pyarrow()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    pa.parquet.write_table(table, tmp, compression=COMPRESSION)
+    os.replace(tmp, path)
+
+
+def _partition_dir(base: Path, day: str, profile_id: Any) -> Path:
+    profile = NULL_PARTITION if profile_id in (None, "") else str(profile_id)
+    return base / f"date={day}" / f"profile_id={profile}"
+
+
+# ------------------------
+# rule_executions
+# ------------------------
+
+def _executions_schema():
+    pa = _pyarrow()
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("rule_id", pa.int64()),
+            ("run_at", pa.timestamp("s", tz="UTC")),
+            ("target_id", pa.string()),
+            ("campaign_id", pa.string()),
+            ("keyword_text", pa.string()),
+            ("match_type", pa.string()),
+            ("old_bid", pa.float64()),
+            ("new_bid", pa.float64()),
+            ("acos", pa.float64()),
+            ("clicks", pa.int64()),
+            ("impressions", pa.int64()),
+            ("action", pa.string()),
+            ("message", pa.string()),
+        ]
+    )
+
+
+def _executions_table(rows: List[Dict[str, Any]]):
+    pa = _pyarrow()
+    schema = _executions_schema()
+    columns = {}
+    for f in schema:
+        values = [r.get(f.name) for r in rows]
+        if f.name == "run_at":
+            # "AAAA-MM-GGTHH:MM:SSZ" -> timestamp, vettoriale
+            raw = pa.array(values, type=pa.string())
+            columns[f.name] = pa.compute.strptime(raw, format="%Y-%m-%dT%H:%M:%SZ", unit="s").cast(f.type)
+        else:
+            columns[f.name] = pa.array(values, type=f.type)
+    return pa.table(columns, schema=schema)
+
+
+def export_executions(output_dir: Path = EXPORT_DIR, batch_rows: int = BATCH_ROWS) -> ExportResult:
+    """Esporta le righe di rule_executions oltre il watermark, a blocchi di batch_rows."""
+    _pyarrow()
+    base = Path(output_dir) / "rule_executions"
+    watermark = int(get_setting(EXECUTIONS_WATERMARK_KEY, "0") or 0)
+    result = ExportResult("rule_executions", watermark=watermark)
+
+    while True:
+        rows = get_executions_after(watermark, batch_rows)
+        if not rows:
+            break
+        partitions: Dict[tuple, List[Dict[str, Any]]] = defaultdict(list)
+        for r in rows:
+            partitions[(r["run_at"][:10], r.get("profile_id"))].append(r)
+
+        for (day, profile_id), part in partitions.items():
+            path = _partition_dir(base, day, profile_id) / f"part-{part[0]['id']:012d}-{part[-1]['id']:012d}.parquet"
+            _write_parquet(_executions_table(part), path)
+            result.files.append(str(path))
+
+        watermark = rows[-1]["id"]
+        set_setting(EXECUTIONS_WATERMARK_KEY, str(watermark))
+        result.rows += len(rows)
+        result.watermark = watermark
+        if len(rows) < batch_rows:
+            break
+    return result
+
+
+# ------------------------
+# daily_metrics
+# ------------------------
+
+def _metrics_table(columns: Dict[str, Any]):
+    import numpy as np
+
+    from db.daily_metrics import DAILY_COLUMNS
+
+    pa = _pyarrow()
+    dtypes = {"q": np.int64, "d": np.float64}
+    return pa.table(
+        {
+            name: pa.array(np.frombuffer(columns[name], dtype=dtypes[code]))
+            for name, code in DAILY_COLUMNS.items()
+        }
+    )
+
+
+def export_daily_metrics(output_dir: Path = EXPORT_DIR) -> ExportResult:
+    """
+    Esporta i giorni di metriche scritti o sostituiti dopo l'ultimo export
+    (un file per giorno e profilo, sovrascritto se il giorno cambia).
+    """
+    from db.daily_metrics import DAILY_METRICS_DIR, available_days, read_daily_metrics
+
+    _pyarrow()
+    base = Path(output_dir) / "daily_metrics"
+    watermarks: Dict[str, int] = json.loads(get_setting(METRICS_WATERMARK_KEY, "{}") or "{}")
+    result = ExportResult("daily_metrics", watermark=watermarks)
+
+    if not DAILY_METRICS_DIR.is_dir():
+        return result
+
+    for profile_dir in sorted(p for p in DAILY_METRICS_DIR.iterdir() if p.is_dir()):
+        profile_id = profile_dir.name
+        last = watermarks.get(profile_id, 0)
+        newest = last
+        for day in available_days(profile_id):
+            mtime = (profile_dir / day).stat().st_mtime_ns
+            if mtime <= last:
+                continue
+            columns = read_daily_metrics(profile_id, day)
+            if columns is None:
+                continue
+            table = _metrics_table(columns)
+            path = _partition_dir(base, day, profile_id) / "part-0.parquet"
+            _write_parquet(table, path)
+            result.files.append(str(path))
+            result.rows += table.num_rows
+            newest = max(newest, mtime)
+        if newest != last:
+            watermarks[profile_id] = newest
+            set_setting(METRICS_WATERMARK_KEY, json.dumps(watermarks, sort_keys=True))
+    return result
+
+
+def run_export(output_dir: Path = EXPORT_DIR, only: Optional[str] = None) -> List[ExportResult]:
+    results = []
+    if only in (None, "executions"):
+        results.append(export_executions(output_dir))
+    if only in (None, "metrics"):
+        results.append(export_daily_metrics(output_dir))
+    return results
+
+
+def main() -> int:
+    import argparse
+
+    from db.database import init_db
+
+    parser = argparse.ArgumentParser(description="Export incrementale dello storico in Parquet")
+    parser.add_argument("--only", choices=["executions", "metrics"], help="esporta una sola sorgente")
+    parser.add_argument("--output", default=str(EXPORT_DIR), help="cartella di destinazione")
+    args = parser.parse_args()
+
+    init_db()
+    try:
+        results = run_export(Path(args.output), args.only)
+    except RuntimeError as exc:
+        print(exc)
+        return 1
+    print(json.dumps([r.summary() for r in results], indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
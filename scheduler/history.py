@@ -0,0 +1,134 @@
+# scheduler/history.py
+
+"""
+Raccolta incrementale dello storico metriche giornaliere (db.daily_metrics).
+
+Si scaricano i giorni mancanti più gli ultimi ATTRIBUTION_WINDOW_DAYS
+(ordini e vendite attribuiti a 14 giorni cambiano ancora dopo il primo
+download), con report DAILY a blocchi di REPORT_CHUNK_DAYS giorni: dopo il
+primo riempimento basta un report per profilo. A ogni sync si aggiorna
+anche il riepilogo della spesa usato per l'ordine delle regole
+(scheduler.priority).
+
+Job separato dallo scheduler (le regole non aspettano i report DAILY),
+da cron una volta al giorno:
+
+    python -m scheduler.history [--days 95]
+"""
+
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional
+
+from db.daily_metrics import available_days, prune_daily_metrics, write_daily_metrics
+
+HISTORY_DAYS = 95            # copre il timeframe "Lifetime" del report v3
+REPORT_CHUNK_DAYS = 14
+ATTRIBUTION_WINDOW_DAYS = 14   # finestra di attribuzione di purchases14d / sales14d
+
+
+def days_to_sync(
+    profile_id: Any,
+    days: int = HISTORY_DAYS,
+    end: Optional[date] = None,
+    refresh_days: int = ATTRIBUTION_WINDOW_DAYS,
+) -> List[date]:
+    """
+    Giorni (fino a ieri) da scaricare: quelli non ancora su disco più gli
+    ultimi refresh_days, ancora aperti all'attribuzione.
+    """
+    if end is None:
+        end = date.today() - timedelta(days=1)
+    have = set(available_days(profile_id))
+    wanted = [end - timedelta(days=d) for d in range(days - 1, -1, -1)]
+    refresh_from = end - timedelta(days=refresh_days - 1)
+    return [d for d in wanted if d >= refresh_from or d.isoformat() not in have]
+
+
+def _chunks(days: List[date], size: int) -> List[List[date]]:
+    """Raggruppa giorni consecutivi in blocchi di al massimo size giorni."""
+    chunks: List[List[date]] = []
+    for d in days:
+        last = chunks[-1] if chunks else None
+        if last and len(last) < size and (d - last[-1]).days == 1:
+            last.append(d)
+        else:
+            chunks.append([d])
+    return chunks
+
+
+def sync_daily_metrics(
+    access_token,
+    profile_id: Any,
+    days: int = HISTORY_DAYS,
+    campaign_ids=None,
+) -> int:
+    """
+    Scarica e salva i giorni degli ultimi `days` giorni mancanti o ancora
+    nella finestra di attribuzione (days_to_sync). Restituisce il numero di
+    giorni scritti.
+    """
+    from amazon_api.metrics_table import MetricsTable, parse_sp_targeting_daily
+    from amazon_api.report import iter_sp_targeting_daily_rows
+
+    written = 0
+    for chunk in _chunks(days_to_sync(profile_id, days), REPORT_CHUNK_DAYS):
+        rows = iter_sp_targeting_daily_rows(access_token, profile_id, campaign_ids, chunk[0], chunk[-1])
+        tables = parse_sp_targeting_daily(rows)
+        for d in chunk:
+            table = tables.get(d.isoformat())
+            if table is None:
+                # nessuna riga: giorno senza traffico, lo salviamo vuoto per non richiederlo più
+                table = MetricsTable()
+            write_daily_metrics(profile_id, d.isoformat(), table)
+            written += 1
+
+    prune_daily_metrics(profile_id, days)
+    from scheduler.priority import update_spend_summary
+
+    # totali di spesa per l'ordine delle regole: ricalcolati solo qui (anche
+    # i giorni già su disco possono essere cambiati)
+    update_spend_summary(profile_id, force=written > 0)
+    return written
+
+
+def sync_all_daily_metrics(access_token, days: int = HISTORY_DAYS) -> Dict[str, Optional[int]]:
+    """
+    sync_daily_metrics per tutti i profili del registro: {profile_id: giorni
+    scritti}, None per i profili non aggiornati (l'errore non ferma gli altri).
+    """
+    from amazon_api.profiles import load_profile_registry
+
+    written: Dict[str, Optional[int]] = {}
+    for prof in load_profile_registry(access_token):
+        profile_id = str(prof["profileId"])
+        try:
+            written[profile_id] = sync_daily_metrics(access_token, profile_id, days)
+        except Exception as exc:
+            written[profile_id] = None
+            print(f"[HISTORY] profilo {profile_id}: storico giornaliero non aggiornato: {exc}")
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+    import json
+
+    from auth import ensure_access_token
+    from db.database import init_db
+    from settings import require_credentials
+
+    parser = argparse.ArgumentParser(description="Storico metriche giornaliere (report DAILY)")
+    parser.add_argument("--days", type=int, default=HISTORY_DAYS, help="giorni di storico da mantenere")
+    args = parser.parse_args(argv)
+    if args.days < 1:
+        parser.error("--days deve essere almeno 1")
+
+    init_db()
+    require_credentials()
+    written = sync_all_daily_metrics(ensure_access_token, args.days)
+    print(json.dumps(written, sort_keys=True))
+    return 1 if None in written.values() else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+# scheduler/pipeline.py
+
+"""
+Pipeline dati: target (configurazione) + report metriche -> tabella unita.
+
+La tabella unita viene salvata come snapshot mmap per profilo (db.snapshot),
+così app Streamlit, scheduler e analisi ad-hoc la riaprono in millisecondi
+invece di richiamare le API.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional
+
+from db.snapshot import TargetSnapshot, open_snapshot, write_snapshot
+
+# Uno snapshot più vecchio di così viene ricostruito dallo scheduler
+SNAPSHOT_MAX_AGE_SECONDS = 3600
+
+DEFAULT_TIMEFRAME_DAYS = 14
+# timeframe "Lifetime" (-1): il report v3 copre al massimo ~95 giorni
+LIFETIME_TIMEFRAME_DAYS = 95
+
+
+def join_targets_with_metrics(
+    targets: Iterable[Dict[str, Any]],
+    metrics,
+    marketplace: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Unisce i target restituiti da get_targets_for_campaign con le metriche
+    del report (MetricsTable o dict {targetId: metriche}).
+
+    Restituisce dict nel formato atteso da rules.engine.
+    """
+    from amazon_api.targets import flatten_target
+
+    rows = []
+    for t in targets:
+        if t.get("targetId") is None:
+            continue
+        rows.append(add_metrics(flatten_target(t), metrics, marketplace))
+    return rows
+
+
+def add_metrics(row: Dict[str, Any], metrics, marketplace: Optional[str]) -> Dict[str, Any]:
+    """Aggiunge a un target piatto le metriche del report e il marketplace."""
+    m = metrics.get(row["target_id"]) or {}
+    row["marketplace"] = marketplace
+    row["impressions"] = m.get("impressions", 0)
+    row["clicks"] = m.get("clicks", 0)
+    row["cost"] = m.get("cost", 0.0)
+    row["orders"] = m.get("orders", 0)
+    row["sales"] = m.get("sales", 0.0)
+    row["acos"] = m.get("acos")
+    return row
+
+
+def profile_marketplace(profile: Dict[str, Any]) -> Optional[str]:
+    return profile.get("countryCode") or profile.get("marketplaceString")
+
+
+def refresh_profile_snapshot(
+    access_token: str,
+    profile: Dict[str, Any],
+    timeframe_days: int = DEFAULT_TIMEFRAME_DAYS,
+    campaign_ids: Optional[List[Any]] = None,
+) -> TargetSnapshot:
+    """
+    Sincronizza il mirror di campagne/target del profilo (solo i cambiamenti
+    vengono riscritti), scarica il report metriche, unisce e scrive un nuovo
+    snapshot. Restituisce lo snapshot appena scritto.
+    """
+    from amazon_api.report import get_sp_targeting_metrics_table
+    from db.mirror import get_mirror_campaigns, get_mirror_targets
+    from scheduler.sync import sync_profile
+
+    profile_id = profile["profileId"]
+    if timeframe_days is None or timeframe_days <= 0:
+        report_days = LIFETIME_TIMEFRAME_DAYS
+    else:
+        report_days = timeframe_days
+
+    result = sync_profile(access_token, profile_id, campaign_ids)
+    print(
+        f"[SYNC] profilo {profile_id}: {result.targets} target, "
+        f"{result.new} nuovi, {result.updated} modificati, {result.removed} rimossi, "
+        f"{result.pages_skipped}/{result.pages} pagine invariate ({result.seconds:.2f}s)"
+    )
+
+    if campaign_ids is None:
+        campaign_ids = [c["campaignId"] for c in get_mirror_campaigns(profile_id)]
+    targets = get_mirror_targets(profile_id, campaign_ids)
+
+    metrics = get_sp_targeting_metrics_table(access_token, profile_id, campaign_ids, report_days)
+    rows = join_targets_with_metrics(targets, metrics, profile_marketplace(profile))
+
+    path = write_snapshot(
+        profile_id,
+        rows,
+        timeframe_days,
+        extra_meta={"campaign_ids": [str(c) for c in campaign_ids]},
+    )
+    return TargetSnapshot(path)
+
+
+def load_profile_targets(
+    access_token: str,
+    profile: Dict[str, Any],
+    timeframe_days: int = DEFAULT_TIMEFRAME_DAYS,
+    max_age_seconds: float = SNAPSHOT_MAX_AGE_SECONDS,
+) -> TargetSnapshot:
+    """Snapshot del profilo: quello su disco se abbastanza recente, altrimenti nuovo."""
+    snap = open_snapshot(profile["profileId"], timeframe_days)
+    if snap is not None:
+        if snap.age_seconds() <= max_age_seconds:
+            return snap
+        snap.close()
+    return refresh_profile_snapshot(access_token, profile, timeframe_days)
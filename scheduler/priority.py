@@ -0,0 +1,311 @@
+# scheduler/priority.py
+
+"""
+Ordine di esecuzione delle regole dovute per impatto stimato.
+
+Quando un run non finisce nel suo budget di tempo (runner --budget), le
+regole rinviate e le modifiche non inviate devono essere quelle che contano
+meno. L'impatto di una regola è la spesa recente nel suo ambito, pesata
+con la priorità:
+
+    impatto = spesa ultimi SPEND_WINDOW_DAYS giorni (campagna della regola,
+              oppure profili del suo marketplace) x DEFAULT_PRIORITY / priority
+
+(priority 50 conta il doppio del default 100, priority 200 la metà).
+
+La spesa viene dallo storico giornaliero (db.daily_metrics); per i profili
+senza storico si usa l'ultimo snapshot (db.snapshot), riportato alla stessa
+finestra. La campagna di ogni target si ricava dallo snapshot.
+
+I totali dallo storico cambiano solo quando arriva un giorno nuovo:
+scheduler.history.sync_daily_metrics li salva (update_spend_summary) in un
+piccolo file JSON per profilo, con la campagna di ogni target presa dal
+mirror. Un run legge quel file finché l'ultimo giorno su disco è quello
+del riepilogo, senza rileggere i giorni target per target.
+
+L'ordine cambia solo tra regole indipendenti: una regola parte sempre dopo
+le regole dovute che la precedono in rules.conflicts e si sovrappongono a
+essa, quindi il risultato di un run completo resta quello di prima.
+"""
+
+import json
+import os
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SPEND_WINDOW_DAYS = 7
+# riepilogo della spesa nella cartella dello storico del profilo (db.daily_metrics)
+SPEND_SUMMARY_FILE = "spend_summary.json"
+
+
+class SpendIndex:
+    """Spesa recente per profilo e per campagna (stessa valuta del profilo)."""
+
+    def __init__(self, profiles: Dict[str, float], campaigns: Dict[str, float], days: int):
+        self.profiles = profiles
+        self.campaigns = campaigns
+        self.days = days
+
+    def __bool__(self) -> bool:
+        return any(self.profiles.values())
+
+    def of_profiles(self, profile_ids: Optional[Iterable[Any]] = None) -> float:
+        """Spesa dei profili indicati; None = tutti."""
+        if profile_ids is None:
+            return sum(self.profiles.values())
+        return sum(self.profiles.get(str(p), 0.0) for p in profile_ids)
+
+    def of_campaign(self, campaign_id: Any) -> float:
+        return self.campaigns.get(str(campaign_id), 0.0) if campaign_id is not None else 0.0
+
+
+def _profile_spend(
+    profile_id: str,
+    days: int,
+    profiles: Dict[str, float],
+    campaigns: Dict[str, float],
+    mapping: Optional[Tuple[Any, Any]] = None,
+) -> None:
+    """
+    Somma la spesa del profilo in profiles e quella per campagna in
+    campaigns. mapping: (target_id, campaign_id) come array int64 ordinati
+    per target_id; None = dallo snapshot.
+    """
+    import numpy as np
+
+    from db.daily_metrics import available_days, read_daily_metrics
+    from db.snapshot import open_snapshot
+    from scheduler.pipeline import LIFETIME_TIMEFRAME_DAYS
+
+    ids: List[Any] = []
+    costs: List[Any] = []
+    for day in available_days(profile_id)[-days:]:
+        columns = read_daily_metrics(profile_id, day)
+        if columns is not None:
+            ids.append(np.frombuffer(columns["target_id"], dtype=np.int64))
+            costs.append(np.frombuffer(columns["cost"], dtype=np.float64))
+
+    snap_ids = snap_campaigns = None
+    if mapping is not None and ids:
+        snap_ids, snap_campaigns = mapping
+    snap = open_snapshot(profile_id) if snap_ids is None else None
+    if snap is not None:
+        # copie: le viste mmap dello snapshot si chiudono subito
+        with snap:
+            snap_ids = np.frombuffer(snap.columns["target_id"], dtype=np.int64).copy()
+            snap_campaigns = np.frombuffer(snap.columns["campaign_id"], dtype=np.int64).copy()
+            if not ids:
+                # niente storico: spesa del timeframe dello snapshot, riportata alla finestra
+                timeframe = snap.meta.get("timeframe_days") or 0
+                if timeframe <= 0:
+                    timeframe = LIFETIME_TIMEFRAME_DAYS
+                ids.append(snap_ids)
+                costs.append(np.frombuffer(snap.columns["cost"], dtype=np.float64) * (days / timeframe))
+    if not ids:
+        return
+
+    target_ids = np.concatenate(ids)
+    cost = np.concatenate(costs)
+    profiles[profile_id] = float(cost.sum())
+    if snap_ids is None or not len(snap_ids):
+        return
+
+    # campagna di ogni riga: snapshot ordinato per target_id -> searchsorted
+    pos = np.minimum(np.searchsorted(snap_ids, target_ids), len(snap_ids) - 1)
+    found = snap_ids[pos] == target_ids
+    camp = snap_campaigns[pos[found]]
+    keep = camp >= 0
+    uniq, inverse = np.unique(camp[keep], return_inverse=True)
+    sums = np.bincount(inverse, weights=cost[found][keep], minlength=len(uniq))
+    for campaign_id, value in zip(uniq.tolist(), sums.tolist()):
+        campaigns[str(campaign_id)] = campaigns.get(str(campaign_id), 0.0) + value
+
+
+def _mirror_mapping(profile_id: str) -> Optional[Tuple[Any, Any]]:
+    """(target_id, campaign_id) dei target nel mirror, ordinati per target_id; None se vuoto."""
+    import numpy as np
+
+    from db.database import get_connection
+
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT target_id, campaign_id FROM targets_mirror WHERE profile_id = ?;",
+            (str(profile_id),),
+        ).fetchall()
+    pairs = []
+    for target_id, campaign_id in rows:
+        try:
+            pairs.append((int(target_id), int(campaign_id) if campaign_id is not None else -1))
+        except ValueError:
+            continue
+    if not pairs:
+        return None
+    pairs.sort()
+    return (
+        np.array([t for t, _ in pairs], dtype=np.int64),
+        np.array([c for _, c in pairs], dtype=np.int64),
+    )
+
+
+def _summary_path(profile_id: str):
+    from db.daily_metrics import DAILY_METRICS_DIR
+
+    return DAILY_METRICS_DIR / str(profile_id) / SPEND_SUMMARY_FILE
+
+
+def _read_spend_summary(profile_id: str, days: int) -> Optional[Dict[str, Any]]:
+    """Riepilogo salvato, se ancora valido (stessa finestra, nessun giorno nuovo)."""
+    from db.daily_metrics import available_days
+
+    try:
+        with open(_summary_path(profile_id), "r", encoding="utf-8") as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return None
+    history = available_days(profile_id)
+    if not history or summary.get("days") != days or summary.get("last_day") != history[-1]:
+        return None
+    return summary
+
+
+def update_spend_summary(profile_id: Any, days: int = SPEND_WINDOW_DAYS, force: bool = False) -> bool:
+    """
+    Salva i totali di spesa dello storico del profilo per load_spend_index,
+    se il riepilogo su disco manca o è superato da un giorno nuovo (con
+    force=True comunque: giorni già presenti riscaricati). Da chiamare dopo
+    aver scritto i giorni (scheduler.history); senza storico non scrive
+    nulla. True se il riepilogo è stato riscritto.
+    """
+    from db.daily_metrics import available_days
+
+    profile_id = str(profile_id)
+    history = available_days(profile_id)
+    if not history or (not force and _read_spend_summary(profile_id, days) is not None):
+        return False
+    profiles: Dict[str, float] = {}
+    campaigns: Dict[str, float] = {}
+    _profile_spend(profile_id, days, profiles, campaigns, _mirror_mapping(profile_id))
+
+    path = _summary_path(profile_id)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "days": days,
+                "last_day": history[-1],
+                "profile": profiles.get(profile_id, 0.0),
+                "campaigns": campaigns,
+            },
+            f,
+        )
+    os.replace(tmp, path)
+    return True
+
+
+def _known_profiles() -> List[str]:
+    from db.daily_metrics import DAILY_METRICS_DIR
+    from db.snapshot import SNAPSHOT_DIR
+
+    found = set()
+    for base in (DAILY_METRICS_DIR, SNAPSHOT_DIR):
+        if base.is_dir():
+            found.update(p.name for p in base.iterdir() if p.is_dir() and not p.name.startswith("."))
+    return sorted(found)
+
+
+def load_spend_index(profile_ids: Optional[Iterable[Any]] = None, days: int = SPEND_WINDOW_DAYS) -> SpendIndex:
+    """
+    Spesa degli ultimi `days` giorni per profilo e campagna. profile_ids
+    None = tutti i profili con storico o snapshot su disco. Dal riepilogo
+    salvato (update_spend_summary) se aggiornato, altrimenti dai dati.
+    """
+    profiles: Dict[str, float] = {}
+    campaigns: Dict[str, float] = {}
+    ids = _known_profiles() if profile_ids is None else [str(p) for p in profile_ids]
+    for profile_id in ids:
+        summary = _read_spend_summary(profile_id, days)
+        if summary is None:
+            _profile_spend(profile_id, days, profiles, campaigns)
+            continue
+        profiles[profile_id] = float(summary["profile"])
+        for campaign_id, value in summary["campaigns"].items():
+            campaigns[campaign_id] = campaigns.get(campaign_id, 0.0) + value
+    return SpendIndex(profiles, campaigns, days)
+
+
+def rule_impact(rule: Dict[str, Any], spend: SpendIndex, registry=None) -> float:
+    """
+    Spesa nell'ambito della regola pesata con la priorità. registry:
+    amazon_api.profiles.ProfileRegistry per i profili del marketplace
+    (None = tutti i profili).
+    """
+    from rules.conflicts import DEFAULT_PRIORITY
+
+    if rule.get("campaign_id"):
+        base = spend.of_campaign(rule["campaign_id"])
+    elif registry is not None:
+        base = spend.of_profiles(p["profileId"] for p in registry.by_marketplace(rule.get("marketplace")))
+    else:
+        base = spend.of_profiles()
+    priority = rule.get("priority")
+    if priority is None:
+        priority = DEFAULT_PRIORITY
+    return base * DEFAULT_PRIORITY / max(priority, 1)
+
+
+def schedule_rules(
+    rules: List[Dict[str, Any]],
+    analysis,
+    spend: SpendIndex,
+    registry=None,
+) -> List[Dict[str, Any]]:
+    """
+    Regole (già nell'ordine di rules.conflicts) riordinate per impatto
+    decrescente. Una regola esce solo dopo le regole dovute che la
+    precedono e si sovrappongono a essa (analysis.overlapping_earlier); a
+    parità di impatto vale l'ordine di partenza.
+    """
+    if len(rules) < 2 or not spend:
+        return list(rules)
+
+    impact = {r["id"]: rule_impact(r, spend, registry) for r in rules}
+    due = {r["id"] for r in rules}
+    waiting = {r["id"]: set(analysis.overlapping_earlier(r["id"])) & due for r in rules}
+    blocks: Dict[Any, List[Any]] = defaultdict(list)
+    for rid, deps in waiting.items():
+        for dep in deps:
+            blocks[dep].append(rid)
+
+    pending = list(rules)
+    ordered: List[Dict[str, Any]] = []
+    while pending:
+        ready = [r for r in pending if not waiting[r["id"]]]
+        # max stabile: la prima in ordine di partenza tra quelle a pari impatto
+        best = max(ready, key=lambda r: impact[r["id"]])
+        pending.remove(best)
+        ordered.append(best)
+        for rid in blocks[best["id"]]:
+            waiting[rid].discard(best["id"])
+    return ordered
+
+
+def prioritize(rules: List[Dict[str, Any]], analysis):
+    """
+    (regole riordinate, SpendIndex) per lo scheduler. Spesa solo dei profili
+    dei marketplace delle regole, se il registro profili è in cache; senza
+    dati di spesa l'ordine resta quello di rules.conflicts.
+    """
+    from amazon_api.profiles import load_profile_registry
+
+    try:
+        registry = load_profile_registry()
+    except RuntimeError:
+        registry = None
+
+    profile_ids = None
+    if registry is not None:
+        profile_ids = sorted(
+            {str(p["profileId"]) for r in rules for p in registry.by_marketplace(r.get("marketplace"))}
+        )
+    spend = load_spend_index(profile_ids)
+    return schedule_rules(rules, analysis, spend, registry), spend
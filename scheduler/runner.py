@@ -1,31 +1,58 @@
 # scheduler/runner.py
 
 import time
+from collections import Counter
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from db.database import (
     init_db,
     get_due_rules,
     update_rule_last_run,
-    log_rule_execution,
+    log_rule_run,
+    get_execution_log_detail,
+    get_rule_analysis,
+    get_conflict_policy,
+    load_guardrail_index,
+    load_bid_state_index,
+    get_bids_changed_since,
+    record_bid_changes,
+    record_rule_runs,
 )
-from rules.engine import apply_rule_to_target
+
+# Avvio da cron (python -m scheduler.runner): all'import solo db.database.
+# Motore regole, auth/requests e pipeline si caricano quando c'è davvero una
+# regola da eseguire: un run senza regole dovute parte ed esce in pochi ms.
 
 
 # -------------------------------------------
-# Queste funzioni vanno collegate al tuo codice Amazon
+# Collegamento al modulo amazon_api
 # -------------------------------------------
 
-def fetch_targets_for_rule(rule: Dict[str, Any]) -> List[Dict[str, Any]]:
+def fetch_targets_for_rule(rule: Dict[str, Any], refresh: bool = True) -> List[Dict[str, Any]]:
     """
-    TODO: integra con il tuo modulo amazon_api.
-
-    Deve restituire una lista di dict del tipo:
+    Target (con metriche) su cui valutare la regola, per tutti i profili del
+    marketplace della regola.
+
+    Legge lo snapshot mmap del profilo se abbastanza recente
+    (pipeline.SNAPSHOT_MAX_AGE_SECONDS), altrimenti lo ricostruisce dalle API.
+    I bid modificati dopo la creazione dello snapshot (scheduler o pagina
+    Modifica Bid, in target_bid_state) sostituiscono quelli dello snapshot:
+    un run successivo parte dal bid in vigore, non da quello vecchio.
+    Con refresh=False (dry run) nessuna chiamata API e nessuna scrittura:
+    registro profili in cache e snapshot su disco di qualunque età; i
+    profili senza snapshot del timeframe restano fuori.
+    rule["marketplace"] viene riscritto con il codice dei profili trovati
+    (alias UK/GB, minuscole, marketplaceStringId), quello dei target: i
+    filtri del motore lo confrontano con ==.
+    Restituisce una lista di dict del tipo:
 
     {
         "target_id": "123",
         "campaign_id": "456",
+        "profile_id": "789",
         "keyword_text": "example",
         "match_type": "exact",
         "marketplace": "US",
@@ -33,108 +60,666 @@ def fetch_targets_for_rule(rule: Dict[str, Any]) -> List[Dict[str, Any]]:
         "acos": 25.3,
         "clicks": 23,
         "impressions": 1234,
+        ...
     }
-
-    Usa rule["timeframe_days"] per decidere il periodo di analisi.
     """
-    raise NotImplementedError("Collega fetch_targets_for_rule al modulo amazon_api.")
-
-
-def update_bid_in_amazon(target: Dict[str, Any], new_bid: float) -> None:
+    from amazon_api.profiles import load_profile_registry
+    from db.snapshot import open_snapshot
+    from scheduler.pipeline import DEFAULT_TIMEFRAME_DAYS, load_profile_targets
+
+    access_token = None
+    if refresh:
+        from auth import ensure_access_token
+
+        # provider, non stringa: ogni richiesta HTTP legge il token corrente
+        access_token = ensure_access_token
+    marketplace = rule.get("marketplace")
+    timeframe_days = rule.get("timeframe_days") or DEFAULT_TIMEFRAME_DAYS
+
+    # profili dal registro in cache (tabella settings): niente /v2/profiles a ogni regola
+    registry = load_profile_registry(access_token)
+    if marketplace:
+        rule["marketplace"] = registry.canonical_marketplace(marketplace)
+
+    targets: List[Dict[str, Any]] = []
+    for prof in registry.by_marketplace(marketplace):
+        if refresh:
+            snap = load_profile_targets(access_token, prof, timeframe_days)
+        else:
+            snap = open_snapshot(prof["profileId"], timeframe_days)
+            if snap is None:
+                print(
+                    f"[RULE {rule.get('id')}] [DRY-RUN] profilo {prof['profileId']}: "
+                    f"nessuno snapshot a {timeframe_days} giorni, saltato"
+                )
+                continue
+        with snap:
+            changed = get_bids_changed_since(snap.created_at)
+            for t in snap:
+                if rule.get("campaign_id") and t["campaign_id"] != str(rule["campaign_id"]):
+                    continue
+                if t["target_id"] in changed:
+                    t["bid"] = changed[t["target_id"]]
+                targets.append(t)
+    return targets
+
+
+def update_bids_in_amazon(profile_id: Any, bids: Dict[str, float]) -> None:
     """
-    TODO: integra con la tua funzione che aggiorna il bid su Amazon.
-
-    Di solito:
-      - prendi profile_id e campaign_id dal target
-      - chiami l'endpoint UpdateBids per il target_id specifico
+    Aggiorna su Amazon i bid di un blocco di target dello stesso profilo
+    (bids = {target_id: nuovo_bid}, al più MAX_TARGETS_PER_REQUEST) con una
+    sola chiamata. Il mirror lo invalida _apply_rule, una volta a fine regola.
     """
-    raise NotImplementedError("Collega update_bid_in_amazon al modulo amazon_api.")
+    from auth import ensure_access_token
+    from amazon_api.update_bids import set_target_bids
+
+    set_target_bids(ensure_access_token, profile_id, bids)
 
 
 # -------------------------------------------
 # Logica scheduler
 # -------------------------------------------
 
-def process_single_rule(rule: Dict[str, Any]) -> None:
-    """Scarica i target per una regola, applica il motore e aggiorna i bid."""
+@dataclass
+class RunContext:
+    """
+    Stato di un run condiviso dalle regole, costruito una volta in
+    _run_due_rules.
+
+    applied: {target_id: bid} già scritti (o simulati) dalle regole
+    precedenti nello stesso run; changes: modifiche per record_bid_changes
+    a fine run. guardrails (rules.guardrails.GuardrailIndex), bid_states
+    (rules.cooldown, None se nessuna regola ha cooldown/isteresi) e spend
+    (scheduler.priority.SpendIndex) sono caricati una volta per run, poi
+    solo lookup. deadline (time.monotonic) e concurrency: vedi _apply_rule.
+    """
+
+    dry_run: bool = False
+    full_log: bool = False
+    guardrails: Any = None
+    bid_states: Any = None
+    spend: Any = None
+    deadline: Optional[float] = None
+    concurrency: int = 1
+    applied: Dict[str, float] = field(default_factory=dict)
+    changes: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def process_single_rule(
+    rule: Dict[str, Any],
+    ctx: Optional[RunContext] = None,
+    skip_applied: bool = False,
+    stats: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Scarica i target per una regola, applica il motore e aggiorna i bid.
+
+    ctx: stato del run (RunContext; None = run di una sola regola). Il bid
+    di partenza dei target in ctx.applied è quello (non quello dello
+    snapshot), e con skip_applied=True (politica FIRST_MATCH, regola
+    sovrapposta a una precedente) quei target vengono saltati con azione
+    SKIP_CONFLICT.
+
+    Il log (rule_executions) è scritto in blocco a fine regola: righe per
+    target solo per INCREASE/DECREASE più un riepilogo con i conteggi per
+    azione; ctx.full_log=True (debug) registra ogni target valutato.
+
+    stats: riepilogo della regola per rule_runs (new_run_stats), riempito
+    man mano: target, azioni, delta bid, chiamate API ed errori.
+
+    La regola è comunque segnata come eseguita: i target rimasti fuori
+    per il budget di tempo (SKIP_BUDGET) vengono rivalutati alla prossima
+    scadenza.
+
+    Con ctx.dry_run=True stampa solo la proiezione (rules.batch) sugli snapshot
+    già su disco: nessuna chiamata API, nessun update su Amazon, nessun log
+    e last_run_at invariato.
+    """
     now = datetime.utcnow()
+    if ctx is None:
+        ctx = RunContext()
+    if stats is None:
+        stats = new_run_stats(None, rule["id"])
+    stats["started_at"] = now.isoformat(timespec="seconds") + "Z"
 
     try:
-        targets = fetch_targets_for_rule(rule)
+        targets = fetch_targets_for_rule(rule, refresh=not ctx.dry_run)
     except NotImplementedError as exc:
         # Se non hai ancora collegato Amazon, esci senza rompere lo scheduler
         print(f"[RULE {rule.get('id')}] fetch_targets_for_rule non implementato: {exc}")
+        stats["errors"] += 1
+        stats["error"] = f"fetch_targets_for_rule non implementato: {exc}"
         return
 
     print(f"[RULE {rule.get('id')}] Trovati {len(targets)} target da valutare")
 
+    applied = ctx.applied
+    skipped: List[Dict[str, Any]] = []
+    if applied:
+        current: List[Dict[str, Any]] = []
+        for t in targets:
+            bid = applied.get(t.get("target_id"))
+            if bid is None:
+                current.append(t)
+            elif skip_applied:
+                skipped.append(t)
+            else:
+                current.append({**t, "bid": bid})
+        targets = current
+
+    if ctx.dry_run:
+        from rules.batch import TargetColumns, simulate_rules
+        from scheduler.simulation import format_summary
+
+        result = simulate_rules(
+            TargetColumns.from_rows(targets), [rule],
+            guardrails=ctx.guardrails, bid_states=ctx.bid_states,
+        )
+        for change in result.changes():
+            applied[change["target_id"]] = change["new_bid"]
+            if ctx.guardrails is not None:
+                ctx.guardrails.note_change(change["target_id"], change["old_bid"])
+        if skipped:
+            print(f"[RULE {rule.get('id')}] [DRY-RUN] {len(skipped)} target saltati (già modificati)")
+        for line in format_summary(result):
+            print(f"[RULE {rule.get('id')}] [DRY-RUN] {line.strip()}")
+        return
+
+    entries = [
+        (
+            t,
+            applied[t["target_id"]],
+            applied[t["target_id"]],
+            "SKIP_CONFLICT",
+            "già modificato da una regola precedente in questo run",
+        )
+        for t in skipped
+    ]
+    try:
+        _apply_rule(rule, targets, now, entries, stats, ctx)
+    finally:
+        # anche se il run si interrompe: i bid già scritti restano tracciati
+        log_rule_run(rule["id"], now, entries, full=ctx.full_log)
+        actions = Counter(e[3] for e in entries)
+        stats["targets"] = len(entries)
+        stats["actions"] = dict(actions)
+        stats["increases"] = actions["INCREASE"]
+        stats["decreases"] = actions["DECREASE"]
+        stats["bid_delta"] = round(stats["bid_delta"], 4)
+
+    update_rule_last_run(rule["id"], now)
+
+
+def _apply_rule(
+    rule: Dict[str, Any],
+    targets: List[Dict[str, Any]],
+    now: datetime,
+    entries: List[tuple],
+    stats: Dict[str, Any],
+    ctx: RunContext,
+) -> None:
+    """
+    Valuta la regola sui target e aggiorna i bid; le voci di log finiscono in entries.
+
+    Prima si valutano tutti i target, poi si inviano le modifiche per
+    profilo, in blocchi di MAX_TARGETS_PER_REQUEST (una chiamata API per
+    blocco): con ctx.concurrency > 1 fino a concurrency profili in
+    parallelo, i blocchi dello stesso profilo in sequenza. I thread fanno
+    solo le chiamate HTTP: esiti, log e SQLite restano al thread
+    principale. I blocchi che partirebbero dopo ctx.deadline non vengono
+    inviati: azione SKIP_BUDGET, bid invariato. Con ctx.spend le modifiche
+    partono per spesa decrescente della campagna. A fine regola (anche se
+    interrotta) il mirror viene invalidato una volta per profilo, per le
+    sole campagne modificate.
+    """
+    from amazon_api.update_bids import MAX_TARGETS_PER_REQUEST
+    from db.mirror import invalidate_mirror
+    from rules.engine import apply_rule_to_target
+
+    guardrails, bid_states, spend = ctx.guardrails, ctx.bid_states, ctx.spend
+    deadline, concurrency = ctx.deadline, ctx.concurrency
+    pending: List[tuple] = []
     for t in targets:
+        if t.get("bid") is None:
+            # target senza bid proprio (es. bid del gruppo di annunci): come rules.batch
+            entries.append((t, None, None, "SKIP_NO_BID", ""))
+            continue
         old_bid = float(t["bid"])
 
-        new_bid, action = apply_rule_to_target(t, rule)
-
-        # Log sempre, anche se NO_ACTION
-        log_rule_execution(
-            rule_id=rule["id"],
-            run_at=now,
-            target=t,
-            old_bid=old_bid,
-            new_bid=new_bid if action in ("INCREASE", "DECREASE") else old_bid,
-            action=action,
-            message="",
+        if guardrails is not None:
+            min_bid, max_bid = guardrails.bounds_for(t)
+        else:
+            min_bid = max_bid = None
+        state = bid_states.state(t["target_id"]) if bid_states is not None else None
+        new_bid, action = apply_rule_to_target(
+            t, rule, min_bid=min_bid, max_bid=max_bid, state=state
         )
 
         if action in ("INCREASE", "DECREASE") and new_bid != old_bid:
+            pending.append((t, old_bid, new_bid, action))
+        else:
+            # voce sempre, anche se NO_ACTION (nel log compatto: solo nel riepilogo)
+            entries.append(
+                (t, old_bid, new_bid if action in ("INCREASE", "DECREASE") else old_bid, action, "")
+            )
+
+    if spend:
+        pending.sort(key=lambda item: spend.of_campaign(item[0].get("campaign_id")), reverse=True)
+
+    # blocchi (profilo, modifiche): profili nell'ordine della prima modifica
+    by_profile: Dict[Any, List[tuple]] = {}
+    for item in pending:
+        by_profile.setdefault(item[0].get("profile_id"), []).append(item)
+    batches = [
+        (profile_id, items[i:i + MAX_TARGETS_PER_REQUEST])
+        for profile_id, items in by_profile.items()
+        for i in range(0, len(items), MAX_TARGETS_PER_REQUEST)
+    ]
+    # {profile_id: campagne modificate}, per invalidate_mirror a fine regola
+    touched: Dict[Any, set] = {}
+
+    def record(batch, send) -> None:
+        profile_id, items = batch
+        try:
+            sent = send()
+        except NotImplementedError as exc:
+            stats["api_calls"] += 1
+            stats["errors"] += 1
+            stats["error"] = f"update_bids_in_amazon non implementato: {exc}"
+            entries.extend((t, old_bid, new_bid, action, "") for t, old_bid, new_bid, action in items)
+            print(f"[RULE {rule.get('id')}] update_bids_in_amazon non implementato: {exc}")
+            return
+        except Exception:
+            stats["api_calls"] += 1
+            entries.extend((t, old_bid, new_bid, action, "") for t, old_bid, new_bid, action in items)
+            raise
+        if not sent:
+            entries.extend(
+                (t, old_bid, old_bid, "SKIP_BUDGET", "budget di tempo del run esaurito")
+                for t, old_bid, _, _ in items
+            )
+            return
+
+        stats["api_calls"] += 1
+        for t, old_bid, new_bid, action in items:
+            stats["bid_delta"] += new_bid - old_bid
+            entries.append((t, old_bid, new_bid, action, ""))
+            ctx.applied[t["target_id"]] = new_bid
+            if guardrails is not None:
+                guardrails.note_change(t["target_id"], old_bid)
+            if t.get("campaign_id"):
+                touched.setdefault(profile_id, set()).add(t["campaign_id"])
+            ctx.changes.append(
+                {
+                    "target_id": t["target_id"],
+                    "profile_id": profile_id,
+                    "campaign_id": t.get("campaign_id"),
+                    "rule_id": rule["id"],
+                    "old_bid": old_bid,
+                    "new_bid": new_bid,
+                }
+            )
+            print(
+                f"[RULE {rule.get('id')}] Target {t.get('target_id')} "
+                f"bid {old_bid} -> {new_bid} ({action})"
+            )
+
+    try:
+        _send_batches(batches, record, deadline, concurrency)
+    finally:
+        # il prossimo sync riallinea il mirror (solo le righe cambiate)
+        for profile_id, campaign_ids in touched.items():
+            invalidate_mirror(profile_id, sorted(campaign_ids))
+
+
+def _send_batches(batches: List[tuple], record, deadline: Optional[float], concurrency: int) -> None:
+    """
+    Invia i blocchi; record(batch, send) ne registra l'esito, dal thread
+    principale e nell'ordine dei blocchi. Con concurrency > 1 un thread per
+    profilo (fino a concurrency): i blocchi di un profilo restano in
+    sequenza, i profili vanno in parallelo.
+    """
+    lanes: Dict[Any, List[tuple]] = {}
+    for batch in batches:
+        lanes.setdefault(batch[0], []).append(batch)
+    if concurrency <= 1 or len(lanes) <= 1:
+        for batch in batches:
+            record(batch, lambda batch=batch: _send_batch(batch, deadline))
+        return
+
+    import threading
+    from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+    futures = {id(batch): Future() for batch in batches}
+    stop = threading.Event()
+
+    def send_lane(lane: List[tuple]) -> None:
+        for batch in lane:
+            future = futures[id(batch)]
+            if stop.is_set():
+                future.cancel()
+                continue
+            future.set_running_or_notify_cancel()
             try:
-                update_bid_in_amazon(t, new_bid)
-                print(
-                    f"[RULE {rule.get('id')}] Target {t.get('target_id')} "
-                    f"bid {old_bid} -> {new_bid} ({action})"
-                )
-            except NotImplementedError as exc:
-                print(
-                    f"[RULE {rule.get('id')}] update_bid_in_amazon non implementato: {exc}"
-                )
+                future.set_result(_send_batch(batch, deadline))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    with ThreadPoolExecutor(
+        max_workers=min(concurrency, len(lanes)), thread_name_prefix="bid-update"
+    ) as pool:
+        for lane in lanes.values():
+            pool.submit(send_lane, lane)
+        failure: Optional[BaseException] = None
+        for batch in batches:
+            future = futures[id(batch)]
+            wait([future])
+            if future.cancelled():
+                continue
+            try:
+                record(batch, future.result)
+            except Exception as exc:
+                if failure is None:
+                    failure = exc
+                    # come nel caso seriale: dopo un errore nessuna nuova
+                    # chiamata; quelle già partite vengono comunque registrate
+                    stop.set()
+    if failure is not None:
+        raise failure
+
+
+def _send_batch(batch: tuple, deadline: Optional[float]) -> bool:
+    """Invia un blocco di modifiche; False (non inviato) se il budget di tempo è esaurito."""
+    if deadline is not None and time.monotonic() >= deadline:
+        return False
+    profile_id, items = batch
+    update_bids_in_amazon(profile_id, {t["target_id"]: new_bid for t, _, new_bid, _ in items})
+    return True
+
+
+def new_run_stats(run_id: Optional[str], rule_id: Any) -> Dict[str, Any]:
+    """Riepilogo vuoto di una regola in un run (una riga di rule_runs)."""
+    return {
+        "run_id": run_id,
+        "rule_id": rule_id,
+        "started_at": None,
+        "finished_at": None,
+        "duration_ms": 0,
+        "targets": 0,
+        "increases": 0,
+        "decreases": 0,
+        "actions": {},
+        "bid_delta": 0.0,
+        "api_calls": 0,
+        "errors": 0,
+        "error": None,
+    }
 
-    update_rule_last_run(rule["id"], now)
 
+# codici di uscita di python -m scheduler.runner --once (2: argomenti non validi, argparse)
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_BUDGET = 3
+
+
+def new_run_summary() -> Dict[str, Any]:
+    """Riepilogo vuoto di una scansione (run_once_for_due_rules), serializzabile in JSON."""
+    return {
+        "run_id": None,
+        "status": "ok",
+        "dry_run": False,
+        "budget_seconds": None,
+        "concurrency": 1,
+        "duration_ms": 0,
+        "rules_due": [],
+        "rules_run": [],
+        "rules_deferred": [],
+        "targets": 0,
+        "increases": 0,
+        "decreases": 0,
+        "skipped_budget": 0,
+        "api_calls": 0,
+        "errors": 0,
+        "error": None,
+    }
 
-def run_once_for_due_rules() -> None:
-    """Esegue una sola scansione delle regole dovute."""
+
+def exit_code(summary: Dict[str, Any]) -> int:
+    """EXIT_ERROR se ci sono errori, EXIT_BUDGET se il budget ha lasciato lavoro indietro."""
+    if summary["status"] == "error":
+        return EXIT_ERROR
+    if summary["status"] == "budget_exhausted":
+        return EXIT_BUDGET
+    return EXIT_OK
+
+
+def run_once_for_due_rules(
+    dry_run: bool = False,
+    full_log: Optional[bool] = None,
+    budget_seconds: Optional[float] = None,
+    concurrency: int = 1,
+    summary: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Esegue una sola scansione delle regole dovute (dry_run: solo simulazione).
+    full_log: log per target completo (debug); None = impostazione salvata
+    (db.get_execution_log_detail).
+
+    budget_seconds: tempo massimo della scansione. Esaurito il budget, le
+    regole non ancora iniziate restano dovute (rules_deferred, eseguite al
+    prossimo avvio) e la regola in corso non invia altre modifiche. Le
+    regole indipendenti partono per impatto stimato (scheduler.priority),
+    così a restare indietro sono quelle che contano meno.
+    concurrency: profili aggiornati in parallelo dentro una regola (blocchi
+    di update bid; le regole restano in sequenza).
+
+    summary: riepilogo (new_run_summary) riempito man mano e restituito;
+    passato dal chiamante resta leggibile anche se la scansione solleva.
+    """
+    if summary is None:
+        summary = new_run_summary()
+    started = time.monotonic()
+    deadline = started + budget_seconds if budget_seconds is not None else None
+    summary.update(dry_run=dry_run, budget_seconds=budget_seconds, concurrency=concurrency)
+    run_stats: List[Dict[str, Any]] = []
+    try:
+        _run_due_rules(dry_run, full_log, deadline, concurrency, summary, run_stats)
+    except Exception as exc:
+        summary["error"] = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        for key in ("targets", "increases", "decreases", "api_calls", "errors"):
+            summary[key] = sum(rs[key] for rs in run_stats)
+        summary["skipped_budget"] = sum(rs["actions"].get("SKIP_BUDGET", 0) for rs in run_stats)
+        summary["duration_ms"] = int((time.monotonic() - started) * 1000)
+        if summary["error"] or summary["errors"]:
+            summary["status"] = "error"
+        elif summary["rules_deferred"] or summary["skipped_budget"]:
+            summary["status"] = "budget_exhausted"
+    return summary
+
+
+def _run_due_rules(
+    dry_run: bool,
+    full_log: Optional[bool],
+    deadline: Optional[float],
+    concurrency: int,
+    summary: Dict[str, Any],
+    run_stats: List[Dict[str, Any]],
+) -> None:
     init_db()
     now = datetime.utcnow()
+    # riepilogo per regola (rule_runs); run_id nello stesso formato di run_at
+    run_id = now.isoformat(timespec="seconds") + "Z"
+    summary["run_id"] = run_id
     rules = get_due_rules(now)
 
     if not rules:
         print("[SCHEDULER] Nessuna regola da eseguire in questo momento.")
         return
 
+    from settings import require_credentials
+    from rules.conflicts import FIRST_MATCH
+    from rules.cooldown import uses_bid_state
+
+    if not dry_run:
+        require_credentials()
+
+    # ordine deterministico precalcolato al salvataggio delle regole (rules.conflicts)
+    analysis = get_rule_analysis()
+    position = {rid: i for i, rid in enumerate(analysis.order)}
+    rules = sorted(rules, key=lambda r: (position.get(r["id"], len(position)), r["id"]))
+    if len(rules) > 1 or deadline is not None:
+        from scheduler.priority import prioritize
+
+        # regole indipendenti per impatto (spesa recente x priorità) e, dentro
+        # la regola, campagne che spendono di più per prime: se il budget
+        # finisce, resta indietro quello che conta meno
+        rules, spend = prioritize(rules, analysis)
+    else:
+        spend = None
+    summary["rules_due"] = [r["id"] for r in rules]
+    first_match = get_conflict_policy() == FIRST_MATCH
+    ctx = RunContext(
+        dry_run=dry_run,
+        full_log=get_execution_log_detail() if full_log is None else full_log,
+        # limiti bid e bid di inizio giornata: letti una volta, poi solo lookup
+        guardrails=load_guardrail_index(now),
+        # stato dell'ultima modifica per target, solo se qualche regola ha cooldown/isteresi
+        bid_states=load_bid_state_index(now) if any(uses_bid_state(r) for r in rules) else None,
+        spend=spend,
+        deadline=deadline,
+        concurrency=concurrency,
+    )
+
     print(f"[SCHEDULER] Regole da eseguire: {[r['id'] for r in rules]}")
 
-    for rule in rules:
-        process_single_rule(rule)
+    if dry_run:
+        # nessuna chiamata API: niente token da rinnovare
+        refresher = nullcontext()
+    else:
+        from auth import TokenRefresher
 
+        # il run può durare più del token: lo rinnoviamo in anticipo in background
+        refresher = TokenRefresher()
 
-def run_scheduler_loop(poll_interval_seconds: int = 3600) -> None:
+    with refresher:
+        try:
+            for i, rule in enumerate(rules):
+                if deadline is not None and time.monotonic() >= deadline:
+                    summary["rules_deferred"] = [r["id"] for r in rules[i:]]
+                    print(f"[SCHEDULER] Budget di tempo esaurito, rinviate: {summary['rules_deferred']}")
+                    break
+                # solo le regole sovrapposte a una precedente controllano i target già toccati
+                skip = first_match and bool(analysis.overlapping_earlier(rule["id"]))
+                stats = new_run_stats(run_id, rule["id"])
+                run_stats.append(stats)
+                summary["rules_run"].append(rule["id"])
+                started = time.perf_counter()
+                try:
+                    process_single_rule(rule, ctx, skip_applied=skip, stats=stats)
+                except Exception as exc:
+                    stats["errors"] += 1
+                    stats["error"] = f"{type(exc).__name__}: {exc}"
+                    raise
+                finally:
+                    stats["finished_at"] = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+                    stats["duration_ms"] = int((time.perf_counter() - started) * 1000)
+        finally:
+            # stato per target e riepilogo in blocco, anche se il run si
+            # interrompe a metà: i bid già scritti su Amazon restano modificati
+            if ctx.changes:
+                n = record_bid_changes(ctx.changes, now)
+                print(f"[SCHEDULER] Stato bid aggiornato per {n} target")
+            if not dry_run:
+                record_rule_runs(run_stats)
+
+
+def run_scheduler_loop(
+    poll_interval_seconds: int = 3600,
+    full_log: Optional[bool] = None,
+    concurrency: int = 1,
+) -> None:
     """
     Loop continuo. Ogni poll_interval_seconds controlla quali regole sono "due".
 
+    Dopo le regole aggiorna lo storico giornaliero (scheduler.history),
+    fuori dal loro tempo: le regole non aspettano i report DAILY.
+
     Per uso reale puoi lanciare:
         python -m scheduler.runner
-    o importare run_scheduler_loop da un altro modulo.
+    o importare run_scheduler_loop da un altro modulo. Da cron / timer
+    systemd è preferibile una scansione singola, senza processo residente
+    (vedi main: --once, --budget, --concurrency), con lo storico in un job
+    a parte (python -m scheduler.history).
     """
     init_db()
     print("[SCHEDULER] Avviato. Controllo regole ogni", poll_interval_seconds, "secondi")
 
     while True:
         try:
-            run_once_for_due_rules()
+            run_once_for_due_rules(full_log=full_log, concurrency=concurrency)
         except Exception as exc:
             print("[SCHEDULER] Errore durante l'esecuzione delle regole:", exc)
 
+        try:
+            from auth import ensure_access_token
+            from scheduler.history import sync_all_daily_metrics
+
+            sync_all_daily_metrics(ensure_access_token)
+        except Exception as exc:
+            print("[HISTORY] Errore durante l'aggiornamento dello storico:", exc)
+
         time.sleep(poll_interval_seconds)
 
 
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Riga di comando:
+
+        python -m scheduler.runner                      # loop continuo
+        python -m scheduler.runner --once [--budget 900] [--concurrency 4]
+        python -m scheduler.runner --dry-run            # una scansione simulata
+
+    Con --once / --dry-run l'ultima riga su stdout è il riepilogo JSON
+    (new_run_summary) e il codice di uscita dice com'è andata: 0 ok,
+    1 errori, 3 budget esaurito con regole o modifiche rinviate.
+    """
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Scheduler regole bid")
+    parser.add_argument("--once", action="store_true", help="una sola scansione, poi esce")
+    parser.add_argument("--dry-run", action="store_true", help="una scansione simulata (implica --once)")
+    parser.add_argument("--budget", type=float, help="tempo massimo della scansione in secondi")
+    parser.add_argument("--concurrency", type=int, default=1, help="profili aggiornati in parallelo (blocchi di update bid)")
+    parser.add_argument("--full-log", action="store_true", help="registra ogni target valutato")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("--concurrency deve essere almeno 1")
+    if args.budget is not None and args.budget <= 0:
+        parser.error("--budget deve essere positivo")
+
+    full_log = True if args.full_log else None
+    if not (args.once or args.dry_run):
+        # Avvio diretto dello scheduler
+        run_scheduler_loop(full_log=full_log, concurrency=args.concurrency)
+        return EXIT_OK
+
+    summary = new_run_summary()
+    try:
+        run_once_for_due_rules(
+            dry_run=args.dry_run,
+            full_log=full_log,
+            budget_seconds=args.budget,
+            concurrency=args.concurrency,
+            summary=summary,
+        )
+    except Exception as exc:
+        print("[SCHEDULER] Errore durante l'esecuzione delle regole:", exc)
+    print(json.dumps(summary, sort_keys=True))
+    return exit_code(summary)
+
+
 if __name__ == "__main__":
-    # Avvio diretto dello scheduler
-    run_scheduler_loop()
+    raise SystemExit(main())
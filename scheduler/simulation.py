@@ -0,0 +1,217 @@
+# scheduler/simulation.py
+
+"""
+Simulazione (dry-run) delle regole su dati già disponibili in locale.
+
+Sorgenti:
+- snapshot metriche per profilo (db.snapshot), gli stessi letti dallo scheduler;
+- storico: target noti (mirror e target_bid_state) con il bid in vigore a
+  un run passato, metriche dallo storico giornaliero (history_columns);
+- storico metriche giornaliere (db.daily_metrics) per il backtest multi-run
+  (rules.backtest).
+
+Nessuna chiamata di scrittura verso Amazon e nessun log su DB: il risultato
+è una proiezione aggregata (rules.batch.SimulationResult o
+rules.backtest.BacktestResult).
+
+Backtest da riga di comando:
+    python -m scheduler.simulation --profile 123456 --rules 1,2 --days 90
+"""
+
+from typing import Any, Dict, List, Optional, Sequence
+
+from rules.batch import SimulationResult, TargetColumns, simulate_rules
+
+
+def snapshot_columns(profile_id: Any, timeframe_days: Optional[int] = None) -> Optional[TargetColumns]:
+    """Colonne dell'ultimo snapshot del profilo (None se non ce n'è uno)."""
+    from db.snapshot import open_snapshot
+
+    snap = open_snapshot(profile_id, timeframe_days)
+    if snap is None:
+        return None
+    with snap:
+        return TargetColumns.from_snapshot(snap)
+
+
+def _window_metrics(profile_id: Any, as_of: Optional[str], days: int) -> Dict[str, Dict[str, Any]]:
+    """
+    {target_id: metriche} sommate sugli ultimi `days` giorni dello storico
+    giornaliero prima di as_of (il giorno del run escluso: il report non lo
+    copre ancora). Vuoto se il profilo non ha storico.
+    """
+    from db.daily_metrics import available_days, read_daily_metrics
+
+    day_limit = as_of[:10] if as_of else "9999-12-31"
+    totals: Dict[str, Dict[str, Any]] = {}
+    for day in [d for d in available_days(profile_id) if d < day_limit][-days:]:
+        columns = read_daily_metrics(profile_id, day)
+        if columns is None:
+            continue
+        names = ("impressions", "clicks", "cost", "orders", "sales")
+        for i, tid in enumerate(columns["target_id"]):
+            acc = totals.get(str(tid))
+            if acc is None:
+                acc = totals[str(tid)] = dict.fromkeys(names, 0)
+            for name in names:
+                acc[name] += columns[name][i]
+    for acc in totals.values():
+        cost, sales = acc["cost"], acc["sales"]
+        acc["acos"] = cost / sales * 100.0 if sales > 0 and cost > 0 else None
+    return totals
+
+
+def history_columns(as_of: Optional[str] = None, timeframe_days: Optional[int] = None) -> TargetColumns:
+    """
+    Target noti con il bid in vigore a as_of (db.get_targets_as_of). Le
+    metriche vengono dallo storico giornaliero (timeframe_days giorni prima
+    del run, default pipeline.DEFAULT_TIMEFRAME_DAYS) per i profili che lo
+    hanno; altrimenti restano quelle registrate nel log, se il target c'è.
+    """
+    from db.database import get_targets_as_of
+    from scheduler.pipeline import DEFAULT_TIMEFRAME_DAYS
+
+    rows = get_targets_as_of(as_of)
+    days = timeframe_days or DEFAULT_TIMEFRAME_DAYS
+    by_profile: Dict[Any, Dict[str, Dict[str, Any]]] = {}
+    for row in rows:
+        profile_id = row.get("profile_id")
+        if profile_id is None:
+            continue
+        if profile_id not in by_profile:
+            by_profile[profile_id] = _window_metrics(profile_id, as_of, days)
+        metrics = by_profile[profile_id].get(str(row["target_id"]))
+        if metrics is not None:
+            row.update(metrics)
+    return TargetColumns.from_rows(rows)
+
+
+def simulate_on_snapshot(
+    rules: Sequence[Dict[str, Any]],
+    profile_id: Any,
+    timeframe_days: Optional[int] = None,
+    guardrails=None,
+    bid_states=None,
+) -> Optional[SimulationResult]:
+    cols = snapshot_columns(profile_id, timeframe_days)
+    if cols is None:
+        return None
+    return simulate_rules(cols, rules, guardrails=guardrails, bid_states=bid_states)
+
+
+def simulate_on_history(
+    rules: Sequence[Dict[str, Any]],
+    as_of: Optional[str] = None,
+    guardrails=None,
+    bid_states=None,
+) -> SimulationResult:
+    return simulate_rules(
+        history_columns(as_of), rules, guardrails=guardrails, bid_states=bid_states
+    )
+
+
+def format_summary(result: SimulationResult) -> List[str]:
+    """Righe di testo per log/console."""
+    s = result.summary()
+    lines = [
+        f"target valutati: {s['targets']}, modificati: {s['affected']} "
+        f"(+{s['increases']} / -{s['decreases']}), delta bid totale: {s['total_bid_delta']:+.2f}"
+    ]
+    for r in s["rules"]:
+        actions = ", ".join(f"{k}={v}" for k, v in sorted(r["actions"].items()) if v)
+        lines.append(
+            f"  regola {r['rule_id']} ({r['name']}): {r['affected']} modifiche, "
+            f"delta {r['bid_delta']:+.2f} [{actions}]"
+        )
+    return lines
+
+
+def backtest_profile(
+    profile_id: Any,
+    rules: Sequence[Dict[str, Any]],
+    period_days: int = 90,
+    first_match: bool = False,
+    guardrails=None,
+):
+    """
+    Backtest delle regole sui target dell'ultimo snapshot del profilo e sullo
+    storico giornaliero salvato (vedi scheduler.history.sync_daily_metrics).
+    None se il profilo non ha ancora uno snapshot.
+    """
+    from db.daily_metrics import available_days, read_daily_metrics
+    from rules.backtest import backtest_rules, build_history, history_metrics
+
+    cols = snapshot_columns(profile_id)
+    if cols is None:
+        return None
+
+    history = build_history(
+        cols.target_id,
+        available_days(profile_id),
+        lambda day: read_daily_metrics(profile_id, day),
+        metrics=history_metrics(rules),
+    )
+    return backtest_rules(
+        cols,
+        history,
+        rules,
+        period_days=period_days,
+        first_match=first_match,
+        guardrails=guardrails,
+    )
+
+
+def main() -> int:
+    import argparse
+    import json
+
+    from db.database import get_all_rules, init_db
+
+    parser = argparse.ArgumentParser(description="Backtest delle regole sullo storico giornaliero")
+    parser.add_argument("--profile", required=True, help="profileId Amazon Ads")
+    parser.add_argument("--rules", default="", help="ID regole separati da virgola (default: attive)")
+    parser.add_argument("--days", type=int, default=90, help="giorni simulati")
+    parser.add_argument("--output", help="salva summary e traiettorie aggregate in JSON")
+    args = parser.parse_args()
+
+    init_db()
+    all_rules = get_all_rules()
+    if args.rules:
+        wanted = {int(r) for r in args.rules.split(",") if r.strip()}
+        rules = [r for r in all_rules if r["id"] in wanted]
+    else:
+        rules = [r for r in all_rules if r["enabled"]]
+
+    from db.database import get_conflict_policy, get_guardrails
+    from rules.conflicts import FIRST_MATCH, resolution_order
+    from rules.guardrails import GuardrailIndex
+
+    rules = resolution_order(rules)
+    result = backtest_profile(
+        args.profile,
+        rules,
+        args.days,
+        first_match=get_conflict_policy() == FIRST_MATCH,
+        guardrails=GuardrailIndex(get_guardrails()),
+    )
+    if result is None:
+        print(f"Nessuno snapshot per il profilo {args.profile}.")
+        return 1
+
+    summary = result.summary()
+    print(json.dumps(summary, indent=2))
+
+    if args.output:
+        summary["total_bid_by_date"] = [
+            [d.isoformat(), round(v, 2)] for d, v in zip(result.run_dates, result.total_bid_by_date)
+        ]
+        summary["changed_by_date"] = [
+            [d.isoformat(), c] for d, c in zip(result.run_dates, result.changed_by_date)
+        ]
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
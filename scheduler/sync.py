@@ -0,0 +1,233 @@
+# scheduler/sync.py
+
+"""
+Sync incrementale campagne/target -> mirror SQLite (db/mirror.py).
+
+Gli endpoint /sp/campaigns/list e /adsApi/v1/query/targets non offrono un
+filtro "modificato dopo", quindi le pagine vanno comunque scaricate; il
+lavoro locale però segue la quantità di cambiamenti:
+
+1. ogni pagina grezza ha un hash: se coincide con quello del sync
+   precedente, la pagina non viene nemmeno decodificata riga per riga;
+2. per le pagine diverse si confronta l'hash di ogni riga con il mirror;
+3. si scrivono (in una transazione per campagna) solo le righe nuove o
+   modificate, registrandole in target_changes; le rimozioni si deducono
+   solo da uno scaricamento completo (per i target di una campagna sparita:
+   dalla lista completa delle campagne).
+"""
+
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from db import mirror
+from db.database import utc_now_str
+
+# Un mirror più recente di così viene letto senza chiamare le API
+MIRROR_MAX_AGE_SECONDS = 900
+
+
+@dataclass
+class SyncResult:
+    profile_id: str
+    campaigns: int = 0
+    targets: int = 0
+    new: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    pages: int = 0
+    pages_skipped: int = 0
+    seconds: float = 0.0
+    changed_campaigns: List[str] = field(default_factory=list)
+
+    @property
+    def changes(self) -> int:
+        return self.new + self.updated + self.removed
+
+
+def _diff_pages(
+    pages: Iterable[Tuple[List[Dict[str, Any]], bytes]],
+    id_key: str,
+    known_page_hashes: List[str],
+    known_hashes: Dict[str, str],
+    result: SyncResult,
+) -> Tuple[List[Tuple[Dict[str, Any], str, str]], List[str], List[str]]:
+    """
+    Confronta le pagine scaricate con il mirror.
+
+    Restituisce (righe da scrivere (riga, hash, NEW|UPDATED), id rimossi,
+    hash delle pagine).
+    """
+    changed: List[Tuple[Dict[str, Any], str, str]] = []
+    seen = set()
+    page_hashes: List[str] = []
+
+    for i, (items, content) in enumerate(pages):
+        h = mirror.page_hash(content)
+        page_hashes.append(h)
+        result.pages += 1
+
+        if i < len(known_page_hashes) and known_page_hashes[i] == h:
+            # pagina identica: tutte le sue righe sono già nel mirror
+            result.pages_skipped += 1
+            seen.update(str(item[id_key]) for item in items if item.get(id_key) is not None)
+            result.unchanged += len(items)
+            continue
+
+        for item in items:
+            if item.get(id_key) is None:
+                continue
+            item_id = str(item[id_key])
+            seen.add(item_id)
+            item_hash = mirror.content_hash(item)
+            old = known_hashes.get(item_id)
+            if old == item_hash:
+                result.unchanged += 1
+            else:
+                changed.append((item, item_hash, "NEW" if old is None else "UPDATED"))
+
+    removed = [item_id for item_id in known_hashes if item_id not in seen]
+    return changed, removed, page_hashes
+
+
+def sync_campaigns(
+    access_token,
+    profile_id,
+    result: Optional[SyncResult] = None,
+    sync_id: Optional[str] = None,
+) -> SyncResult:
+    """
+    Allinea campaigns_mirror alle campagne SP del profilo. I target delle
+    campagne sparite escono anche da targets_mirror (mirror.purge_orphan_targets).
+    """
+    from amazon_api.campaigns import iter_campaign_pages
+
+    if result is None:
+        result = SyncResult(str(profile_id))
+
+    state = mirror.get_sync_state(profile_id, mirror.CAMPAIGNS_SCOPE)
+    known_pages = state["page_hashes"] if state else []
+    known = mirror.get_campaign_hashes(profile_id)
+
+    campaigns_result = SyncResult(str(profile_id))
+    changed, removed, page_hashes = _diff_pages(
+        iter_campaign_pages(access_token, profile_id),
+        "campaignId",
+        known_pages,
+        known,
+        campaigns_result,
+    )
+    result.pages += campaigns_result.pages
+    result.pages_skipped += campaigns_result.pages_skipped
+    result.campaigns = campaigns_result.unchanged + len(changed)
+    result.changed_campaigns.extend(str(c["campaignId"]) for c, _, _ in changed)
+
+    if changed or removed:
+        mirror.apply_campaign_changes(
+            profile_id, [(c, h) for c, h, _ in changed], removed, page_hashes
+        )
+    else:
+        mirror.mark_synced(profile_id, mirror.CAMPAIGNS_SCOPE, page_hashes)
+    # lista campagne completa: i target senza campagna non torneranno da un sync per campagna
+    result.removed += mirror.purge_orphan_targets(profile_id, sync_id)
+    return result
+
+
+def sync_campaign_targets(
+    access_token,
+    profile_id,
+    campaign_id,
+    result: Optional[SyncResult] = None,
+    sync_id: Optional[str] = None,
+) -> SyncResult:
+    """Allinea targets_mirror ai target di una campagna."""
+    from amazon_api.targets import flatten_target, iter_target_pages
+
+    if result is None:
+        result = SyncResult(str(profile_id))
+    if sync_id is None:
+        sync_id = utc_now_str()
+
+    scope = mirror.targets_scope(campaign_id)
+    state = mirror.get_sync_state(profile_id, scope)
+    known_pages = state["page_hashes"] if state else []
+    known = mirror.get_target_hashes(profile_id, campaign_id)
+
+    before = result.unchanged
+    changed, removed, page_hashes = _diff_pages(
+        iter_target_pages(access_token, profile_id, [campaign_id]),
+        "targetId",
+        known_pages,
+        known,
+        result,
+    )
+    result.targets += (result.unchanged - before) + len(changed)
+
+    if changed or removed:
+        upserts = [(t, flatten_target(t), h, change) for t, h, change in changed]
+        mirror.apply_target_changes(profile_id, campaign_id, upserts, removed, page_hashes, sync_id)
+        result.new += sum(1 for *_, change in changed if change == "NEW")
+        result.updated += sum(1 for *_, change in changed if change == "UPDATED")
+        result.removed += len(removed)
+    else:
+        mirror.mark_synced(profile_id, scope, page_hashes)
+    return result
+
+
+def sync_profile(
+    access_token,
+    profile_id,
+    campaign_ids: Optional[List[Any]] = None,
+) -> SyncResult:
+    """
+    Sync incrementale di un profilo: campagne (se campaign_ids è None) e
+    target di ogni campagna. Alla fine elimina da target_changes le righe
+    oltre la finestra di conservazione (mirror.prune_target_changes).
+    """
+    started = time.perf_counter()
+    result = SyncResult(str(profile_id))
+    sync_id = utc_now_str()
+
+    if campaign_ids is None:
+        sync_campaigns(access_token, profile_id, result, sync_id)
+        campaign_ids = [c["campaignId"] for c in mirror.get_mirror_campaigns(profile_id)]
+
+    for cid in campaign_ids:
+        sync_campaign_targets(access_token, profile_id, cid, result, sync_id)
+
+    mirror.prune_target_changes(profile_id)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def _is_fresh(profile_id, scope: str, max_age_seconds: float) -> bool:
+    state = mirror.get_sync_state(profile_id, scope)
+    if not state or not state["synced_at"]:
+        return False
+    synced = datetime.fromisoformat(state["synced_at"].rstrip("Z"))
+    return datetime.utcnow() - synced <= timedelta(seconds=max_age_seconds)
+
+
+def load_profile_campaigns(
+    access_token,
+    profile_id,
+    max_age_seconds: float = MIRROR_MAX_AGE_SECONDS,
+) -> List[Dict[str, Any]]:
+    """Campagne dal mirror, sincronizzandole prima se troppo vecchie."""
+    if not _is_fresh(profile_id, mirror.CAMPAIGNS_SCOPE, max_age_seconds):
+        sync_campaigns(access_token, profile_id)
+    return mirror.get_mirror_campaigns(profile_id)
+
+
+def load_campaign_targets(
+    access_token,
+    profile_id,
+    campaign_id,
+    max_age_seconds: float = MIRROR_MAX_AGE_SECONDS,
+) -> List[Dict[str, Any]]:
+    """Target di una campagna dal mirror, sincronizzandoli prima se troppo vecchi."""
+    if not _is_fresh(profile_id, mirror.targets_scope(campaign_id), max_age_seconds):
+        sync_campaign_targets(access_token, profile_id, campaign_id)
+    return mirror.get_mirror_targets(profile_id, [campaign_id])
@@ -14,17 +14,28 @@ CLIENT_ID = os.getenv("AMAZON_ADS_CLIENT_ID")
 CLIENT_SECRET = os.getenv("AMAZON_ADS_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("AMAZON_ADS_REDIRECT_URI")
 
-if not CLIENT_ID or not CLIENT_SECRET or not REDIRECT_URI:
-    raise RuntimeError(
-        "Variabili .env mancanti. "
-        "Devi avere AMAZON_ADS_CLIENT_ID, AMAZON_ADS_CLIENT_SECRET, AMAZON_ADS_REDIRECT_URI."
-    )
+
+def require_credentials() -> None:
+    """
+    Errore chiaro se mancano le credenziali. Controllo pigro, fatto da chi le
+    usa (login, token, scheduler con regole da eseguire) e non all'import:
+    un run cron senza regole dovute, l'export e i benchmark partono anche
+    senza .env.
+    """
+    if not CLIENT_ID or not CLIENT_SECRET or not REDIRECT_URI:
+        raise RuntimeError(
+            "Variabili .env mancanti. "
+            "Devi avere AMAZON_ADS_CLIENT_ID, AMAZON_ADS_CLIENT_SECRET, AMAZON_ADS_REDIRECT_URI."
+        )
+
 
 # ==========================================================
 # COSTANTI AMAZON ADS (FISSE)
 # ==========================================================
 
-API_BASE_URL = "https://advertising-api.amazon.com"
+# API_BASE_URL e TOKEN_URL si possono sovrascrivere da .env, ad esempio per
+# puntare al mock locale (python -m mock_api.server) nei test di carico.
+API_BASE_URL = os.getenv("AMAZON_ADS_API_BASE_URL", "https://advertising-api.amazon.com")
 LWA_AUTHORIZE_URL = "https://www.amazon.com/ap/oa"
-TOKEN_URL = "https://api.amazon.com/auth/o2/token"
+TOKEN_URL = os.getenv("AMAZON_ADS_TOKEN_URL", "https://api.amazon.com/auth/o2/token")
 SCOPE = "advertising::campaign_management"
@@ -1,3 +1,11 @@
+import contextlib
+import json
+import os
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+
+import db.database as database
 from db.database import (
     create_rule,
     get_all_rules,
@@ -61,5 +69,119 @@ def main():
     print("Regole rimaste:", rules)
 
 
+@contextlib.contextmanager
+def temp_db():
+    """DB SQLite temporaneo per le verifiche, eliminato all'uscita (DB_PATH ripristinato)."""
+    saved = database.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "rules.db")
+        try:
+            database.init_db()
+            yield database.DB_PATH
+        finally:
+            database.DB_PATH = saved
+
+
+def check_run_summary_roundtrip():
+    """Log compatto: righe per target solo per le modifiche, conteggi completi nel RUN_SUMMARY."""
+    with temp_db():
+        run_at = datetime(2026, 1, 15, 8, 0, 0)
+        def target(i):
+            return {"target_id": str(i), "campaign_id": "C1", "keyword_text": f"kw {i}"}
+
+        entries = [
+            (target(1), 0.50, 0.55, "INCREASE", ""),
+            (target(2), 0.80, 0.72, "DECREASE", ""),
+            (target(3), 0.40, 0.40, "NO_ACTION", ""),
+            (target(4), 0.40, 0.40, "SKIP_CONDITION", ""),
+            (target(5), 0.40, 0.40, "SKIP_CONDITION", ""),
+            (target(6), 0.40, 0.40, "SKIP_COOLDOWN", ""),
+        ]
+        expected = dict(Counter(e[3] for e in entries))
+
+        assert database.log_rule_run(7, run_at, entries) == 3
+        rows = database.get_executions_after(0)
+        summary = [r for r in rows if r["action"] == database.RUN_SUMMARY_ACTION]
+        per_target = [r for r in rows if r["action"] != database.RUN_SUMMARY_ACTION]
+        assert len(summary) == 1 and summary[0]["target_id"] is None, summary
+        assert json.loads(summary[0]["message"]) == expected, summary[0]["message"]
+        assert [(r["target_id"], r["old_bid"], r["new_bid"], r["action"]) for r in per_target] == [
+            ("1", 0.50, 0.55, "INCREASE"),
+            ("2", 0.80, 0.72, "DECREASE"),
+        ], per_target
+        assert all(r["run_at"] == "2026-01-15T08:00:00Z" and r["rule_id"] == 7 for r in rows)
+
+        # log completo (debug): ogni target più lo stesso riepilogo
+        assert database.log_rule_run(8, run_at, entries, full=True) == len(entries) + 1
+        rows = [r for r in database.get_executions_after(0) if r["rule_id"] == 8]
+        assert Counter(r["action"] for r in rows if r["target_id"]) == Counter(expected)
+        assert json.loads(rows[-1]["message"]) == expected
+        print("OK riepilogo RUN_SUMMARY:", expected)
+
+
+def check_target_changes_retention():
+    """target_changes: prune_target_changes elimina solo le righe oltre la finestra, del solo profilo."""
+    from db.mirror import TARGET_CHANGES_RETENTION_DAYS, get_target_changes, prune_target_changes
+
+    with temp_db():
+        now = datetime.utcnow()
+        rows = [
+            ("P1", "old", now - timedelta(days=TARGET_CHANGES_RETENTION_DAYS + 1)),
+            ("P1", "new", now - timedelta(days=1)),
+            ("P2", "other", now - timedelta(days=TARGET_CHANGES_RETENTION_DAYS + 1)),
+        ]
+        with database.get_connection() as conn:
+            conn.executemany(
+                "INSERT INTO target_changes (sync_id, profile_id, campaign_id, target_id, change, changed_at) "
+                "VALUES (?, ?, 'C1', ?, 'UPDATED', ?);",
+                [(database.utc_now_str(), pid, tid, at.isoformat(timespec="seconds") + "Z") for pid, tid, at in rows],
+            )
+            conn.commit()
+
+        assert prune_target_changes("P1") == 1
+        assert [r["target_id"] for r in get_target_changes("P1")] == ["new"]
+        assert [r["target_id"] for r in get_target_changes("P2")] == ["other"]
+        print("OK target_changes: righe oltre", TARGET_CHANGES_RETENTION_DAYS, "giorni eliminate")
+
+
+def check_record_bid_changes():
+    """target_bid_state: più modifiche per target in un run, finestra di change_count che riparte."""
+    with temp_db():
+        day0 = datetime(2026, 1, 1, 8, 0, 0)
+
+        def change(tid, old, new, rule_id, **extra):
+            return {"target_id": tid, "old_bid": old, "new_bid": new, "rule_id": rule_id, **extra}
+
+        n = database.record_bid_changes([
+            change("A", 0.50, 0.55, 1, profile_id="P1", campaign_id="C1"),
+            change("B", 1.00, 0.90, 1, profile_id="P1", campaign_id="C2"),
+            change("A", 0.55, 0.60, 2),
+        ], day0)
+        assert n == 2
+        state = database.get_bid_states()
+        a = state["A"]
+        assert (a["previous_bid"], a["bid"], a["last_change_delta"], a["last_rule_id"]) == (0.50, 0.60, 0.1, 2), a
+        assert (a["change_count"], a["window_start"], a["profile_id"]) == (2, "2026-01-01T08:00:00Z", "P1"), a
+        assert state["B"]["change_count"] == 1 and state["B"]["last_change_delta"] == -0.1
+
+        # dentro la finestra (BID_CHANGE_WINDOW_DAYS): il conteggio si somma
+        database.record_bid_changes([change("A", 0.60, 0.65, 1)], day0 + timedelta(days=3))
+        a = database.get_bid_states(["A"])["A"]
+        assert (a["change_count"], a["window_start"], a["previous_bid"]) == (3, "2026-01-01T08:00:00Z", 0.60), a
+
+        # finestra scaduta: riparte da questo run
+        later = day0 + timedelta(days=database.BID_CHANGE_WINDOW_DAYS + 3)
+        database.record_bid_changes([change("A", 0.65, 0.70, 1)], later)
+        a = database.get_bid_states(["A"])["A"]
+        assert (a["change_count"], a["window_start"]) == (1, later.isoformat(timespec="seconds") + "Z"), a
+        assert a["profile_id"] == "P1" and a["campaign_id"] == "C1", a
+
+        assert database.get_bids_changed_since("2026-01-04T08:00:00Z") == {"A": 0.70}
+        print("OK target_bid_state: modifiche unite per run, finestra di", database.BID_CHANGE_WINDOW_DAYS, "giorni")
+
+
 if __name__ == "__main__":
     main()
+    check_run_summary_roundtrip()
+    check_target_changes_retention()
+    check_record_bid_changes()
@@ -1,7 +1,24 @@
+import contextlib
+import copy
+import io
+import json
+import math
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import db.database as database
+from rules.batch import TargetColumns, simulate_rules
+from rules.conflicts import analyze_rules
+from rules.cooldown import BidStateIndex, TargetState
+from rules.expressions import ExpressionError, compile_expression
 from rules.engine import (
     apply_rule_to_target,
     apply_rules_to_target,
 )
+from rules.guardrails import GuardrailIndex
+from scheduler.priority import SpendIndex, rule_impact, schedule_rules
 
 
 def print_header(title: str):
@@ -93,17 +110,582 @@ def main():
     print("New bid:", new_bid3)
     print("Action:", action3)
 
-    # 4) Applicare PIÙ REGOLE in sequenza sullo stesso target
-    rules = [rule_abs, rule_pct, rule_low_traffic]
+    # 4) Regola METRIC: CTR <= 1% con almeno 500 impression → -0.03
+    rule_metric = {
+        "id": 4,
+        "name": "CTR <= 1% -0.03",
+        "rule_type": "METRIC",
+        "campaign_id": None,
+        "marketplace": "US",
+        "match_type": "exact",
+        "conditions": '[{"metric": "ctr", "max": 1}, {"metric": "impressions", "min": 500}]',
+        "adjustment_type": "ABS",
+        "adjustment_value": -0.03,
+    }
+
+    new_bid4, action4 = apply_rule_to_target(target, rule_metric)
+    print_header("REGOLA 4 - METRIC CTR <= 1% -0.03")
+    print("Old bid:", target["bid"])
+    print("New bid:", new_bid4)
+    print("Action:", action4)
+
+    # 5) Applicare PIÙ REGOLE in sequenza sullo stesso target
+    rules = [rule_abs, rule_pct, rule_low_traffic, rule_metric]
     final_bid, logs = apply_rules_to_target(target, rules)
 
-    print_header("APPLICAZIONE SEQUENZIALE DI 3 REGOLE")
+    print_header("APPLICAZIONE SEQUENZIALE DI 4 REGOLE")
     print("Old bid:", target["bid"])
     print("Final bid:", final_bid)
     print("Dettaglio per regola:")
     for log in logs:
         print(log)
 
+    # 6) Cooldown e isteresi: stato dell'ultima modifica del target
+    rule_stable = {
+        **rule_abs,
+        "id": 5,
+        "name": "ACOS 20-30 +0.05, cooldown 48h, isteresi 20%",
+        "cooldown_hours": 48,
+        "hysteresis_pct": 20,
+    }
+    print_header("REGOLA 5 - COOLDOWN 48h / ISTERESI 20%")
+    for label, state in (
+        ("mai modificato", None),
+        ("diminuito 12 ore fa", TargetState(12.0, -1)),
+        ("diminuito 3 giorni fa", TargetState(72.0, -1)),
+        ("aumentato 3 giorni fa", TargetState(72.0, 1)),
+    ):
+        new_bid5, action5 = apply_rule_to_target(target, rule_stable, state=state)
+        print(f"{label}: new bid {new_bid5}, action {action5}")
+
+    # 7) Ordine di esecuzione per impatto: spesa recente x priorità
+    campaign_rules = [
+        {**rule_abs, "id": 10, "campaign_id": "111"},
+        {**rule_abs, "id": 11, "campaign_id": "111", "adjustment_value": -0.05},
+        {**rule_abs, "id": 12, "campaign_id": "222"},
+        {**rule_abs, "id": 13, "campaign_id": "333", "priority": 50},
+    ]
+    spend = SpendIndex({"1": 180.0}, {"111": 20.0, "222": 100.0, "333": 60.0}, days=7)
+    print_header("ORDINE PER IMPATTO (spesa 7 giorni x priorità)")
+    for r in campaign_rules:
+        print(f"regola {r['id']} campagna {r['campaign_id']}: impatto {rule_impact(r, spend):.1f}")
+    ordered = schedule_rules(campaign_rules, analyze_rules(campaign_rules), spend)
+    print("Ordine:", [r["id"] for r in ordered], "(11 sempre dopo 10: stesse condizioni e campagna)")
+
+
+# ==========================================================
+# VERIFICHE (assert): python test_rules.py si ferma al primo errore
+# ==========================================================
+
+@contextlib.contextmanager
+def temp_db():
+    """DB SQLite temporaneo per le verifiche che scrivono (log, stato bid), eliminato all'uscita."""
+    saved = database.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "rules.db")
+        try:
+            database.init_db()
+            yield database.DB_PATH
+        finally:
+            database.DB_PATH = saved
+
+
+def sample_targets():
+    """Target nel formato di fetch_targets_for_rule, su due campagne."""
+    rows = []
+    for i, (acos, clicks, bid) in enumerate([
+        (10.0, 40, 0.50), (25.0, 12, 0.80), (45.0, 30, 1.20), (80.0, 60, 0.30),
+        (None, 3, 0.40), (28.0, 0, 0.05), (60.0, 25, 2.00), (15.0, 8, None),
+    ]):
+        rows.append({
+            "target_id": str(100 + i),
+            "campaign_id": "C1" if i % 2 == 0 else "C2",
+            "profile_id": "P1",
+            "keyword_text": f"kw {i}",
+            "match_type": "exact",
+            "marketplace": "US",
+            "bid": bid,
+            "acos": acos,
+            "clicks": clicks,
+            "impressions": 100 * (i + 1),
+            "cost": 2.0 * clicks,
+            "orders": i % 3,
+            "sales": 10.0 * (i % 3),
+        })
+    return rows
+
+
+def sample_rules():
+    base = {
+        "campaign_id": None, "marketplace": "US", "match_type": None,
+        "acos_min": None, "acos_max": None, "clicks_min": None, "clicks_max": None,
+    }
+    return [
+        {**base, "id": 1, "name": "ACOS alto -10%", "rule_type": "ACOS_BAND",
+         "acos_min": 40, "acos_max": 100, "adjustment_type": "PCT", "adjustment_value": -10},
+        {**base, "id": 2, "name": "ACOS basso +0.05", "rule_type": "ACOS_BAND",
+         "acos_min": 0, "acos_max": 30, "adjustment_type": "ABS", "adjustment_value": 0.05,
+         "cooldown_hours": 24},
+        {**base, "id": 3, "name": "C2 molti click", "rule_type": "EXPRESSION", "campaign_id": "C2",
+         "expression": "clicks >= 10 and cpc > 1", "adjustment_type": "ABS", "adjustment_value": -0.03,
+         "hysteresis_pct": 20},
+    ]
+
+
+def sample_guardrails(day_start: bool = True):
+    """day_start=False: nessun bid di inizio giornata (la variazione si misura dal bid attuale)."""
+    return GuardrailIndex(
+        [
+            {"scope": "GLOBAL", "scope_id": "*", "min_bid": 0.10, "max_bid": 1.50, "max_change_pct": None},
+            {"scope": "CAMPAIGN", "scope_id": "C1", "min_bid": None, "max_bid": None, "max_change_pct": 5},
+        ],
+        day_start_bids={"102": 1.25} if day_start else None,
+    )
+
+
+def sample_bid_states(now):
+    changed = (now - timedelta(hours=6)).isoformat(timespec="seconds") + "Z"
+    return BidStateIndex(
+        [
+            {"target_id": "100", "last_change_at": changed, "last_change_delta": 0.05},
+            {"target_id": "103", "last_change_at": changed, "last_change_delta": 0.02},
+        ],
+        now,
+    )
+
+
+def check_simulation_parity():
+    """simulate_rules (dry run) e process_single_rule (run reale) danno gli stessi bid."""
+    import scheduler.runner as runner
+
+    with temp_db():
+        now = datetime.utcnow()
+        targets, rules = sample_targets(), sample_rules()
+
+        result = simulate_rules(
+            TargetColumns.from_rows(copy.deepcopy(targets)), rules,
+            guardrails=sample_guardrails(), bid_states=sample_bid_states(now),
+        )
+        simulated = {c["target_id"]: c["new_bid"] for c in result.changes()}
+
+        ctx = runner.RunContext(guardrails=sample_guardrails(), bid_states=sample_bid_states(now))
+        sent = []
+        saved = runner.fetch_targets_for_rule, runner.update_bids_in_amazon
+        runner.fetch_targets_for_rule = lambda rule, refresh=True: [
+            t for t in copy.deepcopy(targets)
+            if not rule.get("campaign_id") or t["campaign_id"] == rule["campaign_id"]
+        ]
+        runner.update_bids_in_amazon = lambda profile_id, bids: sent.append((profile_id, bids))
+        try:
+            for rule in rules:
+                stats = runner.new_run_stats(None, rule["id"])
+                runner.process_single_rule(rule, ctx, stats=stats)
+                projection = next(p for p in result.rules if p.rule_id == rule["id"])
+                assert stats["increases"] == projection.actions["INCREASE"], (rule["id"], stats, projection)
+                assert stats["decreases"] == projection.actions["DECREASE"], (rule["id"], stats, projection)
+                # 107 non ha bid: saltato, senza interrompere la regola
+                if rule["campaign_id"] is None:
+                    assert stats["actions"].get("SKIP_NO_BID") == 1, (rule["id"], stats)
+        finally:
+            runner.fetch_targets_for_rule, runner.update_bids_in_amazon = saved
+
+        assert simulated, "la simulazione deve modificare qualche target"
+        assert ctx.applied == simulated, (ctx.applied, simulated)
+        # un solo profilo: al più una chiamata per regola, con tutte le sue modifiche
+        assert len(sent) <= len(rules) and {pid for pid, _ in sent} == {"P1"}, sent
+        assert sum(len(bids) for _, bids in sent) == len(ctx.changes)
+        print("OK parità simulate_rules / process_single_rule:", simulated)
+
+
+def check_backtest_parity():
+    """Un solo run di backtest_rules sulle metriche dei target dà i bid di simulate_rules."""
+    from array import array
+
+    from rules.backtest import backtest_rules, build_history, history_metrics
+
+    rows = []
+    for t in sample_targets():
+        # metriche coerenti con lo storico: l'ACOS del backtest è cost / sales
+        sales = t["cost"] * 100.0 / t["acos"] if t["acos"] else 0.0
+        acos = t["cost"] / sales * 100.0 if sales > 0 and t["cost"] > 0 else None
+        rows.append({**t, "sales": sales, "acos": acos})
+    rules = sample_rules()
+    # il backtest misura la variazione giornaliera dal bid di inizio del giorno simulato
+    guardrails = sample_guardrails(day_start=False)
+    cols = TargetColumns.from_rows(rows)
+    result = simulate_rules(cols, rules, guardrails=guardrails)
+    simulated = {c["target_id"]: c["new_bid"] for c in result.changes()}
+
+    # tutto il traffico in un solo giorno, il giorno prima del run
+    day = datetime(2026, 1, 14).date()
+    metrics = history_metrics(rules)
+    columns = {"target_id": array("q", (int(t["target_id"]) for t in rows))}
+    for name in metrics:
+        typecode = "d" if name in ("cost", "sales") else "q"
+        columns[name] = array(typecode, (t[name] for t in rows))
+    history = build_history(cols.target_id, [day.isoformat()], lambda d: columns, metrics)
+    backtest = backtest_rules(
+        cols, history, rules, period_days=1, end_date=day + timedelta(days=1), guardrails=guardrails,
+    )
+    replayed = {
+        tid: float(final)
+        for tid, start, final in zip(backtest.target_ids, backtest.start_bids, backtest.final_bids)
+        if not math.isnan(start) and final != start
+    }
+    assert simulated and replayed == simulated, (replayed, simulated)
+    print("OK parità backtest_rules (un run) / simulate_rules:", len(simulated), "target modificati")
+
+
+def check_expressions():
+    """Costrutti non ammessi rifiutati; forma scalare e vettoriale concordi."""
+    for text in (
+        "__import__('os').system('true')",
+        "clicks.__class__",
+        "[c for c in ()]",
+        "clicks if cost else orders",
+        "lambda: clicks",
+        "clicks ** 2 > 1",
+        "foo > 1",
+        "(clicks := 5) > 1",
+        "clicks[0] > 1",
+        "'a' < 'b'",
+        "clicks > 5 or not 1 < 2",
+    ):
+        try:
+            compile_expression(text)
+        except ExpressionError:
+            continue
+        raise AssertionError(f"espressione accettata: {text}")
+
+    cols = TargetColumns.from_rows(sample_targets())
+    for text in (
+        "clicks >= 20 and orders == 0",
+        "cpc > 2.5 or (ctr < 15 and impressions > 300)",
+        "10 <= clicks < 50 and not acos > 40",
+        "sales / orders > 5 or cvr != 0",
+        "cost - sales * 0.5 > -1",
+    ):
+        compiled = compile_expression(text)
+        mask = compiled.mask({name: cols.metric_array(name) for name in compiled.names}, len(cols))
+        scalar = [compiled.matches(t) for t in sample_targets()]
+        assert mask.tolist() == scalar, (text, mask.tolist(), scalar)
+    print("OK espressioni: costrutti non ammessi rifiutati, scalare == vettoriale")
+
+
+def check_guardrails():
+    """max_change_pct limita la variazione rispetto al bid di inizio giornata, anche tra regole."""
+    from amazon_api.update_bids import build_bid_updates
+
+    rule_down, rule_up = sample_rules()[0], sample_rules()[1]
+    targets = {t["target_id"]: t for t in sample_targets()}
+
+    index = sample_guardrails()
+    # 102 (C1, max 5%): partiva da 1.25 a inizio giornata, -10% si ferma a 1.1875
+    lo, hi = index.bounds_for(targets["102"])
+    assert (round(lo, 4), round(hi, 4)) == (1.1875, 1.3125), (lo, hi)
+    assert apply_rule_to_target(targets["102"], rule_down, lo, hi) == (1.19, "DECREASE")
+    # 106 (C1): l'intervallo del 5% è fuori dal max_bid globale 1.50
+    assert index.bounds_for(targets["106"]) == (1.5, 1.5)
+    assert apply_rule_to_target(targets["106"], rule_down, *index.bounds_for(targets["106"])) == (1.5, "DECREASE")
+
+    # due regole nello stesso run: la seconda parte dal bid già alzato ma
+    # il riferimento resta il bid di inizio giornata
+    target = {**targets["100"], "bid": 1.00, "acos": 20.0}
+    new_bid, action = apply_rule_to_target(target, rule_up, *index.bounds_for(target))
+    assert (new_bid, action) == (1.05, "INCREASE"), (new_bid, action)
+    index.note_change(target["target_id"], 1.00)
+    raised = {**target, "bid": new_bid}
+    assert apply_rule_to_target(raised, rule_up, *index.bounds_for(raised)) == (1.05, "NO_ACTION")
+
+    # modifica manuale (pagina Modifica Bid): stessi limiti
+    updates = build_bid_updates(
+        [{"targetId": "100", "campaignId": "C1", "bid": {"bid": 1.00}}], 0.20, sample_guardrails(), "P1"
+    )
+    assert updates == [{"targetId": "100", "bid": {"bid": 1.05}}], updates
+    print("OK guardrail: max_change_pct e limiti assoluti applicati")
+
+
+def check_cooldown_hysteresis():
+    """SKIP_COOLDOWN e SKIP_HYSTERESIS: motore, simulazione e modifiche manuali registrate."""
+    rule = {**sample_rules()[1], "cooldown_hours": 24, "hysteresis_pct": 20}  # ACOS 0-30, +0.05
+    base = {**sample_targets()[1], "bid": 0.80}
+    cases = [
+        # (acos, stato ultima modifica, azione attesa)
+        (28.0, None, "INCREASE"),
+        (28.0, TargetState(6.0, 1), "SKIP_COOLDOWN"),
+        (28.0, TargetState(6.0, -1), "SKIP_COOLDOWN"),
+        (28.0, TargetState(48.0, -1), "SKIP_HYSTERESIS"),  # inversione: soglia stretta a 24
+        (10.0, TargetState(48.0, -1), "INCREASE"),
+        (28.0, TargetState(48.0, 1), "INCREASE"),  # stessa direzione: nessuna isteresi
+    ]
+    now = datetime.utcnow()
+    rows, states = [], []
+    for i, (acos, state, expected) in enumerate(cases):
+        target = {**base, "target_id": str(900 + i), "acos": acos}
+        assert apply_rule_to_target(target, rule, state=state)[1] == expected, (i, expected)
+        rows.append(target)
+        if state is not None:
+            changed = now - timedelta(hours=state.hours_since_change)
+            states.append({
+                "target_id": target["target_id"],
+                "last_change_at": changed.isoformat(timespec="seconds") + "Z",
+                "last_change_delta": 0.05 * state.direction,
+            })
+
+    result = simulate_rules(TargetColumns.from_rows(rows), [rule], bid_states=BidStateIndex(states, now))
+    expected = {}
+    for _, _, action in cases:
+        expected[action] = expected.get(action, 0) + 1
+    actions = {k: v for k, v in result.rules[0].actions.items() if v}
+    assert actions == expected, (actions, expected)
+
+    # isteresi solo sulla soglia attraversata (lato della modifica opposta)
+    from rules.cooldown import tighten_rule
+
+    up = {"rule_type": "ACOS_BAND", "acos_min": 10, "acos_max": 30, "adjustment_value": 0.05, "hysteresis_pct": 20}
+    assert (tighten_rule(up)["acos_min"], tighten_rule(up)["acos_max"]) == (10, 24)
+    down = {**up, "acos_min": 40, "acos_max": 100, "adjustment_value": -10}
+    assert (tighten_rule(down)["acos_min"], tighten_rule(down)["acos_max"]) == (48, 100)
+    low = {"rule_type": "LOW_TRAFFIC", "clicks_min": 5, "clicks_max": 10, "adjustment_value": 0.1, "hysteresis_pct": 20}
+    assert (tighten_rule(low)["clicks_min"], tighten_rule(low)["clicks_max"]) == (5, 8)
+    metric = {
+        "rule_type": "METRIC", "adjustment_value": -0.1, "hysteresis_pct": 20,
+        "conditions": [{"metric": "cost", "min": 10, "max": 50}, {"metric": "orders", "min": 1, "max": 5}],
+    }
+    tight = {c["metric"]: (c["min"], c["max"]) for c in json.loads(tighten_rule(metric)["conditions"])}
+    assert tight == {"cost": (12, 50), "orders": (1, 4)}, tight
+    expr = {"rule_type": "EXPRESSION", "expression": "acos >= 5 and acos <= 30 and orders > 2",
+            "adjustment_value": 0.05, "hysteresis_pct": 20}
+    assert tighten_rule(expr)["expression"] == "acos >= 5 and acos <= 24.0 and (orders > 2.4)", tighten_rule(expr)
+
+    # una modifica manuale (db.log_manual_bid_changes) fa partire il cooldown
+    with temp_db():
+        database.log_manual_bid_changes([
+            {"target_id": "900", "profile_id": "P1", "campaign_id": "C2", "old_bid": 0.90, "new_bid": 0.80},
+        ])
+        state = database.load_bid_state_index().state("900")
+        assert state is not None and state.direction == -1 and state.hours_since_change < 1, state
+        assert apply_rule_to_target(rows[0], rule, state=state)[1] == "SKIP_COOLDOWN"
+        print("OK cooldown / isteresi:", expected)
+
+
+def run_once_cli(argv, update=None):
+    """
+    python -m scheduler.runner argv su un DB temporaneo con due regole
+    dovute, senza Amazon: (codice di uscita, riepilogo JSON, bid inviati).
+    """
+    import auth
+    import settings
+    import scheduler.runner as runner
+
+    with temp_db():
+        for rule in sample_rules()[:2]:
+            database.create_rule({
+                **{k: v for k, v in rule.items() if k != "id"},
+                "timeframe_days": 14, "frequency_days": 1, "enabled": 1,
+            })
+        sent = []
+
+        def send(profile_id, bids):
+            if update is not None:
+                update(profile_id, bids)
+            sent.append((profile_id, bids))
+
+        saved = (
+            runner.fetch_targets_for_rule, runner.update_bids_in_amazon,
+            settings.require_credentials, auth.TokenRefresher,
+        )
+        runner.fetch_targets_for_rule = lambda rule, refresh=True: sample_targets()
+        runner.update_bids_in_amazon = send
+        settings.require_credentials = lambda: None
+        auth.TokenRefresher = contextlib.nullcontext
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                code = runner.main(argv)
+        finally:
+            (
+                runner.fetch_targets_for_rule, runner.update_bids_in_amazon,
+                settings.require_credentials, auth.TokenRefresher,
+            ) = saved
+        summary = json.loads(out.getvalue().strip().splitlines()[-1])
+        return code, summary, sent
+
+
+def check_once_exit_codes():
+    """--once: 0 ok, 1 errori, 3 budget esaurito; --dry-run non invia nulla."""
+    from scheduler.runner import EXIT_BUDGET, EXIT_ERROR, EXIT_OK
+
+    code, summary, sent = run_once_cli(["--once"])
+    assert code == EXIT_OK and summary["status"] == "ok", summary
+    assert sent and summary["api_calls"] == len(sent), summary
+    assert summary["rules_run"] == summary["rules_due"] and len(summary["rules_run"]) == 2
+
+    code, summary, sent = run_once_cli(["--dry-run"])
+    assert code == EXIT_OK and summary["dry_run"] and not sent, summary
+
+    def fail(profile_id, bids):
+        raise RuntimeError("429 Too Many Requests")
+
+    code, summary, sent = run_once_cli(["--once"], update=fail)
+    assert code == EXIT_ERROR and summary["status"] == "error", summary
+    assert "429" in summary["error"], summary
+
+    code, summary, sent = run_once_cli(
+        ["--once", "--budget", "0.05"], update=lambda profile_id, bids: time.sleep(0.1)
+    )
+    assert code == EXIT_BUDGET and summary["status"] == "budget_exhausted", summary
+    assert summary["skipped_budget"] or summary["rules_deferred"], summary
+    print("OK --once: codici di uscita 0 / 1 / 3")
+
+
+def check_concurrent_batches():
+    """--concurrency: un thread per profilo, blocchi in sequenza, mirror dal thread principale."""
+    import threading
+
+    import db.mirror as mirror
+    import scheduler.runner as runner
+    from amazon_api.update_bids import MAX_TARGETS_PER_REQUEST
+
+    with temp_db():
+        per_profile = MAX_TARGETS_PER_REQUEST + 20
+        targets = [
+            {**sample_targets()[0], "target_id": f"{pid}-{i}", "profile_id": pid, "campaign_id": f"{pid}-C"}
+            for pid in ("P1", "P2")
+            for i in range(per_profile)
+        ]
+        rule = {**sample_rules()[1], "cooldown_hours": None}
+        lock = threading.Lock()
+        busy, calls, invalidated = set(), [], []
+
+        def send(profile_id, bids):
+            with lock:
+                assert profile_id not in busy, "due blocchi dello stesso profilo in parallelo"
+                busy.add(profile_id)
+            time.sleep(0.02)
+            with lock:
+                busy.discard(profile_id)
+                calls.append((profile_id, len(bids), threading.current_thread().name))
+
+        def invalidate(profile_id, campaign_ids=None):
+            assert threading.current_thread() is threading.main_thread()
+            invalidated.append((profile_id, list(campaign_ids)))
+
+        saved = runner.fetch_targets_for_rule, runner.update_bids_in_amazon, mirror.invalidate_mirror
+        runner.fetch_targets_for_rule = lambda rule, refresh=True: copy.deepcopy(targets)
+        runner.update_bids_in_amazon = send
+        mirror.invalidate_mirror = invalidate
+        try:
+            ctx = runner.RunContext(concurrency=4)
+            stats = runner.new_run_stats(None, rule["id"])
+            with contextlib.redirect_stdout(io.StringIO()):
+                runner.process_single_rule(rule, ctx, stats=stats)
+        finally:
+            runner.fetch_targets_for_rule, runner.update_bids_in_amazon, mirror.invalidate_mirror = saved
+
+        assert stats["increases"] == 2 * per_profile and stats["api_calls"] == 4, stats
+        assert sorted((pid, n) for pid, n, _ in calls) == [
+            ("P1", 20), ("P1", MAX_TARGETS_PER_REQUEST), ("P2", 20), ("P2", MAX_TARGETS_PER_REQUEST)
+        ], calls
+        assert all(name.startswith("bid-update") for _, _, name in calls), calls
+        assert sorted(invalidated) == [("P1", ["P1-C"]), ("P2", ["P2-C"])], invalidated
+        print("OK concurrency: blocchi per profilo, mirror invalidato una volta per profilo")
+
+
+def check_report_v2_fallback():
+    """Ordini e vendite letti da v3 o, riga per riga, dalle colonne v2 (_first_value)."""
+    from amazon_api.metrics_table import (
+        ORDERS_KEYS, SALES_KEYS, _first_value, parse_sp_targeting_daily, parse_sp_targeting_table,
+    )
+
+    v2 = {"targetId": "2", "date": "2026-01-15", "cost": 5.0, "clicks": 4,
+          "attributedSales14d": 40.0, "attributedConversions14d": 3}
+    v3 = {"targetId": "1", "date": "2026-01-15", "cost": 3.0, "clicks": 2,
+          "sales14d": 12.0, "purchases14d": 1, "attributedSales14d": 0, "attributedConversions14d": 0}
+    assert _first_value(v2, SALES_KEYS) == 40.0 and _first_value(v2, ORDERS_KEYS) == 3
+    assert _first_value(v3, SALES_KEYS) == 12.0 and _first_value(v3, ORDERS_KEYS) == 1
+    # v3 a zero (nessuna vendita): non ripiega su un v2 assente
+    assert not _first_value({"sales14d": 0}, SALES_KEYS)
+
+    table = parse_sp_targeting_table([v2, v3])
+    assert table.get(2)["sales"] == 40.0 and table.get(2)["orders"] == 3, table.get(2)
+    assert table.get(1)["sales"] == 12.0 and table.get(1)["orders"] == 1, table.get(1)
+    assert round(table.get(2)["acos"], 6) == 12.5, table.get(2)
+    daily = parse_sp_targeting_daily([v2, v3])["2026-01-15"]
+    assert daily.get(2)["sales"] == 40.0 and daily.get(2)["orders"] == 3, daily.get(2)
+    print("OK report: ordini e vendite da colonne v3 o v2 per riga")
+
+
+def check_conflicts():
+    """analyze_rules: estremi che si toccano, LOW_TRAFFIC semiaperti, ambiti disgiunti, ordine di priorità."""
+    def acos(rid, lo, hi, **extra):
+        return {"id": rid, "rule_type": "ACOS_BAND", "acos_min": lo, "acos_max": hi,
+                "adjustment_value": 0.05, **extra}
+
+    def clicks(rid, lo, hi):
+        return {"id": rid, "rule_type": "LOW_TRAFFIC", "clicks_min": lo, "clicks_max": hi,
+                "adjustment_value": 0.05}
+
+    def pairs(analysis):
+        return {(o.rule_id, o.other_rule_id, o.kind) for o in analysis.overlaps}
+
+    # bande ACOS con estremi inclusi: [0, 30] e [30, 60] condividono ACOS 30
+    touching = analyze_rules([acos(1, 0, 30), acos(2, 30, 60, adjustment_value=-10)])
+    assert [(o.kind, o.low, o.high, o.opposite) for o in touching.overlaps] == [("ACOS", 30, 30, True)]
+
+    # click < clicks_max: [0, 10) e [10, 20) non hanno click in comune
+    assert not analyze_rules([clicks(3, 0, 10), clicks(4, 10, 20)]).overlaps
+    assert pairs(analyze_rules([clicks(3, 0, 10), clicks(4, 9, 20)])) == {(3, 4, "CLICKS")}
+
+    # stesse bande su campagne (o marketplace) diverse: nessuna sovrapposizione
+    assert not analyze_rules([acos(5, 0, 50, campaign_id="C1"), acos(6, 0, 50, campaign_id="C2")]).overlaps
+    assert not analyze_rules([acos(5, 0, 50, marketplace="US"), acos(6, 0, 50, marketplace="IT")]).overlaps
+    assert pairs(analyze_rules([acos(5, 0, 50, campaign_id="C1"), acos(6, 0, 50)])) == {(5, 6, "ACOS")}
+
+    # overlapping_earlier segue l'ordine di priorità (poi ID), non l'ordine di inserimento
+    analysis = analyze_rules([acos(10, 0, 100, priority=50), acos(11, 0, 100, priority=10), acos(12, 0, 100)])
+    assert analysis.order == [11, 10, 12], analysis.order
+    assert analysis.overlapping_earlier(11) == []
+    assert analysis.overlapping_earlier(10) == [11]
+    assert analysis.overlapping_earlier(12) == [11, 10]
+    print("OK conflitti: estremi, ambiti e ordine di priorità")
+
+
+def check_marketplace_alias():
+    """Marketplace della regola (alias, minuscole, stringId) nel codice dei target."""
+    from amazon_api.profiles import ProfileRegistry
+    from rules.engine import matches_filters
+
+    registry = ProfileRegistry(
+        [
+            {"profileId": 1, "countryCode": "GB", "accountInfo": {"marketplaceStringId": "A1F83G8C2ARO7P"}},
+            {"profileId": 2, "countryCode": "US"},
+        ],
+        time.time(),
+    )
+    target = {"target_id": "T1", "marketplace": "GB"}
+    for alias in ("UK", "uk", "gb", "a1f83g8c2aro7p"):
+        rule = {"marketplace": registry.canonical_marketplace(alias)}
+        assert rule["marketplace"] == "GB" and matches_filters(target, rule), alias
+    assert registry.canonical_marketplace("it ") == "IT"
+    assert not matches_filters(target, {"marketplace": registry.canonical_marketplace("us")})
+    print("OK marketplace: alias UK/GB, minuscole e stringId normalizzati")
+
+
+def run_checks():
+    print_header("VERIFICHE")
+    check_simulation_parity()
+    check_backtest_parity()
+    check_expressions()
+    check_guardrails()
+    check_cooldown_hysteresis()
+    check_once_exit_codes()
+    check_conflicts()
+    check_concurrent_batches()
+    check_marketplace_alias()
+    check_report_v2_fallback()
+
 
 if __name__ == "__main__":
     main()
+    run_checks()